@@ -0,0 +1,350 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import logging
+import threading
+import time
+
+from db import DB
+from entities import INVALID_ID, Author, Review, Story, User
+from metrics import DB_QUERY_SECONDS, DB_READER_WAIT_SECONDS, timed_query
+
+
+_DONE = object()
+
+
+class ReaderPool:
+    '''Потоки с соединениями только для чтения к одной БД (см. DB.reader()), по соединению на поток
+
+    Соединение открывается при первом чтении в потоке. Благодаря WAL каждый запрос читает последний
+    зафиксированный снимок БД и не ждёт ни фиксации записей, ни других читателей.
+    '''
+
+    def __init__(self, db: DB, size: int, name: str):
+        self.db = db
+        self.name = name
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix=f'{name}-reader')
+        self._local = threading.local()
+        self._readers = []
+
+    def _read(self, submitted: float, fn, args: tuple):
+        # Reads that find all connections busy wait in the queue of the executor
+        DB_READER_WAIT_SECONDS.observe(self.name, value=time.perf_counter() - submitted)
+        reader = getattr(self._local, 'reader', None)
+        if reader is None:
+            reader = self._local.reader = self.db.reader()
+            self._readers.append(reader)
+        return timed_query(fn, reader, *args)
+
+    async def run(self, fn, *args):
+        '''Выполняем `fn(reader, *args)` на свободном соединении'''
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self._read, time.perf_counter(), fn, args
+        )
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for reader in self._readers:
+            reader.close()
+        self._readers.clear()
+
+
+class AsyncDB:
+    '''Асинхронная обёртка над DB: все запросы выполняются в отдельных потоках, не блокируя event loop
+
+    Для ShardedDB у каждого шарда свой поток и своя очередь записи, так что шарды работают параллельно.
+    Чтения пользовательских данных идут через пул соединений только для чтения каждого шарда
+    (`readers` соединений, см. ReaderPool) и не ждут, пока поток записи фиксирует очередную пачку.
+    '''
+
+    def __init__(self, db: DB, batch_delay: float = 0, batch_size: int = 256, readers: int = 4):
+        self.db = db
+        self._shards = getattr(db, 'shards', [db])
+        # sqlite3 connection is not safe for concurrent use, so all queries to a shard
+        # are serialized through a single dedicated thread
+        self._executors = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'db{i}') for i in range(len(self._shards))
+        ]
+        # There is no second connection to an in-memory database, it is read in the thread of the writer
+        self._readers = [
+            ReaderPool(shard, readers, f'db{i}') if readers > 0 and not shard.in_memory else None
+            for i, shard in enumerate(self._shards)
+        ]
+        # Writes are queued and committed in batches, see write()
+        self.batch_delay = batch_delay
+        self.batch_size = batch_size
+        self._writes = [[] for _ in self._shards]
+        self._batch_full = [asyncio.Event() for _ in self._shards]
+        self._flushers = [None for _ in self._shards]
+
+    def version(self, user_id: int):
+        '''Версия данных пользователя, см. CachedDB.version(); без кэша версий нет'''
+        return None
+
+    def _shard_index(self, args: tuple) -> int:
+        return 0 if len(self._shards) == 1 else self.db.shard_index(args)
+
+    async def _run_in(self, shard_index: int, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executors[shard_index], partial(timed_query, fn, *args, **kwargs)
+        )
+
+    async def run(self, fn, *args, **kwargs):
+        return await self._run_in(self._shard_index(args), fn, *args, **kwargs)
+
+    async def read(self, fn, *args):
+        '''Выполняем чтение `fn(db, *args)`, где `fn` - метод DB (например, DB.list_authors), в пуле читателей
+
+        Запрос видит все изменения, которые уже дождались write(), так что пользователь сразу видит свои записи.
+        '''
+        index = self._shard_index(args)
+        pool = self._readers[index]
+        if pool is None:
+            return await self._run_in(index, fn, self._shards[index], *args)
+        return await pool.run(fn, *args)
+
+    async def run_reader(self, fn, *args):
+        '''Выполняем долгое чтение `fn(db, *args)` в отдельном потоке со своим соединением (см. DB.reader())
+
+        Поток БД в это время обслуживает запросы остальных пользователей.
+        '''
+        if self.db.in_memory:
+            # There is no second connection to an in-memory database
+            return await self.run(fn, self.db, *args)
+
+        def read():
+            reader = self.db.reader()
+            try:
+                return timed_query(fn, reader, *args)
+            finally:
+                reader.close()
+
+        return await asyncio.get_running_loop().run_in_executor(None, read)
+
+    async def write(self, fn, *args):
+        '''Ставим изменение `fn(*args)` в очередь и ждём, пока транзакция с ним будет зафиксирована
+
+        Изменения, накопившиеся, пока фиксировалась предыдущая пачка (и ещё `batch_delay` секунд),
+        но не больше `batch_size`, фиксируются одной транзакцией, то есть одним fsync на всю пачку.
+        '''
+        index = self._shard_index(args)
+        future = asyncio.get_running_loop().create_future()
+        writes = self._writes[index]
+        writes.append((fn, args, future))
+        if len(writes) >= self.batch_size:
+            self._batch_full[index].set()
+        flusher = self._flushers[index]
+        if flusher is None or flusher.done():
+            self._flushers[index] = asyncio.create_task(self._flush_writes(index))
+        return await future
+
+    async def _flush_writes(self, index: int):
+        batch_full = self._batch_full[index]
+        while self._writes[index]:
+            if self.batch_delay > 0 and len(self._writes[index]) < self.batch_size:
+                try:
+                    await asyncio.wait_for(batch_full.wait(), self.batch_delay)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                # Let the writes issued in the same iteration of the event loop join the batch
+                await asyncio.sleep(0)
+            batch_full.clear()
+            writes = self._writes[index]
+            batch, self._writes[index] = writes[:self.batch_size], writes[self.batch_size:]
+            try:
+                calls = [(partial(timed_query, fn), args) for fn, args, _ in batch]
+                results = await self._run_in(index, self._shards[index].run_batch, calls)
+            except Exception as e:
+                logging.exception('Failed to commit a batch of writes')
+                results = [(None, e)] * len(batch)
+            for (_, _, future), (result, error) in zip(batch, results):
+                # The waiting handler may have been cancelled
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+    async def stream(self, fn, *args):
+        '''Асинхронно перебираем итератор `fn(db, *args)`; каждый шаг выполняется в потоке БД
+
+        Так курсор читается по мере отправки результатов, а не загружается в память целиком.
+        Если у шарда есть пул читателей, перебор идёт в его потоках, но со своим соединением:
+        весь список читается из одного снимка БД и не занимает соединений пула, пока отправляются ответы.
+        '''
+        index = self._shard_index(args)
+        pool = self._readers[index]
+        executor = self._executors[index] if pool is None else pool.executor
+        reader = None
+        pending = None
+        # Time spent in the database thread is summed over all steps and reported as one query
+        elapsed = 0.0
+
+        def step(call, *call_args):
+            nonlocal elapsed
+            start = time.perf_counter()
+            try:
+                return call(*call_args)
+            finally:
+                elapsed += time.perf_counter() - start
+
+        def start_iteration():
+            nonlocal reader
+            if pool is None:
+                return iter(fn(self.db, *args))
+            reader = self._shards[index].reader()
+            return iter(fn(reader, *args))
+
+        async def run_step(call, *call_args):
+            nonlocal pending
+            pending = executor.submit(step, call, *call_args)
+            return await asyncio.wrap_future(pending)
+
+        def close_reader(_=None):
+            if reader is not None:
+                reader.close()
+
+        try:
+            iterator = await run_step(start_iteration)
+            while True:
+                item = await run_step(next, iterator, _DONE)
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            DB_QUERY_SECONDS.observe(fn.__name__, value=elapsed)
+            # A cancelled step may still be running, its connection is closed after it
+            if pending is None or pending.done():
+                close_reader()
+            else:
+                pending.add_done_callback(close_reader)
+
+    async def close(self):
+        '''Дожидаемся записи всех изменений из очередей и останавливаем потоки БД'''
+        for index in range(len(self._shards)):
+            while self._flushers[index] is not None and not self._flushers[index].done():
+                await self._flushers[index]
+        for executor in self._executors:
+            executor.shutdown(wait=True)
+        for pool in self._readers:
+            if pool is not None:
+                pool.close()
+
+    async def add_user_if_new(self, user: User):
+        return await self.write(self.db.add_user_if_new, user)
+
+    async def add_author(self, author: Author):
+        return await self.write(self.db.add_author, author)
+
+    async def author_id(self, user: User, author_name: str):
+        return await self.read(DB.author_id, user, author_name)
+
+    async def similar_authors(self, user: User, author_name: str, limit: int = 3):
+        return await self.read(DB.similar_authors, user, author_name, limit)
+
+    async def get_author(self, user: User, author_id: int):
+        return await self.read(DB.get_author, user, author_id)
+
+    async def list_authors(self, user: User):
+        return await self.read(DB.list_authors, user)
+
+    async def list_authors_page(self, user: User, cursor=None, limit: int = 10, backward: bool = False):
+        return await self.read(DB.list_authors_page, user, cursor, limit, backward)
+
+    async def remove_author(self, user: User, author_id: int):
+        return await self.write(self.db.remove_author, user, author_id)
+
+    async def add_story(self, story: Story):
+        return await self.write(self.db.add_story, story)
+
+    async def story_id(self, user: User, story: Story, author: Author):
+        return await self.read(DB.story_id, user, story, author)
+
+    async def similar_stories(self, user: User, author_id: int, title: str, limit: int = 3):
+        return await self.read(DB.similar_stories, user, author_id, title, limit)
+
+    async def get_story(self, user: User, story_id: int):
+        return await self.read(DB.get_story, user, story_id)
+
+    async def list_stories(self, user: User, author_id: int = INVALID_ID):
+        return await self.read(DB.list_stories, user, author_id)
+
+    async def list_stories_page(
+        self, user: User, author_id: int, cursor=None, limit: int = 10, backward: bool = False
+    ):
+        return await self.read(DB.list_stories_page, user, author_id, cursor, limit, backward)
+
+    async def remove_story(self, user: User, story_id: int):
+        return await self.write(self.db.remove_story, user, story_id)
+
+    async def add_review(self, review: Review):
+        return await self.write(self.db.add_review, review)
+
+    async def get_review(self, user: User, review_id: int):
+        return await self.read(DB.get_review, user, review_id)
+
+    async def list_reviews(self, user: User, author_id: int = INVALID_ID):
+        return await self.read(DB.list_reviews, user, author_id)
+
+    async def list_story_reviews(self, user: User, story_id: int):
+        return await self.read(DB.list_story_reviews, user, story_id)
+
+    async def list_story_reviews_page(
+        self, user: User, story_id: int, cursor=None, limit: int = 10, backward: bool = False
+    ):
+        return await self.read(DB.list_story_reviews_page, user, story_id, cursor, limit, backward)
+
+    async def search_reviews(self, user: User, query: str, offset: int = 0, limit: int = 10):
+        return await self.read(DB.search_reviews, user, query, offset, limit)
+
+    async def remove_review(self, user: User, review_id: int):
+        return await self.write(self.db.remove_review, user, review_id)
+
+    async def undo_remove(self, user: User, since: float):
+        return await self.write(self.db.undo_remove, user, since)
+
+    async def purge_removed(self, before: float, limit: int = 100) -> int:
+        '''Окончательно удаляем всё, что удалено раньше `before` (см. DB.purge_removed()), во всех шардах
+
+        Пачки идут через поток БД по одной, между ними выполняются запросы пользователей.
+        '''
+        purged = 0
+        for index, shard in enumerate(self._shards):
+            while True:
+                count = await self._run_in(index, shard.purge_removed, before, limit)
+                purged += count
+                if count == 0:
+                    break
+        return purged
+
+    async def import_reviews(self, user: User, rows: list):
+        return await self.write(self.db.import_reviews, user, rows)
+
+    async def get_stats(self, user: User, authors: int = 10, stories: int = 5):
+        return await self.read(DB.get_stats, user, authors, stories)
+
+    async def load_user_data(self):
+        return await self.run(self.db.load_user_data)
+
+    async def save_user_data(self, user_id: int, data):
+        return await self.write(self.db.save_user_data, user_id, data)
+
+    async def load_conversations(self, name: str):
+        return await self.run(self.db.load_conversations, name)
+
+    async def save_conversation(self, name: str, key: str, state):
+        return await self.write(self.db.save_conversation, name, key, state)
+
+    async def load_callback_data(self, worker: int = 0):
+        return await self.run(self.db.load_callback_data, worker)
+
+    async def save_callback_data(
+        self, keyboards: list, access_times: list, removed_keyboards: list, queries: list, removed_queries: list,
+        worker: int = 0,
+    ):
+        return await self.write(
+            self.db.save_callback_data, keyboards, access_times, removed_keyboards, queries, removed_queries, worker
+        )
@@ -0,0 +1,38 @@
+'''Общее для бенчмарков: пользователи и свежие БД'''
+from types import SimpleNamespace
+from typing import Callable, Iterable
+
+from db import DB
+from entities import User
+from sharding import ShardedDB, shard_paths
+
+
+def telegram_user(user_id: int) -> SimpleNamespace:
+    '''Пользователь Telegram, как update.effective_user'''
+    return SimpleNamespace(
+        id=user_id, is_bot=False, username=f'user{user_id}', first_name='', last_name='', language_code='ru'
+    )
+
+
+def make_user(user_id: int) -> User:
+    return User(telegram_user(user_id))
+
+
+def new_db(sqlite_fn: str, shards: int = 1) -> DB:
+    '''Пустая БД со всеми таблицами; при `shards` > 1 - шардированная'''
+    db = ShardedDB(shard_paths(sqlite_fn, shards)) if shards > 1 else DB(sqlite_fn)
+    db.prepare()
+    return db
+
+
+def seed(sqlite_fn: str, user_ids: Iterable[int], reviews: Callable[[int], list]) -> DB:
+    '''Новая БД, где каждому пользователю импортированы отзывы `reviews(user_id)`
+
+    Отзывы - кортежи (автор, произведение, текст, оценка), как для DB.import_reviews().
+    '''
+    db = new_db(sqlite_fn)
+    for user_id in user_ids:
+        user = make_user(user_id)
+        db.add_user_if_new(user)
+        db.import_reviews(user, reviews(user_id))
+    return db
@@ -0,0 +1,126 @@
+'''Сравнение построения сущностей: прежние классы с __dict__ против __slots__ и row_factory
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.entities_bench --rows 100000
+'''
+import argparse
+import time
+import tracemalloc
+
+from benchmarks.common import new_db, telegram_user
+from db import DB, REVIEW_COLUMNS
+from entities import INVALID_ID, Author, Story, User
+
+
+class LegacyUser:
+    def __init__(self, effective_user):
+        self.id = effective_user.id
+        self.is_bot = effective_user.is_bot
+        self.username = effective_user.username
+        self.first_name = effective_user.first_name
+        self.last_name = effective_user.last_name
+        self.lang = effective_user.language_code
+
+
+class LegacyReview:
+    def __init__(self, user, text, id_=INVALID_ID, author_name='', story_title='', rank=INVALID_ID):
+        self.user_id = user.id
+        self.text = text
+        self.rank = rank
+        self.author_name = author_name
+        self.author_id = INVALID_ID
+        self.story_id = INVALID_ID
+        self.story_title = story_title
+        self.id = id_
+
+
+def legacy_list_reviews(db: DB, user):
+    '''Как list_reviews() работал раньше: кортежи строк копируются в объекты списковым включением'''
+    rows = db.conn.cursor().execute(
+        f'''
+            SELECT {REVIEW_COLUMNS}
+            FROM review
+            JOIN story ON (review.user_id == story.user_id) AND (review.story_id == story.id)
+            JOIN author ON (review.user_id == author.user_id) AND (story.author_id == author.id)
+            WHERE review.user_id == ?
+            ORDER BY author.name, story.title, review.text
+        ''',
+        (user.id,)
+    ).fetchall()
+    return [
+        LegacyReview(user, text=row[0], id_=row[1], story_title=row[2], author_name=row[3], rank=row[4])
+        for row in rows
+    ]
+
+
+def fill(db: DB, user: User, rows: int):
+    db.add_user_if_new(user)
+    authors = max(1, rows // 100)
+    for i in range(authors):
+        db.add_author(Author(user, name=f'author {i}'))
+    for i in range(authors):
+        story = Story(user, title=f'story {i}')
+        story.author_id = i + 1
+        db.add_story(story)
+    db.conn.executemany(
+        '''INSERT INTO review (user_id, story_id, text, rank) VALUES (?, ?, ?, ?)''',
+        ((user.id, i % authors + 1, f'review text {i}', i % 6) for i in range(rows))
+    )
+    db.conn.commit()
+
+
+def measure(fn, repeat: int):
+    '''Лучшее время из `repeat` запусков и пик памяти, выделенной за один запуск'''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    result = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return best, peak
+
+
+def report(name: str, legacy, current):
+    print(
+        f'{name}: {legacy[0] * 1000:.1f} ms / {legacy[1] / 2**20:.1f} MiB -> '
+        f'{current[0] * 1000:.1f} ms / {current[1] / 2**20:.1f} MiB '
+        f'(x{legacy[0] / current[0]:.2f} time, x{legacy[1] / max(current[1], 1):.2f} memory)'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000, help='number of reviews in the list')
+    parser.add_argument('--updates', type=int, default=100000, help='number of updates for the User benchmark')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    effective_user = telegram_user(1)
+    user = User(effective_user)
+    db = new_db(':memory:')
+    fill(db, user, args.rows)
+    assert len(db.list_reviews(user)) == len(legacy_list_reviews(db, LegacyUser(effective_user))) == args.rows
+
+    report(
+        f'list_reviews({args.rows} rows)',
+        measure(lambda: legacy_list_reviews(db, LegacyUser(effective_user)), args.repeat),
+        measure(lambda: db.list_reviews(user), args.repeat),
+    )
+
+    # Old with_db built a new User on every update, now the cached one is checked and reused
+    cached = User(effective_user)
+    report(
+        f'User for {args.updates} updates',
+        measure(lambda: [LegacyUser(effective_user) for _ in range(args.updates)], args.repeat),
+        measure(lambda: [cached if cached.matches(effective_user) else User(effective_user)
+                         for _ in range(args.updates)], args.repeat),
+    )
+
+
+if __name__ == '__main__':
+    main()
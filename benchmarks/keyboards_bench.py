@@ -0,0 +1,108 @@
+'''Скорость построения inline-клавиатур (см. keyboards/engine.py)
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.keyboards_bench --buttons 10 500 2000
+
+Для каждого размера списка сравниваются:
+
+* reshape - прежняя раскладка кнопок вложенным циклом по индексам;
+* layout - раскладка срезами (keyboards.engine.layout);
+* build - клавиатура списка авторов целиком, с созданием кнопок;
+* memo - та же клавиатура из KeyboardCache, пока версия библиотеки не изменилась.
+
+Отдельно - клавиатуры оценки и подтверждения: построение заново и из static_keyboard.
+'''
+import argparse
+import asyncio
+import time
+import timeit
+
+from benchmarks.common import make_user
+from entities import Author
+from keyboards import KeyboardCache, authors_inline_keyboard, confirm_inline_keyboard, rank_inline_keyboard
+from keyboards.engine import layout
+
+
+def reshape(array1d: list, nrows: int, ncols: int) -> list:
+    '''Раскладка, которой клавиатуры строились до keyboards.engine'''
+    result = []
+    for y in range(nrows):
+        row = []
+        if y*ncols < len(array1d):
+            for x in range(ncols):
+                index = y*ncols + x
+                if index < len(array1d):
+                    row.append(array1d[index])
+            result.append(row)
+        else:
+            break
+    return result
+
+
+def per_call(fn, seconds: float) -> float:
+    '''Микросекунд на вызов `fn()`; число повторов подбирается так, чтобы замер шёл около `seconds`'''
+    timer = timeit.Timer(fn)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * seconds / max(elapsed, 1e-9)))
+    return min(timer.repeat(repeat=3, number=number)) / number * 1e6
+
+
+async def memo_per_call(keyboards: KeyboardCache, key: tuple, build, number: int) -> float:
+    '''Микросекунд на клавиатуру из кэша'''
+    start = time.perf_counter()
+    for _ in range(number):
+        await keyboards.get(1, 0, key, build)
+    return (time.perf_counter() - start) / number * 1e6
+
+
+def bench_lists(sizes: list, cols: int, seconds: float):
+    print(f'{"buttons":>8} {"reshape":>10} {"layout":>10} {"build":>10} {"memo":>10}  (us per keyboard)')
+    keyboards = KeyboardCache(maxsize=16)
+    user = make_user(1)
+    for size in sizes:
+        authors = [Author(user, f'Автор {i}', i) for i in range(size)]
+        buttons = list(range(size))
+        rows = size // cols + int(size % cols > 0)
+
+        async def build():
+            return authors_inline_keyboard(authors, optional_data=(42,), cols=cols)
+
+        key = ('authors', size)
+        asyncio.run(keyboards.get(1, 0, key, build))
+        memo = asyncio.run(memo_per_call(keyboards, key, build, 10000))
+        assert keyboards.cache.misses == len(keyboards.cache)
+        markup = authors_inline_keyboard(authors, optional_data=(42,), cols=cols)
+        assert sum(len(row) for row in markup.inline_keyboard) == size + 1
+        print(
+            f'{size:>8} {per_call(lambda: reshape(buttons, rows, cols), seconds):>10.1f} '
+            f'{per_call(lambda: layout(buttons, cols), seconds):>10.1f} '
+            f'{per_call(lambda: authors_inline_keyboard(authors, optional_data=(42,), cols=cols), seconds):>10.1f} '
+            f'{memo:>10.2f}'
+        )
+
+
+def bench_static(seconds: float):
+    for name, keyboard in (('rank', rank_inline_keyboard), ('confirm', confirm_inline_keyboard)):
+        build = keyboard.__wrapped__
+        print(
+            f'{name:<8} rebuilt {per_call(lambda: build((7, 3)), seconds):.1f} us, '
+            f'memoized {per_call(lambda: keyboard((7, 3)), seconds):.2f} us'
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--buttons', type=int, nargs='+', default=[10, 500, 2000], help='sizes of the lists')
+    parser.add_argument('--cols', type=int, default=2, help='buttons in a row')
+    parser.add_argument('--seconds', type=float, default=0.2, help='time of every measurement')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    bench_lists(args.buttons, args.cols, args.seconds)
+    bench_static(args.seconds)
+    print(f'total {time.perf_counter() - start:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+'''Нагрузочный тест: пользователи ведут дневник через настоящие обработчики бота без обращений к сети
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.load --users 50 --authors 5 --stories 3 --reviews 2 --output load.json
+
+Каждая команда - это весь диалог (команда и все нажатия кнопок до конца). Для каждой команды
+печатаются пропускная способность и перцентили задержки; с --output результаты сохраняются в JSON,
+чтобы сравнивать прогоны на разных коммитах.
+'''
+import argparse
+import asyncio
+from collections import defaultdict
+import itertools
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+
+from telegram import Update
+from telegram.request import BaseRequest, RequestData
+
+from callback_cache import DiaryBot
+from config import Config
+from main import build_application, shutdown
+
+
+_ids = itertools.count(1)
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Bot', 'username': 'diary_bot'}
+
+
+class FakeRequest(BaseRequest):
+    '''Ответы Bot API без сети; для каждого чата запоминаются последние текст и клавиатура'''
+
+    def __init__(self):
+        self.texts = {}
+        self.keyboards = {}
+        self.requests = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(
+        self, url: str, method: str, request_data: RequestData = None, read_timeout=None, write_timeout=None,
+        connect_timeout=None, pool_timeout=None,
+    ):
+        self.requests += 1
+        endpoint = url.rsplit('/', 1)[-1]
+        params = {} if request_data is None else request_data.parameters
+        chat_id = params.get('chat_id')
+        if endpoint == 'getMe':
+            result = BOT_USER
+        elif endpoint in ('sendMessage', 'editMessageText', 'editMessageReplyMarkup'):
+            if 'text' in params:
+                self.texts[chat_id] = params['text']
+            markup = params.get('reply_markup')
+            if isinstance(markup, str):
+                markup = json.loads(markup)
+            self.keyboards[chat_id] = None if markup is None else markup['inline_keyboard']
+            result = {
+                'message_id': params.get('message_id', next(_ids)), 'date': 0,
+                'chat': {'id': chat_id, 'type': 'private'}, 'text': self.texts.get(chat_id, ''),
+            }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class SimulatedUser:
+    '''Пользователь, который отправляет команды и нажимает кнопки по их тексту'''
+
+    def __init__(self, application, request: FakeRequest, user_id: int, latencies: dict, errors: dict):
+        self.application = application
+        self.request = request
+        self.id = user_id
+        self.latencies = latencies
+        self.errors = errors
+        self._from = {'id': user_id, 'is_bot': False, 'first_name': 'User', 'username': f'user{user_id}'}
+        self._chat = {'id': user_id, 'type': 'private'}
+
+    async def send(self, text: str):
+        command_length = len(text.split()[0])
+        update = Update.de_json({'update_id': next(_ids), 'message': {
+            'message_id': next(_ids), 'date': 0, 'chat': self._chat, 'from': self._from, 'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': command_length}],
+        }}, self.application.bot)
+        await self.application.process_update(update)
+
+    async def press(self, text: str):
+        '''Нажимаем кнопку с текстом `text`, листая страницы клавиатуры, пока она не найдётся'''
+        while True:
+            keyboard = self.request.keyboards.get(self.id) or []
+            buttons = {button['text']: button for row in keyboard for button in row}
+            button = buttons.get(text) or buttons.get('»')
+            if button is None:
+                raise LookupError(f'No button {text!r} for user {self.id}')
+            update = Update.de_json({'update_id': next(_ids), 'callback_query': {
+                'id': str(next(_ids)), 'from': self._from, 'chat_instance': str(self.id),
+                'data': button['callback_data'],
+                'message': {
+                    'message_id': next(_ids), 'date': 0, 'chat': self._chat,
+                    'text': self.request.texts.get(self.id, ''), 'reply_markup': {'inline_keyboard': keyboard},
+                },
+            }}, self.application.bot)
+            # The same as the bot does for updates it gets from Telegram
+            self.application.bot.insert_callback_data(update)
+            await self.application.process_update(update)
+            if button['text'] == text:
+                return
+
+    async def command(self, name: str, text: str, *buttons: str):
+        start = time.perf_counter()
+        try:
+            await self.send(text)
+            for button in buttons:
+                await self.press(button)
+        except LookupError:
+            self.errors[name] += 1
+            # Leave the conversation, so that the next command starts from scratch
+            await self.send('/cancel')
+        else:
+            self.latencies[name].append(time.perf_counter() - start)
+
+    async def run(self, authors: int, stories: int, reviews: int, reads: int):
+        await self.command('start', '/start')
+        library = []
+        for a in range(authors):
+            author = f'Автор {a}'
+            await self.command('add_author', f'/add_author {author}', 'Да')
+            for s in range(stories):
+                story = f'Книга {a}.{s}'
+                await self.command('add_story', f'/add_story {story}', author, 'Да')
+                for r in range(reviews):
+                    # Buttons show first 15 characters of a review
+                    review = f'Отзыв {a}.{s}.{r}'
+                    await self.command('add_review', f'/add_review {review}', author, story, str(r % 5 + 1), 'Да')
+                    library.append((author, story, review))
+
+        for _ in range(reads):
+            await self.command('list_authors', '/list_authors')
+            await self.command('list_stories', '/list_stories')
+            await self.command('list_reviews', '/list_reviews')
+
+        if library:
+            author, story, review = library[-1]
+            await self.command('remove_review', '/remove_review', author, story, review, 'Да')
+            await self.command('remove_story', '/remove_story', author, story, 'Да')
+            await self.command('remove_author', '/remove_author', author, 'Да')
+
+
+def percentile(values: list, p: float) -> float:
+    '''Перцентиль методом ближайшего ранга; `values` должны быть отсортированы'''
+    return values[max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))]
+
+
+def summarize(latencies: dict, errors: dict, elapsed: float) -> dict:
+    commands = {}
+    for name in sorted(set(latencies) | set(errors)):
+        values = sorted(latencies[name])
+        summary = {'count': len(values), 'errors': errors[name], 'throughput': len(values) / elapsed}
+        if values:
+            summary.update({
+                f'p{p}_ms': percentile(values, p) * 1000 for p in (50, 95, 99)
+            })
+        commands[name] = summary
+    total = sum(len(values) for values in latencies.values())
+    return {'elapsed_s': elapsed, 'commands_total': total, 'throughput': total / elapsed, 'commands': commands}
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_load(args) -> dict:
+    Config.db().prepare()
+    request = FakeRequest()
+    bot = DiaryBot(
+        '123456:benchmark', arbitrary_callback_data=Config.callback_data_cache_size(),
+        request=request, get_updates_request=FakeRequest(),
+    )
+    application = build_application(bot)
+    await application.initialize()
+
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    users = [SimulatedUser(application, request, 1000 + i, latencies, errors) for i in range(args.users)]
+    start = time.perf_counter()
+    await asyncio.gather(*(user.run(args.authors, args.stories, args.reviews, args.reads) for user in users))
+    elapsed = time.perf_counter() - start
+
+    await application.shutdown()
+    await shutdown(application)
+
+    result = summarize(latencies, errors, elapsed)
+    result['requests_to_bot_api'] = request.requests
+    return result
+
+
+def print_report(result: dict):
+    print(f"{result['commands_total']} commands in {result['elapsed_s']:.2f} s: {result['throughput']:.1f} commands/s")
+    print(f"{'command':<15} {'count':>7} {'errors':>7} {'cmd/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, summary in result['commands'].items():
+        print(
+            f"{name:<15} {summary['count']:>7} {summary['errors']:>7} {summary['throughput']:>9.1f} "
+            f"{summary.get('p50_ms', 0):>9.2f} {summary.get('p95_ms', 0):>9.2f} {summary.get('p99_ms', 0):>9.2f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20, help='number of concurrent users')
+    parser.add_argument('--authors', type=int, default=5, help='authors in the library of every user')
+    parser.add_argument('--stories', type=int, default=3, help='stories of every author')
+    parser.add_argument('--reviews', type=int, default=2, help='reviews of every story')
+    parser.add_argument('--reads', type=int, default=5, help='how many times every user lists the library')
+    parser.add_argument('--output', help='save results to this JSON file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['BOT_DB'] = os.path.join(tmp, 'load.sqlite')
+        os.environ.setdefault('BOT_TOKEN', '123456:benchmark')
+        result = asyncio.run(run_load(args))
+
+    result['revision'] = git_revision()
+    result['params'] = vars(args)
+    print_report(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+'''Задержка чтения во время записи: чтения в потоке записи против пула читателей (см. async_db.ReaderPool)
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.reads_bench --readers 0 4 --writers 10 --users 50
+
+`--writers` пользователей без остановки импортируют по `--rows` отзывов за раз (тяжёлые записи с fsync),
+а `--users` пользователей листают первые страницы своих авторов и отзывов и получают весь список
+отзывов сообщениями, как в /list_reviews.
+Для каждого размера пула (0 - чтения в потоке записи, как раньше) печатаются число чтений в секунду
+и задержки чтений в миллисекундах.
+'''
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+from async_db import AsyncDB
+from benchmarks.common import make_user, seed
+from db import DB
+from entities import User
+from handlers.review import reviews_messages
+
+
+async def run(db: AsyncDB, args, readers: list, writers: list) -> list:
+    latencies = []
+    stop = asyncio.Event()
+
+    async def write(user: User):
+        i = 0
+        while not stop.is_set():
+            await db.import_reviews(user, [
+                (f'Writer {i}', f'Story {i} {j}', f'review {j}', j % 5 + 1) for j in range(args.rows)
+            ])
+            i += 1
+
+    async def read(user: User):
+        for _ in range(args.reads):
+            start = time.perf_counter()
+            await db.list_authors_page(user)
+            latencies.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            await db.list_story_reviews_page(user, 1)
+            latencies.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            async for _ in db.stream(reviews_messages, user):
+                pass
+            latencies.append(time.perf_counter() - start)
+
+    writing = [asyncio.create_task(write(user)) for user in writers]
+    await asyncio.gather(*(read(user) for user in readers))
+    stop.set()
+    await asyncio.gather(*writing)
+    return latencies
+
+
+def measure(sqlite_fn: str, args, pool_size: int) -> tuple:
+    db = AsyncDB(DB(sqlite_fn), readers=pool_size)
+    readers = [make_user(i) for i in range(args.users)]
+    writers = [make_user(args.users + i) for i in range(args.writers)]
+    start = time.perf_counter()
+    latencies = asyncio.run(run(db, args, readers, writers))
+    elapsed = time.perf_counter() - start
+    asyncio.run(db.close())
+    db.db.close()
+    return len(latencies) / elapsed, sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--readers', type=int, nargs='+', default=[0, 4], help='sizes of the reader pool')
+    parser.add_argument('--users', type=int, default=50, help='users that read')
+    parser.add_argument('--writers', type=int, default=10, help='users that write at the same time')
+    parser.add_argument('--rows', type=int, default=200, help='reviews in every write')
+    parser.add_argument('--reads', type=int, default=20, help='rounds of reads of every user')
+    args = parser.parse_args()
+
+    print(f'{"readers":>8} {"reads/s":>9} {"p50":>8} {"p95":>8} {"p99":>8}  (ms)')
+    with tempfile.TemporaryDirectory() as tmp:
+        sqlite_fn = os.path.join(tmp, 'reads.sqlite')
+        seed(sqlite_fn, range(args.users), lambda user_id: [
+            (f'Author {i % 10}', f'Story {i}', f'review {i}', i % 5 + 1) for i in range(50)
+        ]).close()
+        for pool_size in args.readers:
+            rate, latencies = measure(sqlite_fn, args, pool_size)
+            p50, p95, p99 = (statistics.quantiles(latencies, n=100)[i] * 1000 for i in (49, 94, 98))
+            print(f'{pool_size:>8} {rate:>9.0f} {p50:>8.2f} {p95:>8.2f} {p99:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
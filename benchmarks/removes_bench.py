@@ -0,0 +1,136 @@
+'''Удаление автора со всеми записями: каскад триггеров против пометки и пакетной очистки
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.removes_bench --stories 200 1000 --reviews 5
+
+У одного пользователя заводится автор с `--stories` произведениями по `--reviews` отзывов, у остальных
+`--users` пользователей - небольшие библиотеки. Время в миллисекундах:
+
+* cascade - прежнее удаление: DELETE автора, а триггеры построчно удаляют его произведения и их отзывы,
+  на каждый отзыв - пересчёт статистики, FTS и триграмм;
+* remove - DB.remove_author(): пометка автора, его произведений и отзывов и пересчёт статистики одним запросом;
+* undo - DB.undo_remove() того же автора;
+* purge - DB.purge_removed() до конца, пачками по `--limit` (так их делает фоновая очистка бота);
+  max batch - самая долгая пачка, столько ждут запросы пользователей.
+'''
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks.common import make_user, seed
+from db import DB
+
+
+# Cascade of deletes before migration 8
+LEGACY_TRIGGERS = '''
+DROP TRIGGER review_stats_delete;
+CREATE TRIGGER review_stats_delete
+AFTER DELETE ON review
+WHEN OLD.story_id IN (SELECT story_id FROM story_stats)
+BEGIN
+    UPDATE rank_stats SET reviews = reviews - 1 WHERE user_id == OLD.user_id AND rank == OLD.rank;
+    DELETE FROM rank_stats WHERE user_id == OLD.user_id AND rank == OLD.rank AND reviews <= 0;
+
+    UPDATE author_stats SET reviews = reviews - 1, rank_sum = rank_sum - OLD.rank
+    WHERE author_id == (SELECT author_id FROM story_stats WHERE story_id == OLD.story_id);
+    DELETE FROM author_stats
+    WHERE author_id == (SELECT author_id FROM story_stats WHERE story_id == OLD.story_id) AND reviews <= 0;
+
+    UPDATE story_stats SET reviews = reviews - 1, rank_sum = rank_sum - OLD.rank
+    WHERE story_id == OLD.story_id;
+    DELETE FROM story_stats WHERE story_id == OLD.story_id AND reviews <= 0;
+END;
+CREATE TRIGGER on_author_delete
+AFTER DELETE ON author
+FOR EACH ROW
+BEGIN
+    DELETE FROM story WHERE story.user_id == OLD.user_id AND story.author_id == OLD.id;
+END;
+CREATE TRIGGER on_story_delete
+AFTER DELETE ON story
+FOR EACH ROW
+BEGIN
+    DELETE FROM review WHERE review.user_id == OLD.user_id AND review.story_id == OLD.id;
+END;
+'''
+
+
+def fill(sqlite_fn: str, users: int, stories: int, reviews: int) -> DB:
+    def rows(user_id: int) -> list:
+        if user_id == 0:
+            return [
+                ('Prolific Author', f'Story {i}', f'review {j} of story {i}', j % 5 + 1)
+                for i in range(stories) for j in range(reviews)
+            ]
+        return [(f'Author {i}', f'Story {i}', f'review of story {i}', i % 5 + 1) for i in range(20)]
+
+    return seed(sqlite_fn, range(users + 1), rows)
+
+
+def author_id(db: DB) -> int:
+    return db.conn.execute('''SELECT id FROM author WHERE user_id == 0 AND name == 'Prolific Author' ''').fetchone()[0]
+
+
+def measure_cascade(sqlite_fn: str, args, stories: int) -> float:
+    db = fill(sqlite_fn, args.users, stories, args.reviews)
+    db.conn.executescript(LEGACY_TRIGGERS)
+    target = author_id(db)
+    start = time.perf_counter()
+    db.conn.execute('''DELETE FROM author WHERE user_id == 0 AND id == ?''', (target,))
+    db.conn.commit()
+    elapsed = time.perf_counter() - start
+    assert not any(db.check_stats().values())
+    db.close()
+    return elapsed
+
+
+def measure_soft(sqlite_fn: str, args, stories: int) -> tuple:
+    db = fill(sqlite_fn, args.users, stories, args.reviews)
+    user = make_user(0)
+    target = author_id(db)
+
+    start = time.perf_counter()
+    db.remove_author(user, target)
+    remove = time.perf_counter() - start
+
+    start = time.perf_counter()
+    assert db.undo_remove(user, 0).id == target
+    undo = time.perf_counter() - start
+
+    db.remove_author(user, target)
+    batches = []
+    while True:
+        start = time.perf_counter()
+        purged = db.purge_removed(time.time() + 1, args.limit)
+        batches.append(time.perf_counter() - start)
+        if not purged:
+            break
+    assert not any(db.check_stats().values())
+    assert db.conn.execute('''SELECT COUNT(*) FROM review WHERE user_id == 0''').fetchone()[0] == 0
+    db.close()
+    return remove, undo, sum(batches), max(batches)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stories', type=int, nargs='+', default=[200, 1000], help='stories of the removed author')
+    parser.add_argument('--reviews', type=int, default=5, help='reviews of every story')
+    parser.add_argument('--users', type=int, default=100, help='other users with small libraries')
+    parser.add_argument('--limit', type=int, default=100, help='rows of every kind purged in one transaction')
+    args = parser.parse_args()
+
+    print(f'{"stories":>8} {"cascade":>9} {"remove":>9} {"undo":>9} {"purge":>9} {"max batch":>10}  (ms)')
+    for stories in args.stories:
+        with tempfile.TemporaryDirectory() as tmp:
+            cascade = measure_cascade(os.path.join(tmp, 'cascade.sqlite'), args, stories)
+            remove, undo, purge, batch = measure_soft(os.path.join(tmp, 'soft.sqlite'), args, stories)
+        print(
+            f'{stories:>8} {cascade * 1000:>9.1f} {remove * 1000:>9.1f} {undo * 1000:>9.1f} '
+            f'{purge * 1000:>9.1f} {batch * 1000:>10.1f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+'''Проверка планировщика исходящих запросов (send_scheduler.py) на заглушке Bot API с лимитами Telegram
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.send_bench --latency 50 --chats 5
+
+Заглушка отвечает с задержкой `--latency` мс и, как Telegram, отвечает 429, если чат получает больше
+`--chat-limit` запросов за секунду или бот - больше `--limit`. Каждый сценарий прогоняется без
+планировщика и с ним:
+
+* press - нажатия кнопок: answerCallbackQuery, затем editMessageText, как в обработчиках;
+* burst - каждый чат сразу получает `--burst` сообщений.
+'''
+import argparse
+import asyncio
+from collections import defaultdict, deque
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+from telegram.request import HTTPXRequest
+
+from benchmarks.webhook_sender import FakeBotAPI
+from send_scheduler import SendScheduler
+
+
+class FloodControlledBotAPI(FakeBotAPI):
+    '''Заглушка Bot API, которая отвечает 429 при превышении лимитов и считает запросы'''
+
+    def __init__(self, latency: float, limit: int, chat_limit: int):
+        super().__init__()
+        self.latency = latency
+        self.limit = limit
+        self.chat_limit = chat_limit
+        self.requests = defaultdict(int)
+        self.flooded = 0
+        self._times = deque()
+        self._chat_times = defaultdict(deque)
+
+    @staticmethod
+    def _count(times: deque, now: float) -> int:
+        while times and times[0] <= now - 1:
+            times.popleft()
+        return len(times)
+
+    async def respond(self, method: str, params: dict) -> tuple:
+        await asyncio.sleep(self.latency)
+        now = time.monotonic()
+        chat_times = self._chat_times[params['chat_id']] if 'chat_id' in params else None
+        if self._count(self._times, now) >= self.limit or (
+            chat_times is not None and self._count(chat_times, now) >= self.chat_limit
+        ):
+            self.flooded += 1
+            return 429, {
+                'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 1},
+            }
+        self._times.append(now)
+        if chat_times is not None:
+            chat_times.append(now)
+        self.requests[method] += 1
+        return await super().respond(method, params)
+
+
+async def press(bot: ExtBot, chat_id: int, presses: int):
+    for i in range(presses):
+        await bot.answer_callback_query(f'{chat_id}-{i}')
+        await bot.edit_message_text(f'page {i}', chat_id=chat_id, message_id=1)
+
+
+async def burst(bot: ExtBot, chat_id: int, messages: int):
+    await asyncio.gather(*(bot.send_message(chat_id, f'message {i}') for i in range(messages)))
+
+
+SCENARIOS = {'press': press, 'burst': burst}
+
+
+async def run_scenario(args, name: str, scheduler: bool) -> str:
+    api = FloodControlledBotAPI(args.latency / 1000, args.limit, args.chat_limit)
+    server = await asyncio.start_server(api.serve, '127.0.0.1', args.api_port)
+    bot = ExtBot(
+        '123456:benchmark', base_url=f'http://127.0.0.1:{args.api_port}/bot',
+        request=HTTPXRequest(connection_pool_size=256),
+        # A bucket lets through its burst and then its rate within a second, together they stay within the limits
+        rate_limiter=SendScheduler(
+            args.limit / 2, args.chat_limit / 2, args.chat_limit // 2
+        ) if scheduler else None,
+    )
+    count = args.presses if name == 'press' else args.burst
+    errors = 0
+    async with bot:
+        start = time.perf_counter()
+        results = await asyncio.gather(*(
+            SCENARIOS[name](bot, chat_id, count) for chat_id in range(1, args.chats + 1)
+        ), return_exceptions=True)
+        elapsed = time.perf_counter() - start
+    server.close()
+    for result in results:
+        if isinstance(result, RetryAfter):
+            errors += 1
+        elif isinstance(result, Exception):
+            raise result
+
+    requests = ', '.join(f'{method} {count}' for method, count in sorted(api.requests.items()) if method != 'getMe')
+    per_press = f', {elapsed / count * 1000:.0f} ms per press' if name == 'press' else ''
+    return (
+        f'{name:<7} {"scheduler" if scheduler else "direct":<9} {elapsed:6.2f} s{per_press}; sent: {requests}; '
+        f'429: {api.flooded}, failed chats: {errors}'
+    )
+
+
+async def run(args):
+    for name in args.scenarios:
+        for scheduler in (False, True):
+            print(await run_scenario(args, name, scheduler))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--chats', type=int, default=5, help='number of chats')
+    parser.add_argument('--presses', type=int, default=5, help='button presses in every chat')
+    parser.add_argument('--burst', type=int, default=10, help='messages sent at once to every chat')
+    parser.add_argument('--latency', type=float, default=50, help='latency of the fake Bot API, ms')
+    parser.add_argument('--limit', type=int, default=30, help='requests per second the fake Bot API allows')
+    parser.add_argument('--chat-limit', type=int, default=5, help='requests per second to one chat it allows')
+    parser.add_argument('--api-port', type=int, default=8082, help='port of the fake Bot API')
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
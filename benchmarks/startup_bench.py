@@ -0,0 +1,85 @@
+'''Время холодного старта бота
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.startup_bench --runs 5
+
+Каждый запуск - новый процесс Python, время - медиана по запускам, в миллисекундах:
+
+* import - импорт main и всех обработчиков без BOT_DB (так модули импортируют инструменты и тесты);
+* first start - импорт, создание схемы новой БД и сборка приложения со всеми обработчиками;
+* restart - то же с уже созданной БД: схема не меняется (см. migrations.migrate()).
+
+В столбце process - всё время процесса, вместе с запуском интерпретатора.
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+IMPORT = '''
+import json, time
+start = time.perf_counter()
+import main, handlers
+from config import Config
+assert Config._db is None
+print(json.dumps({'import': time.perf_counter() - start}))
+'''
+
+START = '''
+import json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+from config import Config
+Config.db().prepare()
+prepared = time.perf_counter()
+main.build_application(main.build_bot())
+built = time.perf_counter()
+print(json.dumps({'import': imported - start, 'prepare': prepared - imported, 'build': built - prepared}))
+'''
+
+STAGES = ('import', 'prepare', 'build')
+
+
+def run_child(code: str, env: dict) -> dict:
+    '''Времена этапов в дочернем процессе и всё время процесса'''
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True).stdout
+    elapsed = time.perf_counter() - start
+    return dict(json.loads(output.splitlines()[-1]), process=elapsed)
+
+
+def report(name: str, runs: list):
+    columns = ' '.join(
+        f'{stage} {statistics.median(run[stage] for run in runs) * 1000:7.1f}' for stage in STAGES + ('process',)
+        if stage in runs[0]
+    )
+    print(f'{name:<12} {columns}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='processes started for every scenario')
+    args = parser.parse_args()
+
+    env = {key: value for key, value in os.environ.items() if not key.startswith('BOT_')}
+    env['PYTHONPATH'] = os.getcwd()
+    report('import', [run_child(IMPORT, env) for _ in range(args.runs)])
+    with tempfile.TemporaryDirectory() as tmp:
+        env.update(BOT_TOKEN='123456:benchmark')
+        first = []
+        for i in range(args.runs):
+            env['BOT_DB'] = os.path.join(tmp, f'startup{i}.sqlite')
+            first.append(run_child(START, env))
+        report('first start', first)
+        report('restart', [run_child(START, env) for _ in range(args.runs)])
+
+
+if __name__ == '__main__':
+    main()
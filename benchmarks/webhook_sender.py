@@ -0,0 +1,161 @@
+'''Локальная проверка режима webhook: заглушка Bot API и отправитель обновлений
+
+Сначала запускаем заглушку и отправителя, затем бота, направив его на заглушку:
+
+    python -m benchmarks.webhook_sender --users 50 --commands 20
+    BOT_MODE=webhook BOT_WEBHOOK_URL=http://127.0.0.1:8443/ BOT_API_BASE_URL=http://127.0.0.1:8081/bot \\
+        python main.py
+
+Когда бот вызовет setWebhook, каждый пользователь по порядку (не дожидаясь ответов) отправит
+пары `/add_author`, `/cancel`. Затем проверяется, что ответы каждому пользователю пришли в том же порядке,
+то есть шаги диалога одного пользователя не перемешались, и печатается пропускная способность.
+'''
+import argparse
+import asyncio
+from collections import defaultdict
+from http import HTTPStatus
+import itertools
+import json
+import time
+from urllib.parse import parse_qsl
+
+import httpx
+
+
+class FakeBotAPI:
+    '''HTTP-сервер, отвечающий на запросы бота к Bot API и запоминающий отправленные сообщения'''
+
+    def __init__(self):
+        self.messages = defaultdict(list)
+        self.webhook_set = asyncio.Event()
+        self.message_sent = asyncio.Event()
+        self._ids = itertools.count(1)
+
+    def answer(self, method: str, params: dict):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Bot', 'username': 'diary_bot'}
+        if method == 'setWebhook':
+            self.webhook_set.set()
+        if method == 'sendMessage':
+            chat_id = int(params['chat_id'])
+            self.messages[chat_id].append(params['text'])
+            self.message_sent.set()
+            return {
+                'message_id': next(self._ids), 'date': 0,
+                'chat': {'id': chat_id, 'type': 'private'}, 'text': params['text'],
+            }
+        return True
+
+    async def respond(self, method: str, params: dict) -> tuple:
+        '''HTTP-статус и тело ответа на запрос'''
+        return 200, {'ok': True, 'result': self.answer(method, params)}
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # The bot keeps connections alive, so several requests come through one connection
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, _, value = line.decode().partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                if headers.get('content-type', '').startswith('application/json'):
+                    params = json.loads(body or b'{}')
+                else:
+                    params = dict(parse_qsl(body.decode()))
+                method = request_line.split()[1].decode().rsplit('/', 1)[-1]
+                status, response = await self.respond(method, params)
+                payload = json.dumps(response).encode()
+                writer.write(
+                    f'HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: application/json\r\n'.encode()
+                    + f'Content-Length: {len(payload)}\r\n\r\n'.encode() + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # The connection is still open when the sender exits
+            pass
+        finally:
+            writer.close()
+
+
+def command_update(update_id: int, user_id: int, text: str) -> dict:
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'User', 'username': f'user{user_id}'}
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'},
+        'from': user, 'text': text,
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}],
+    }}
+
+
+async def send_user_updates(client: httpx.AsyncClient, args, ids, user_id: int):
+    headers = {} if args.secret is None else {'X-Telegram-Bot-Api-Secret-Token': args.secret}
+    for i in range(args.commands):
+        for text in (f'/add_author A{user_id}_{i}', '/cancel'):
+            update = command_update(next(ids), user_id, text)
+            response = await client.post(args.webhook, json=update, headers=headers)
+            response.raise_for_status()
+
+
+def expected_messages(user_id: int, commands: int) -> list:
+    messages = []
+    for i in range(commands):
+        messages.append(f'Добавить автора `A{user_id}_{i}`?')
+        messages.append('Ну и ладно, в другой раз тогда')
+    return messages
+
+
+async def run(args):
+    api = FakeBotAPI()
+    server = await asyncio.start_server(api.serve, '127.0.0.1', args.api_port)
+    print(f'Fake Bot API on http://127.0.0.1:{args.api_port}/bot, waiting for the bot to set the webhook')
+    await api.webhook_set.wait()
+
+    users = range(100000, 100000 + args.users)
+    expected = args.users * args.commands * 2
+    ids = itertools.count(1)
+    start = time.perf_counter()
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=args.connections)) as client:
+        await asyncio.gather(*(send_user_updates(client, args, ids, user_id) for user_id in users))
+    sent = time.perf_counter() - start
+
+    # Wait until the replies stop coming
+    while sum(len(api.messages[user_id]) for user_id in users) < expected:
+        api.message_sent.clear()
+        try:
+            await asyncio.wait_for(api.message_sent.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            break
+    elapsed = time.perf_counter() - start
+    server.close()
+
+    received = sum(len(api.messages[user_id]) for user_id in users)
+    reordered = [user_id for user_id in users if api.messages[user_id] != expected_messages(user_id, args.commands)]
+    print(f'{expected} updates posted in {sent:.2f} s, {received} replies in {elapsed:.2f} s '
+          f'({received / elapsed:.0f} replies/s)')
+    if reordered:
+        print(f'Replies are missing or out of order for {len(reordered)} users, e.g. {reordered[:5]}')
+        return 1
+    print('Replies of every user are in order')
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--commands', type=int, default=20, help='/add_author + /cancel pairs per user')
+    parser.add_argument('--webhook', default='http://127.0.0.1:8443/', help='BOT_WEBHOOK_URL of the bot')
+    parser.add_argument('--secret', help='BOT_WEBHOOK_SECRET of the bot')
+    parser.add_argument('--api-port', type=int, default=8081, help='port of the fake Bot API')
+    parser.add_argument('--connections', type=int, default=20, help='concurrent connections to the webhook')
+    parser.add_argument('--timeout', type=float, default=5, help='seconds to wait for a missing reply')
+    args = parser.parse_args()
+    raise SystemExit(asyncio.run(run(args)))
+
+
+if __name__ == '__main__':
+    main()
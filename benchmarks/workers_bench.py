@@ -0,0 +1,103 @@
+'''Пропускная способность режима с несколькими процессами-обработчиками (см. workers.py)
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.workers_bench --workers 1 2 4 --users 200 --commands 20
+
+У каждого пользователя заранее заполнен дневник, и он присылает команды, которые только читают его
+и строят списки с клавиатурами, то есть нагружают процессор, а не запись в БД. Обновления готовятся
+заранее и раздаются через workers.Dispatcher обработчикам с Bot API без сети (как в benchmarks.load);
+время - от первого обновления до того, как все обработчики ответили на всё и остановились.
+'''
+import argparse
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+
+from benchmarks.common import seed
+from benchmarks.load import FakeRequest
+from callback_cache import DiaryBot
+from config import Config
+from main import build_application
+from workers import Dispatcher, serve
+
+
+COMMANDS = ('/list_authors', '/list_stories', '/list_reviews', '/stats')
+
+
+def bench_worker(index: int, connection):
+    '''Процесс-обработчик с Bot API без сети; после остановки отправляет число запросов к Bot API'''
+    logging.basicConfig(level=logging.WARNING)
+    request = FakeRequest()
+    bot = DiaryBot(
+        '123456:benchmark', arbitrary_callback_data=Config.callback_data_cache_size(),
+        request=request, get_updates_request=FakeRequest(),
+    )
+    asyncio.run(serve(build_application(bot, worker=index), connection))
+    connection.send(request.requests)
+
+
+def fill(sqlite_fn: str, users: int, authors: int, stories: int, reviews: int):
+    seed(sqlite_fn, range(1000, 1000 + users), lambda user_id: [
+        (f'Автор {a}', f'Книга {a}.{s}', f'Отзыв {a}.{s}.{r}', r % 5 + 1)
+        for a in range(authors) for s in range(stories) for r in range(reviews)
+    ]).close()
+
+
+def updates(users: int, commands: int) -> list:
+    '''(id пользователя, JSON обновления) в порядке отправки: пользователи присылают команды по очереди'''
+    result = []
+    update_id = 0
+    for i in range(commands):
+        text = COMMANDS[i % len(COMMANDS)]
+        for user_id in range(1000, 1000 + users):
+            update_id += 1
+            user = {'id': user_id, 'is_bot': False, 'first_name': 'User', 'username': f'user{user_id}'}
+            result.append((user_id, json.dumps({'update_id': update_id, 'message': {
+                'message_id': update_id, 'date': 0, 'chat': {'id': user_id, 'type': 'private'}, 'from': user,
+                'text': text, 'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}],
+            }}).encode()))
+    return result
+
+
+def measure(workers: int, payloads: list) -> tuple:
+    '''Обновлений в секунду и число ответов бота'''
+    dispatcher = Dispatcher(workers, target=bench_worker)
+    dispatcher.wait_ready()
+    start = time.perf_counter()
+    for user_id, data in payloads:
+        dispatcher.send(dispatcher.ring.node(user_id), data)
+    dispatcher.close()
+    elapsed = time.perf_counter() - start
+    replies = sum(connection.recv() for connection in dispatcher.connections)
+    return len(payloads) / elapsed, replies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='numbers of worker processes')
+    parser.add_argument('--users', type=int, default=200, help='number of users')
+    parser.add_argument('--commands', type=int, default=20, help='commands sent by every user')
+    parser.add_argument('--authors', type=int, default=10, help='authors in the library of every user')
+    parser.add_argument('--stories', type=int, default=3, help='stories of every author')
+    parser.add_argument('--reviews', type=int, default=1, help='reviews of every story')
+    args = parser.parse_args()
+
+    print(f'{os.cpu_count()} CPUs')
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['BOT_DB'] = os.path.join(tmp, 'workers.sqlite')
+        os.environ.setdefault('BOT_TOKEN', '123456:benchmark')
+        fill(os.environ['BOT_DB'], args.users, args.authors, args.stories, args.reviews)
+        payloads = updates(args.users, args.commands)
+        base = None
+        for workers in args.workers:
+            rate, replies = measure(workers, payloads)
+            base = base or rate
+            print(f'{workers} workers: {rate:.0f} updates/s (x{rate / base:.2f}), {replies} Bot API requests')
+
+
+if __name__ == '__main__':
+    main()
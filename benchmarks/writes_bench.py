@@ -0,0 +1,65 @@
+'''Пропускная способность записи: по транзакции на изменение против групповой фиксации
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.writes_bench --users 1 10 100 --writes 20
+    python -m benchmarks.writes_bench --users 100 --shards 1 2 4  # масштабирование по шардам
+'''
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from async_db import AsyncDB
+from benchmarks.common import make_user, new_db
+from entities import Author, User
+
+
+async def run_users(db: AsyncDB, users: int, writes: int) -> float:
+    async def user_session(user: User):
+        await db.add_user_if_new(user)
+        for i in range(writes):
+            await db.add_author(Author(user, name=f'author {i}'))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        user_session(make_user(i)) for i in range(users)
+    ))
+    elapsed = time.perf_counter() - start
+    await db.close()
+    return users * (writes + 1) / elapsed
+
+
+def measure(users: int, writes: int, batch_size: int, shards: int = 1) -> float:
+    '''Записей в секунду на свежей БД в файле (в памяти fsync не происходит)'''
+    with tempfile.TemporaryDirectory() as tmp:
+        db = new_db(os.path.join(tmp, 'bench.sqlite'), shards)
+        return asyncio.run(run_users(AsyncDB(db, batch_size=batch_size), users, writes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 10, 100], help='numbers of concurrent users')
+    parser.add_argument('--writes', type=int, default=20, help='writes per user')
+    parser.add_argument('--shards', type=int, nargs='+', help='compare numbers of shards instead of batching')
+    args = parser.parse_args()
+
+    if args.shards:
+        for users in args.users:
+            base = None
+            for shards in args.shards:
+                rate = measure(users, args.writes, batch_size=256, shards=shards)
+                base = base or rate
+                print(f'{users} users, {shards} shards: {rate:.0f} writes/s (x{rate / base:.2f})')
+        return
+
+    for users in args.users:
+        # batch_size=1 commits every write separately, as before the write queue
+        single = measure(users, args.writes, batch_size=1)
+        grouped = measure(users, args.writes, batch_size=256)
+        print(f'{users} users: {single:.0f} -> {grouped:.0f} writes/s (x{grouped / single:.2f})')
+
+
+if __name__ == '__main__':
+    main()
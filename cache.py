@@ -0,0 +1,256 @@
+from collections import OrderedDict, defaultdict
+
+from async_db import AsyncDB
+from db import DB
+from entities import INVALID_ID, Author, Review, Story, User
+from metrics import CACHES
+
+
+_MISSING = object()
+
+
+class LRUCache:
+    '''Ограниченный по размеру кэш с вытеснением давно не использованных записей и счётчиками обращений'''
+
+    def __init__(self, maxsize: int, maxweight: int = 0, on_evict=None):
+        self.maxsize = maxsize
+        # Total weight of all values, 0 means unbounded
+        self.maxweight = maxweight
+        self.weight = 0
+        self._on_evict = on_evict
+        self._data = OrderedDict()
+        self._weights = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        value = self._data.get(key, _MISSING)
+        if value is _MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value, weight: int = 1):
+        self.pop(key)
+        self._data[key] = value
+        self._weights[key] = weight
+        self.weight += weight
+        while len(self._data) > self.maxsize or (self.maxweight and self.weight > self.maxweight):
+            evicted_key, _ = self._data.popitem(last=False)
+            self.weight -= self._weights.pop(evicted_key)
+            self.evictions += 1
+            if self._on_evict is not None:
+                self._on_evict(evicted_key)
+
+    def pop(self, key, default=None):
+        value = self._data.pop(key, _MISSING)
+        if value is _MISSING:
+            return default
+        self.weight -= self._weights.pop(key)
+        return value
+
+    def clear(self):
+        self._data.clear()
+        self._weights.clear()
+        self.weight = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'weight': self.weight,
+            'maxweight': self.maxweight,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+AUTHOR = 'author'
+STORY = 'story'
+REVIEW = 'review'
+AUTHORS = 'authors'
+STORIES = 'stories'
+REVIEWS = 'reviews'
+STORY_REVIEWS = 'story_reviews'
+
+
+class CachedDB(AsyncDB):
+    '''AsyncDB с кэшированием авторов, произведений и отзывов пользователя и их списков
+
+    Ключ записи - (user_id, kind, scope, page), где scope - id автора, произведения или отзыва,
+    а page - параметры страницы (None для полного списка или отдельной записи).
+    Методы, изменяющие данные, сбрасывают все записи, которые могли измениться
+    (в том числе из-за каскадного удаления триггерами).
+    '''
+
+    def __init__(self, db, maxsize: int, maxrows: int, **kwargs):
+        super().__init__(db, **kwargs)
+        # Weight of a cached list is the number of its rows
+        self.cache = LRUCache(maxsize, maxweight=maxrows, on_evict=self._forget)
+        CACHES.register('lists', self.stats)
+        self._user_keys = defaultdict(set)
+        # Version of a user's data is the number of the last write to it, so a read that raced with a write
+        # is not cached. Only recent writers are remembered, the others get the last number given out
+        # before their entry was evicted: it is not less than their own, so versions never go back.
+        self._last_write = 0
+        self._forgotten = 0
+        self._versions = LRUCache(maxsize, on_evict=self._forget_version)
+
+    def version(self, user_id: int) -> int:
+        return self._versions.get(user_id, self._forgotten)
+
+    def _forget_version(self, user_id: int):
+        self._forgotten = self._last_write
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+    def _forget(self, key):
+        user_keys = self._user_keys.get(key[0])
+        if user_keys is not None:
+            user_keys.discard(key)
+            if not user_keys:
+                del self._user_keys[key[0]]
+
+    def _invalidate(self, user_id: int, kind: str, scopes=None):
+        '''Сбрасываем записи вида `kind`; если заданы `scopes`, то только для них'''
+        self._last_write += 1
+        self._versions.put(user_id, self._last_write)
+        for key in list(self._user_keys.get(user_id, ())):
+            if key[1] == kind and (scopes is None or key[2] in scopes):
+                self.cache.pop(key)
+                self._forget(key)
+
+    async def _read(self, key, fn, *args):
+        value = self.cache.get(key)
+        if value is None:
+            version = self.version(key[0])
+            value = await self.read(fn, *args)
+            # Missing entities are not cached
+            if value is not None and version == self.version(key[0]):
+                self.cache.put(key, value, weight=len(value) + 1 if isinstance(value, list) else 1)
+                self._user_keys[key[0]].add(key)
+        # Lists are copied, so that callers can not change the cached ones
+        return list(value) if isinstance(value, list) else value
+
+    async def get_author(self, user: User, author_id: int):
+        return await self._read((user.id, AUTHOR, author_id, None), DB.get_author, user, author_id)
+
+    async def get_story(self, user: User, story_id: int):
+        return await self._read((user.id, STORY, story_id, None), DB.get_story, user, story_id)
+
+    async def get_review(self, user: User, review_id: int):
+        return await self._read((user.id, REVIEW, review_id, None), DB.get_review, user, review_id)
+
+    async def list_authors(self, user: User):
+        return await self._read((user.id, AUTHORS, None, None), DB.list_authors, user)
+
+    async def list_stories(self, user: User, author_id: int = INVALID_ID):
+        return await self._read((user.id, STORIES, author_id, None), DB.list_stories, user, author_id)
+
+    async def list_reviews(self, user: User, author_id: int = INVALID_ID):
+        return await self._read((user.id, REVIEWS, author_id, None), DB.list_reviews, user, author_id)
+
+    async def list_story_reviews(self, user: User, story_id: int):
+        return await self._read((user.id, STORY_REVIEWS, story_id, None), DB.list_story_reviews, user, story_id)
+
+    async def list_authors_page(self, user: User, cursor=None, limit: int = 10, backward: bool = False):
+        return await self._read(
+            (user.id, AUTHORS, None, (cursor, limit, backward)),
+            DB.list_authors_page, user, cursor, limit, backward
+        )
+
+    async def list_stories_page(
+        self, user: User, author_id: int, cursor=None, limit: int = 10, backward: bool = False
+    ):
+        return await self._read(
+            (user.id, STORIES, author_id, (cursor, limit, backward)),
+            DB.list_stories_page, user, author_id, cursor, limit, backward
+        )
+
+    async def list_story_reviews_page(
+        self, user: User, story_id: int, cursor=None, limit: int = 10, backward: bool = False
+    ):
+        return await self._read(
+            (user.id, STORY_REVIEWS, story_id, (cursor, limit, backward)),
+            DB.list_story_reviews_page, user, story_id, cursor, limit, backward
+        )
+
+    async def add_author(self, author: Author):
+        try:
+            return await super().add_author(author)
+        finally:
+            self._invalidate(author.user_id, AUTHORS)
+
+    async def remove_author(self, user: User, author_id: int):
+        try:
+            return await super().remove_author(user, author_id)
+        finally:
+            # DB.remove_author() marks the author with its stories and reviews removed and reads skip them,
+            # so every cached list that may hold any of them is stale
+            self._invalidate(user.id, AUTHOR, (author_id,))
+            self._invalidate(user.id, STORY)
+            self._invalidate(user.id, REVIEW)
+            self._invalidate(user.id, AUTHORS)
+            self._invalidate(user.id, STORIES, (INVALID_ID, author_id))
+            self._invalidate(user.id, REVIEWS, (INVALID_ID, author_id))
+            self._invalidate(user.id, STORY_REVIEWS)
+
+    async def add_story(self, story: Story):
+        try:
+            return await super().add_story(story)
+        finally:
+            self._invalidate(story.user_id, STORIES, (INVALID_ID, story.author_id))
+
+    async def remove_story(self, user: User, story_id: int):
+        try:
+            return await super().remove_story(user, story_id)
+        finally:
+            # DB.remove_story() marks the story with its reviews removed and reads skip them,
+            # so every cached list that may hold any of them is stale
+            self._invalidate(user.id, STORY, (story_id,))
+            self._invalidate(user.id, REVIEW)
+            self._invalidate(user.id, STORIES)
+            self._invalidate(user.id, REVIEWS)
+            self._invalidate(user.id, STORY_REVIEWS, (story_id,))
+
+    async def add_review(self, review: Review):
+        try:
+            return await super().add_review(review)
+        finally:
+            author_scopes = None if review.author_id == INVALID_ID else (INVALID_ID, review.author_id)
+            self._invalidate(review.user_id, REVIEWS, author_scopes)
+            self._invalidate(review.user_id, STORY_REVIEWS, (review.story_id,))
+
+    async def remove_review(self, user: User, review_id: int):
+        try:
+            return await super().remove_review(user, review_id)
+        finally:
+            self._invalidate(user.id, REVIEW, (review_id,))
+            self._invalidate(user.id, REVIEWS)
+            self._invalidate(user.id, STORY_REVIEWS)
+
+    async def undo_remove(self, user: User, since: float):
+        try:
+            return await super().undo_remove(user, since)
+        finally:
+            for kind in (AUTHOR, STORY, REVIEW, AUTHORS, STORIES, REVIEWS, STORY_REVIEWS):
+                self._invalidate(user.id, kind)
+
+    async def import_reviews(self, user: User, rows: list):
+        try:
+            return await super().import_reviews(user, rows)
+        finally:
+            self._invalidate(user.id, AUTHORS)
+            self._invalidate(user.id, STORIES)
+            self._invalidate(user.id, REVIEWS)
+            self._invalidate(user.id, STORY_REVIEWS)
@@ -0,0 +1,65 @@
+from telegram import CallbackQuery, InlineKeyboardMarkup
+from telegram.ext import CallbackDataCache, ExtBot, InvalidCallbackData
+
+from metrics import CACHES
+
+
+class InstrumentedCallbackDataCache(CallbackDataCache):
+    '''CallbackDataCache со счётчиками попаданий, промахов и вытеснений клавиатур'''
+
+    __slots__ = ('keyboards', 'hits', 'misses', 'evictions')
+
+    def __init__(self, bot: ExtBot, maxsize: int = 1024, persistent_data=None):
+        super().__init__(bot, maxsize=maxsize, persistent_data=persistent_data)
+        self.keyboards = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def process_keyboard(self, reply_markup: InlineKeyboardMarkup) -> InlineKeyboardMarkup:
+        size = len(self._keyboard_data)
+        processed = super().process_keyboard(reply_markup)
+        if processed is not reply_markup:
+            self.keyboards += 1
+            # Every stored keyboard gets a new uuid, so the size stays the same only if some keyboard was evicted
+            if len(self._keyboard_data) == size:
+                self.evictions += 1
+        return processed
+
+    def process_callback_query(self, callback_query: CallbackQuery) -> None:
+        has_data = callback_query.data is not None
+        super().process_callback_query(callback_query)
+        if has_data:
+            if isinstance(callback_query.data, InvalidCallbackData):
+                self.misses += 1
+            else:
+                self.hits += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._keyboard_data),
+            'maxsize': self.maxsize,
+            'keyboards': self.keyboards,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+class DiaryBot(ExtBot):
+    '''ExtBot, который хранит данные кнопок в InstrumentedCallbackDataCache'''
+
+    __slots__ = ('_instrumented_cache',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        cache = super().callback_data_cache
+        self._instrumented_cache = None if cache is None else InstrumentedCallbackDataCache(self, cache.maxsize)
+        if self._instrumented_cache is not None:
+            CACHES.register('callback_data', self._instrumented_cache.stats)
+
+    @property
+    def callback_data_cache(self):
+        return self._instrumented_cache
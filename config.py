@@ -1,15 +1,163 @@
 import os
 
+from cache import CachedDB
 from db import DB
+from sharding import ShardedDB, shard_paths
+
+
+def _open_db():
+    '''Одна БД или, если BOT_DB_SHARDS больше 1, шарды рядом с BOT_DB (см. sharding.py)'''
+    shards = int(os.environ.get('BOT_DB_SHARDS', 1))
+    if shards > 1:
+        return ShardedDB(shard_paths(os.environ['BOT_DB'], shards), debug=os.environ.get('BOT_DEBUG_SQL'))
+    return DB(os.environ['BOT_DB'], debug=os.environ.get('BOT_DEBUG_SQL'))
 
 
 class Config:
-    _db = DB(os.environ['BOT_DB'], debug=os.environ.get('BOT_DEBUG_SQL'))
+    '''Настройки бота из переменных окружения
+
+    Каждая настройка читается при обращении к ней, а БД открывается при первом вызове db() или async_db(),
+    так что импорт модулей бота не требует BOT_DB и не трогает БД.
+    '''
+    _db = None
+    _async_db = None
 
     @staticmethod
     def token():
         return os.environ['BOT_TOKEN']
 
+    @staticmethod
+    def api_base_url():
+        '''Адрес Bot API, можно указать свой сервер Bot API или заглушку для тестов'''
+        return os.environ.get('BOT_API_BASE_URL', 'https://api.telegram.org/bot')
+
+    @staticmethod
+    def mode():
+        '''Как получать обновления: `polling` или `webhook`'''
+        mode = os.environ.get('BOT_MODE', 'polling')
+        if mode not in ('polling', 'webhook'):
+            raise ValueError(f'Unknown BOT_MODE {mode!r}, expected polling or webhook')
+        return mode
+
+    @staticmethod
+    def workers():
+        '''Сколько процессов-обработчиков запускать; 1 - всё в одном процессе (см. workers.py)'''
+        return int(os.environ.get('BOT_WORKERS', 1))
+
+    @staticmethod
+    def concurrency():
+        '''Сколько обновлений (разных пользователей) обрабатывать одновременно'''
+        return int(os.environ.get('BOT_CONCURRENCY', 32))
+
+    @staticmethod
+    def rate_limit():
+        '''Сколько запросов в секунду отправлять в Bot API всего (делится между обработчиками); 0 - без лимита'''
+        return float(os.environ.get('BOT_RATE_LIMIT', 30))
+
+    @staticmethod
+    def chat_rate_limit():
+        '''Сколько запросов в секунду отправлять в один чат; 0 - без лимита'''
+        return float(os.environ.get('BOT_CHAT_RATE_LIMIT', 1))
+
+    @staticmethod
+    def chat_burst():
+        '''Сколько запросов в один чат можно отправить подряд, не дожидаясь лимита'''
+        return int(os.environ.get('BOT_CHAT_BURST', 5))
+
+    @staticmethod
+    def webhook_url():
+        return os.environ['BOT_WEBHOOK_URL']
+
+    @staticmethod
+    def webhook_listen():
+        return os.environ.get('BOT_WEBHOOK_LISTEN', '127.0.0.1')
+
+    @staticmethod
+    def webhook_port():
+        return int(os.environ.get('BOT_WEBHOOK_PORT', 8443))
+
+    @staticmethod
+    def webhook_path():
+        return os.environ.get('BOT_WEBHOOK_PATH', '/')
+
+    @staticmethod
+    def webhook_secret():
+        return os.environ.get('BOT_WEBHOOK_SECRET')
+
+    @staticmethod
+    def known_users_cache_size():
+        return int(os.environ.get('BOT_KNOWN_USERS_CACHE_SIZE', 100000))
+
+    @staticmethod
+    def callback_data_cache_size():
+        return int(os.environ.get('BOT_CALLBACK_DATA_CACHE_SIZE', 1024))
+
+    @staticmethod
+    def keyboard_cache_size():
+        return int(os.environ.get('BOT_KEYBOARD_CACHE_SIZE', 10000))
+
+    @staticmethod
+    def undo_window():
+        '''Сколько секунд удалённое можно вернуть командой /undo'''
+        return float(os.environ.get('BOT_UNDO_WINDOW', 600))
+
+    @staticmethod
+    def purge_interval():
+        '''Как часто (в секундах) окончательно удалять то, что уже нельзя вернуть'''
+        return float(os.environ.get('BOT_PURGE_INTERVAL', 60))
+
+    @staticmethod
+    def persistence_interval():
+        '''Как часто (в секундах) сохранять изменившиеся диалоги и данные кнопок'''
+        return float(os.environ.get('BOT_PERSISTENCE_INTERVAL', 10))
+
+    @staticmethod
+    def metrics_port():
+        '''Порт HTTP-сервера с метриками; None - сервер не запускается'''
+        port = os.environ.get('BOT_METRICS_PORT')
+        return None if port is None else int(port)
+
+    @staticmethod
+    def metrics_host():
+        return os.environ.get('BOT_METRICS_HOST', '127.0.0.1')
+
+    @staticmethod
+    def list_cache_size():
+        return int(os.environ.get('BOT_LIST_CACHE_SIZE', 10000))
+
+    @staticmethod
+    def list_cache_rows():
+        return int(os.environ.get('BOT_LIST_CACHE_ROWS', 1000000))
+
+    @staticmethod
+    def write_batch_delay():
+        '''Сколько (в секундах) ждать следующих записей, чтобы зафиксировать их одной транзакцией'''
+        return int(os.environ.get('BOT_WRITE_BATCH_DELAY_MS', 0)) / 1000
+
+    @staticmethod
+    def write_batch_size():
+        return int(os.environ.get('BOT_WRITE_BATCH_SIZE', 256))
+
+    @staticmethod
+    def db_readers():
+        '''Сколько соединений только для чтения держать к каждому шарду; 0 - читать в потоке записи'''
+        return int(os.environ.get('BOT_DB_READERS', 4))
+
     @classmethod
     def db(cls):
+        if cls._db is None:
+            cls._db = _open_db()
         return cls._db
+
+    @classmethod
+    def async_db(cls):
+        if cls._async_db is None:
+            cls._async_db = CachedDB(
+                cls.db(),
+                maxsize=cls.list_cache_size(),
+                maxrows=cls.list_cache_rows(),
+                batch_delay=cls.write_batch_delay(),
+                batch_size=cls.write_batch_size(),
+                readers=cls.db_readers(),
+            )
+        return cls._async_db
@@ -6,3 +6,6 @@ CONFIRM_ANSWERS = (
     CONFIRM_POSITIVE,
     CONFIRM_NEGATIVE,
 )
+
+# Telegram does not accept longer messages
+MESSAGE_MAX_LENGTH = 4096
@@ -1,197 +1,358 @@
+import json
 import logging
+import os
+import re
 import sqlite3
+import time
+from urllib.request import pathname2url
 
-from entities import INVALID_ID, Author, Review, Story, User
+from entities import INVALID_ID, Author, Review, Stats, Story, User
+from migrations import STATS_REBUILD_8, STATS_TABLES_8, migrate
+from text_keys import text_key, trigrams
+
+
+# Column lists in the order expected by the row factories of entities
+AUTHOR_COLUMNS = 'author.id, author.name, author.user_id'
+STORY_COLUMNS = 'story.title, story.id, author.name, story.author_id, story.user_id'
+REVIEW_COLUMNS = (
+    'review.text, review.id, story.title, author.name, review.rank, review.story_id, story.author_id, review.user_id'
+)
+# Found reviews carry the matched fragment of the text instead of the whole text
+SEARCH_COLUMNS = REVIEW_COLUMNS.replace('review.text', "snippet(review_fts, 0, '', '', '…', 24)", 1)
+# Removed authors, stories and reviews stay in their tables until DB.purge_removed(), reads skip them
+ALIVE_AUTHOR = 'author.removed_at IS NULL'
+ALIVE_STORY = f'{ALIVE_AUTHOR} AND story.removed_at IS NULL'
+ALIVE_REVIEW = f'{ALIVE_STORY} AND review.removed_at IS NULL'
+# Reviews that leave the statistics with a removed author, story or review and come back on undo (see _count_reviews())
+REMOVED_REVIEWS = {
+    'author': 'review.story_id IN (SELECT id FROM story WHERE user_id == :user AND author_id == :id)',
+    'story': 'review.story_id == :id',
+    'review': 'review.id == :id',
+}
+# Dice coefficient of the trigram sets below which a name is not suggested as a misspelling
+MIN_SIMILARITY = 0.5
+# How long to wait for the write lock, in seconds: in the multi-process mode (see workers.py)
+# another process may hold it for a whole batch of writes or an import
+BUSY_TIMEOUT = 30
+
+
+def fts_query(text: str) -> str:
+    '''Превращаем запрос пользователя в запрос FTS5: все слова (или их начала) должны встретиться в отзыве
+
+    Слова берутся в кавычки, так что операторы FTS5 в тексте запроса не ломают его.
+    '''
+    return ' '.join('"{}"*'.format(word) for word in re.findall(r'\w+', text))
+
+
+def fts_user_query(user_id: int, match: str) -> str:
+    '''Запрос FTS5 `match` к тексту отзывов только одного пользователя
+
+    Владелец отзыва проиндексирован токеном `u<user_id>` в колонке owner (см. миграцию 9), так что индекс
+    пересекает совпадения слов только с отзывами этого пользователя.
+    '''
+    return f'owner : "u{user_id}" AND text : ({match})'
 
 
 class DB:
-    def __init__(self, sqlite_fn, debug=False):
-        self.conn = sqlite3.connect(sqlite_fn)
+    def __init__(self, sqlite_fn, debug=False, read_only=False):
+        self.sqlite_fn = sqlite_fn
+        self.debug = debug
+        if read_only:
+            uri = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(sqlite_fn)))
+            self.conn = sqlite3.connect(uri, uri=True, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        else:
+            # Connection is used from the AsyncDB worker thread, access is serialized there
+            self.conn = sqlite3.connect(sqlite_fn, timeout=BUSY_TIMEOUT, check_same_thread=False)
         if debug:
             self.conn.set_trace_callback(logging.info)
+        if not read_only:
+            # Readers do not block the writer and a commit appends to the log instead of rewriting pages.
+            # `synchronous` stays FULL, so a committed batch survives a power loss.
+            self.conn.execute('PRAGMA journal_mode = WAL')
+        self._in_batch = False
 
     def __del__(self):
+        self.close()
+
+    def close(self):
         self.conn.close()
 
     def prepare(self):
-        cursor = self.conn.cursor()
-        cursor.execute(
-            '''
-            CREATE TABLE IF NOT EXISTS user
-            (
-                id INTEGER PRIMARY KEY
-            )
-            '''
-        )
+        migrate(self.conn)
 
-        cursor.execute(
-            '''
-            CREATE TABLE IF NOT EXISTS author
-            (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                name TEXT,
-                FOREIGN KEY(user_id) REFERENCES user(id)
-            )
-            '''
-        )
+    @property
+    def in_memory(self) -> bool:
+        return self.sqlite_fn in (':memory:', '')
 
-        cursor.execute(
-            '''
-            CREATE TABLE IF NOT EXISTS story
-            (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                title TEXT NOT NULL,
-                author_id INTEGER,
-                FOREIGN KEY(author_id) REFERENCES author(id),
-                FOREIGN KEY(user_id) REFERENCES user(id)
-            )
-            '''
-        )
+    def reader(self):
+        '''Отдельное соединение только для чтения, для запросов вне потока записи AsyncDB (см. ReaderPool)
 
-        cursor.execute(
-            '''
-            CREATE TABLE IF NOT EXISTS review
-            (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                story_id INTEGER,
-                text TEXT NOT NULL,
-                rank INTEGER NOT NULL CHECK(rank >= 0 AND rank <= 5),
-                FOREIGN KEY(user_id) REFERENCES user(id),
-                FOREIGN KEY(story_id) REFERENCES story(id)
-            )
-            '''
-        )
+        Благодаря WAL оно не мешает записи и видит согласованный снимок БД.
+        Для БД в памяти (`in_memory`) второе соединение открыть нельзя.
+        '''
+        return DB(self.sqlite_fn, debug=self.debug, read_only=True)
 
-        # Create triggers
-        cursor.execute(
-            '''
-            CREATE TRIGGER IF NOT EXISTS on_author_delete
-            AFTER DELETE ON author
-            FOR EACH ROW
-            BEGIN
-                DELETE FROM story WHERE story.user_id == OLD.user_id AND story.author_id == OLD.id;
-            END
-            '''
-        )
-        cursor.execute(
-            '''
-            CREATE TRIGGER IF NOT EXISTS on_story_delete
-            AFTER DELETE ON story
-            FOR EACH ROW
-            BEGIN
-                DELETE FROM review WHERE review.user_id == OLD.user_id AND review.story_id == OLD.id;
-            END
-            '''
-        )
+    def _commit(self):
+        # Inside run_batch() all writes are committed at once
+        if not self._in_batch:
+            self.conn.commit()
 
-        self.conn.commit()
+    def run_batch(self, calls: list) -> list:
+        '''Выполняем изменения `(fn, args)` одной транзакцией и возвращаем пары (результат, исключение)
 
-    def add_user_if_new(self, user: User):
-        cursor = self.conn.cursor()
-        users = cursor.execute(
-            '''SELECT * FROM user WHERE user.id == ?''', (user.id,)
-        ).fetchall()
-        if len(users) == 0:
-            cursor.execute(
-                '''INSERT INTO user VALUES (?)''', (user.id,)
-            )
+        Каждое изменение выполняется в своей точке сохранения, так что ошибка в одном из них
+        откатывает только его. Если не удался сам COMMIT, исключение пробрасывается для всей пачки.
+        '''
+        results = []
+        self._in_batch = True
+        try:
+            # The write lock is taken at once: a deferred transaction that reads first can not wait
+            # for another process to release the lock and fails instead
+            self.conn.execute('BEGIN IMMEDIATE')
+            for fn, args in calls:
+                self.conn.execute('SAVEPOINT write')
+                try:
+                    results.append((fn(*args), None))
+                except Exception as e:
+                    self.conn.execute('ROLLBACK TO write')
+                    results.append((None, e))
+                self.conn.execute('RELEASE write')
             self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            self._in_batch = False
+        return results
+
+    def add_user_if_new(self, user: User) -> bool:
+        '''Returns True if the user has been added'''
+        cursor = self.conn.cursor()
+        cursor.execute(
+            '''INSERT OR IGNORE INTO user VALUES (?)''', (user.id,)
+        )
+        self._commit()
+        if cursor.rowcount > 0:
             logging.debug(f'Add new user: {user.username}')
-        else:
-            logging.debug(f'User with {user.id=} already in db')
+            return True
+        logging.debug(f'User with {user.id=} already in db')
+        return False
 
-    def add_author(self, author: Author):
+    def add_author(self, author: Author) -> bool:
+        '''Returns False if the author (up to text_key()) is already in db'''
         cursor = self.conn.cursor()
+        name_key = text_key(author.name)
+        # A removed author with the same name gives way to the new one
+        self._purge(cursor, authors=[
+            author_id for author_id, in cursor.execute(
+                '''SELECT id FROM author WHERE user_id == ? AND name_key == ? AND removed_at IS NOT NULL''',
+                (author.user_id, name_key)
+            )
+        ])
         cursor.execute(
-            '''INSERT INTO author (user_id, name) VALUES (?, ?)''',
-            (author.user_id, author.name)
+            '''INSERT OR IGNORE INTO author (user_id, name, name_key) VALUES (?, ?, ?)''',
+            (author.user_id, author.name, name_key)
         )
-        self.conn.commit()
+        added = cursor.rowcount > 0
+        if added:
+            cursor.executemany(
+                '''INSERT INTO author_trigram (user_id, trigram, author_id) VALUES (?, ?, ?)''',
+                [(author.user_id, trigram, cursor.lastrowid) for trigram in trigrams(name_key)]
+            )
+        self._commit()
+        return added
 
     def author_id(self, user: User, author_name: str):
         cursor = self.conn.cursor()
-        authors = cursor.execute(
-            '''SELECT id FROM author WHERE user_id == ? AND name == ?''',
-            (user.id, author_name)
+        author = cursor.execute(
+            '''SELECT id FROM author WHERE user_id == ? AND name_key == ? AND removed_at IS NULL''',
+            (user.id, text_key(author_name))
+        ).fetchone()
+        return INVALID_ID if author is None else author[0]
+
+    def similar_authors(self, user: User, author_name: str, limit: int = 3):
+        '''Авторы с похожими именами, от самых похожих; ищутся по индексу триграмм'''
+        name_trigrams = trigrams(text_key(author_name))
+        if not name_trigrams:
+            return []
+        # A key of n characters has at most n distinct trigrams, so its length stands in for their number
+        cursor = self._cursor(Author.from_row)
+        return cursor.execute(
+            f'''
+                SELECT {AUTHOR_COLUMNS}
+                FROM (
+                    SELECT author_id, COUNT(*) AS shared FROM author_trigram
+                    WHERE user_id == ? AND trigram IN ({', '.join('?' * len(name_trigrams))})
+                    GROUP BY author_id
+                ) AS found
+                JOIN author ON author.id == found.author_id
+                WHERE {ALIVE_AUTHOR} AND 2.0 * found.shared / (length(author.name_key) + ?) >= ?
+                ORDER BY 2.0 * found.shared / (length(author.name_key) + ?) DESC, author.name
+                LIMIT ?
+            ''',
+            (user.id, *name_trigrams, len(name_trigrams), MIN_SIMILARITY, len(name_trigrams), limit)
         ).fetchall()
-        if len(authors) > 1:
-            # TODO: emit some signal if that happens
-            logging.critical(f'[{user.id=}] More than one unique author: `{author_name}`')
-            return authors[0]
-        return INVALID_ID if not authors else authors[0]
+
+    def get_author(self, user: User, author_id: int):
+        cursor = self._cursor(Author.from_row)
+        return cursor.execute(
+            f'''SELECT {AUTHOR_COLUMNS} FROM author WHERE user_id == ? AND id == ? AND {ALIVE_AUTHOR}''',
+            (user.id, author_id)
+        ).fetchone()
 
     def list_authors(self, user: User):
-        cursor = self.conn.cursor()
-        authors = cursor.execute(
-            '''SELECT id, name FROM author WHERE user_id == ?''',
+        cursor = self._cursor(Author.from_row)
+        return cursor.execute(
+            f'''SELECT {AUTHOR_COLUMNS} FROM author WHERE user_id == ? AND {ALIVE_AUTHOR}''',
             (user.id,)
         ).fetchall()
-        return [Author(user, name=row[1], id_=row[0]) for row in authors]
+
+    def list_authors_page(self, user: User, cursor=None, limit: int = 10, backward: bool = False):
+        return self._keyset_page(
+            Author.from_row,
+            f'''SELECT {AUTHOR_COLUMNS} FROM author WHERE user_id == ? AND {ALIVE_AUTHOR}''',
+            (user.id,), ('author.name',), cursor, limit, backward
+        )
 
     def remove_author(self, user: User, author_id: int):
+        '''Помечаем автора удалённым вместе со всем, что о нём записано (см. undo_remove() и purge_removed())'''
         cursor = self.conn.cursor()
-        cursor.execute(
-            '''DELETE FROM author WHERE user_id == ? AND id == ?''',
-            (user.id, author_id)
-        )
-        self.conn.commit()
+        alive = cursor.execute(
+            f'''SELECT 1 FROM author WHERE user_id == ? AND id == ? AND {ALIVE_AUTHOR}''', (user.id, author_id)
+        ).fetchone()
+        if alive:
+            self._count_reviews(cursor, -1, user.id, REMOVED_REVIEWS['author'], author_id)
+            cursor.execute(
+                '''UPDATE author SET removed_at = ? WHERE user_id == ? AND id == ?''', (time.time(), user.id, author_id)
+            )
+        self._commit()
 
-    def add_story(self, story: Story):
+    def add_story(self, story: Story) -> bool:
+        '''Returns False if the author already has a story with the same title (up to text_key())'''
         cursor = self.conn.cursor()
+        title_key = text_key(story.title)
+        self._purge(cursor, stories=[
+            story_id for story_id, in cursor.execute(
+                '''
+                    SELECT id FROM story
+                    WHERE user_id == ? AND author_id == ? AND (title_key == ? OR title == ?) AND removed_at IS NOT NULL
+                ''',
+                (story.user_id, story.author_id, title_key, story.title)
+            )
+        ])
         cursor.execute(
-            '''INSERT INTO story (user_id, title, author_id) VALUES (?, ?, ?)''',
-            (story.user_id, story.title, story.author_id)
+            '''INSERT OR IGNORE INTO story (user_id, title, author_id, title_key) VALUES (?, ?, ?, ?)''',
+            (story.user_id, story.title, story.author_id, title_key)
         )
-        self.conn.commit()
+        added = cursor.rowcount > 0
+        if added:
+            cursor.executemany(
+                '''INSERT INTO story_trigram (user_id, author_id, trigram, story_id) VALUES (?, ?, ?, ?)''',
+                [(story.user_id, story.author_id, trigram, cursor.lastrowid) for trigram in trigrams(title_key)]
+            )
+        self._commit()
+        return added
 
     def story_id(self, user: User, story: Story, author: Author):
         cursor = self.conn.cursor()
-        stories = cursor.execute(
-            '''SELECT id FROM story WHERE user_id == ? AND author_id == ? AND title == ?''',
-            (user.id, author.id, story.title)
+        story_row = cursor.execute(
+            '''SELECT id FROM story WHERE user_id == ? AND author_id == ? AND title_key == ? AND removed_at IS NULL''',
+            (user.id, author.id, text_key(story.title))
+        ).fetchone()
+        return INVALID_ID if story_row is None else story_row[0]
+
+    def similar_stories(self, user: User, author_id: int, title: str, limit: int = 3):
+        '''Произведения автора с похожими названиями, от самых похожих; ищутся по индексу триграмм'''
+        title_trigrams = trigrams(text_key(title))
+        if not title_trigrams:
+            return []
+        cursor = self._cursor(Story.from_row)
+        return cursor.execute(
+            f'''
+                SELECT {STORY_COLUMNS}
+                FROM (
+                    SELECT story_id, COUNT(*) AS shared FROM story_trigram
+                    WHERE user_id == ? AND author_id == ? AND trigram IN ({', '.join('?' * len(title_trigrams))})
+                    GROUP BY story_id
+                ) AS found
+                JOIN story ON story.id == found.story_id
+                JOIN author ON (story.user_id == author.user_id) AND (story.author_id == author.id)
+                WHERE {ALIVE_STORY} AND 2.0 * found.shared / (length(story.title_key) + ?) >= ?
+                ORDER BY 2.0 * found.shared / (length(story.title_key) + ?) DESC, story.title
+                LIMIT ?
+            ''',
+            (user.id, author_id, *title_trigrams, len(title_trigrams), MIN_SIMILARITY, len(title_trigrams), limit)
         ).fetchall()
-        if len(stories) > 1:
-            # TODO: emit some signal if that happens
-            logging.critical(f'[{user.id=}] More than one unique story `{story.title}` for author `{author.name}`')
-            return stories[0]
-        return INVALID_ID if not stories else stories[0]
 
-    def list_stories(self, user: User, author_id: int = INVALID_ID):
-        cursor = self.conn.cursor()
+    def get_story(self, user: User, story_id: int):
+        cursor = self._cursor(Story.from_row)
+        return cursor.execute(
+            f'''
+                SELECT {STORY_COLUMNS}
+                FROM story
+                JOIN author ON (story.user_id == author.user_id) AND (story.author_id == author.id)
+                WHERE story.user_id == ? AND story.id == ? AND {ALIVE_STORY}
+            ''',
+            (user.id, story_id)
+        ).fetchone()
+
+    def iter_stories(self, user: User, author_id: int = INVALID_ID):
+        cursor = self._cursor(Story.from_row)
         if author_id == INVALID_ID:
             stories = cursor.execute(
-                '''
-                    SELECT story.title, story.id, author.name
+                f'''
+                    SELECT {STORY_COLUMNS}
                     FROM story
                     JOIN author ON (story.user_id == author.user_id) AND (story.author_id == author.id)
-                    WHERE story.user_id == ?
+                    WHERE story.user_id == ? AND {ALIVE_STORY}
                     ORDER BY author.name, story.title
                 ''',
                 (user.id,)
-            ).fetchall()
+            )
         else:
             stories = cursor.execute(
-                '''
-                    SELECT story.title, story.id, author.name
+                f'''
+                    SELECT {STORY_COLUMNS}
                     FROM story
                     JOIN author ON (story.user_id == author.user_id) AND (story.author_id == author.id)
-                    WHERE story.user_id == ? AND story.author_id == ?
+                    WHERE story.user_id == ? AND story.author_id == ? AND {ALIVE_STORY}
                     ORDER BY story.title
                 ''',
                 (user.id, author_id)
-            ).fetchall()
-        return [Story(user, title=row[0], id_=row[1], author_name=row[2]) for row in stories]
+            )
+        return stories
+
+    def list_stories(self, user: User, author_id: int = INVALID_ID):
+        return list(self.iter_stories(user, author_id))
+
+    def list_stories_page(self, user: User, author_id: int, cursor=None, limit: int = 10, backward: bool = False):
+        return self._keyset_page(
+            Story.from_row,
+            f'''
+                SELECT {STORY_COLUMNS}
+                FROM story
+                JOIN author ON (story.user_id == author.user_id) AND (story.author_id == author.id)
+                WHERE story.user_id == ? AND story.author_id == ? AND {ALIVE_STORY}
+            ''',
+            (user.id, author_id), ('story.title',), cursor, limit, backward
+        )
 
     def remove_story(self, user: User, story_id: int):
         cursor = self.conn.cursor()
-        cursor.execute(
-            '''DELETE FROM story WHERE user_id == ? AND id == ?''',
+        alive = cursor.execute(
+            f'''
+                SELECT 1 FROM story
+                JOIN author ON (story.user_id == author.user_id) AND (story.author_id == author.id)
+                WHERE story.user_id == ? AND story.id == ? AND {ALIVE_STORY}
+            ''',
             (user.id, story_id)
-        )
-        self.conn.commit()
+        ).fetchone()
+        if alive:
+            self._count_reviews(cursor, -1, user.id, REMOVED_REVIEWS['story'], story_id)
+            cursor.execute(
+                '''UPDATE story SET removed_at = ? WHERE user_id == ? AND id == ?''', (time.time(), user.id, story_id)
+            )
+        self._commit()
 
     def add_review(self, review: Review):
         cursor = self.conn.cursor()
@@ -199,65 +360,523 @@ class DB:
             '''INSERT INTO review (user_id, story_id, text, rank) VALUES (?, ?, ?, ?)''',
             (review.user_id, review.story_id, review.text, review.rank)
         )
-        self.conn.commit()
+        self._commit()
 
-    def list_reviews(self, user: User, author_id: int = INVALID_ID):
-        cursor = self.conn.cursor()
+    def get_review(self, user: User, review_id: int):
+        cursor = self._cursor(Review.from_row)
+        return cursor.execute(
+            f'''
+                SELECT {REVIEW_COLUMNS}
+                FROM review
+                JOIN story ON (review.user_id == story.user_id) AND (review.story_id == story.id)
+                JOIN author ON (review.user_id == author.user_id) AND (story.author_id == author.id)
+                WHERE review.user_id == ? AND review.id == ? AND {ALIVE_REVIEW}
+            ''',
+            (user.id, review_id)
+        ).fetchone()
+
+    def iter_reviews(self, user: User, author_id: int = INVALID_ID):
+        cursor = self._cursor(Review.from_row)
         if author_id == INVALID_ID:
             reviews = cursor.execute(
-                '''
-                    SELECT review.text, review.id, story.title, author.name, review.rank
+                f'''
+                    SELECT {REVIEW_COLUMNS}
                     FROM review
                     JOIN story ON (review.user_id == story.user_id) AND (review.story_id == story.id)
                     JOIN author ON (review.user_id == author.user_id) AND (story.author_id == author.id)
-                    WHERE review.user_id == ?
+                    WHERE review.user_id == ? AND {ALIVE_REVIEW}
                     ORDER BY author.name, story.title, review.text
                 ''',
                 (user.id,)
-            ).fetchall()
+            )
         else:
             reviews = cursor.execute(
-                '''
-                    SELECT review.text, review.id, story.title, author.name, review.rank
+                f'''
+                    SELECT {REVIEW_COLUMNS}
                     FROM review
                     JOIN story ON (review.user_id == story.user_id) AND (review.story_id == story.id)
                     JOIN author ON (review.user_id == author.user_id) AND (story.author_id == author.id)
-                    WHERE review.user_id == ? AND story.author_id == ?
+                    WHERE review.user_id == ? AND story.author_id == ? AND {ALIVE_REVIEW}
                     ORDER BY author.name, story.title, review.text
                 ''',
                 (user.id, author_id)
-            ).fetchall()
-        return [
-            Review(user, text=row[0], id_=row[1], story_title=row[2], author_name=row[3], rank=row[4])
-            for row in reviews
-        ]
+            )
+        return reviews
+
+    def list_reviews(self, user: User, author_id: int = INVALID_ID):
+        return list(self.iter_reviews(user, author_id))
 
     def list_story_reviews(self, user: User, story_id: int):
-        cursor = self.conn.cursor()
-        reviews = cursor.execute(
-            '''
-                SELECT review.text, review.id, story.title, author.name, review.rank
+        cursor = self._cursor(Review.from_row)
+        return cursor.execute(
+            f'''
+                SELECT {REVIEW_COLUMNS}
                 FROM review
                 JOIN story ON (review.user_id == story.user_id) AND (review.story_id == story.id)
                 JOIN author ON (review.user_id == author.user_id) AND (story.author_id == author.id)
-                WHERE review.user_id == ? AND story.id == ?
+                WHERE review.user_id == ? AND story.id == ? AND {ALIVE_REVIEW}
                 ORDER BY author.name, story.title, review.text
             ''',
             (user.id, story_id)
         ).fetchall()
-        return [
-            Review(user, text=row[0], id_=row[1], story_title=row[2], author_name=row[3], rank=row[4])
-            for row in reviews
-        ]
+
+    def list_story_reviews_page(
+        self, user: User, story_id: int, cursor=None, limit: int = 10, backward: bool = False
+    ):
+        return self._keyset_page(
+            Review.from_row,
+            f'''
+                SELECT {REVIEW_COLUMNS}
+                FROM review
+                JOIN story ON (review.user_id == story.user_id) AND (review.story_id == story.id)
+                JOIN author ON (review.user_id == author.user_id) AND (story.author_id == author.id)
+                WHERE review.user_id == ? AND review.story_id == ? AND {ALIVE_REVIEW}
+            ''',
+            # The order comes from the (user_id, story_id) index, whose entries end with the id
+            (user.id, story_id), ('review.id',), cursor, limit, backward
+        )
+
+    def search_reviews(self, user: User, query: str, offset: int = 0, limit: int = 10):
+        '''Отзывы, подходящие под запрос, от самых релевантных (bm25)'''
+        match = fts_query(query)
+        if not match:
+            return []
+        cursor = self._cursor(Review.from_row)
+        return cursor.execute(
+            f'''
+                SELECT {SEARCH_COLUMNS}
+                FROM review_fts
+                JOIN review ON review.id == review_fts.rowid
+                JOIN story ON (review.user_id == story.user_id) AND (review.story_id == story.id)
+                JOIN author ON (review.user_id == author.user_id) AND (story.author_id == author.id)
+                WHERE review_fts MATCH ? AND review.user_id == ? AND {ALIVE_REVIEW}
+                ORDER BY bm25(review_fts, 1.0, 0.0), review.id
+                LIMIT ? OFFSET ?
+            ''',
+            # The owner column is only a filter, relevance is computed by the text alone
+            (fts_user_query(user.id, match), user.id, limit, offset)
+        ).fetchall()
+
+    def iter_diary(self, user: User):
+        '''Весь дневник строками (автор, название, оценка, отзыв) по порядку, включая авторов без произведений
+        и произведения без отзывов (у них оценка и отзыв - None)'''
+        return self.conn.cursor().execute(
+            f'''
+                SELECT author.name, story.title, review.rank, review.text
+                FROM author
+                LEFT JOIN story ON
+                    (story.user_id == author.user_id) AND (story.author_id == author.id) AND story.removed_at IS NULL
+                LEFT JOIN review ON
+                    (review.user_id == story.user_id) AND (review.story_id == story.id) AND review.removed_at IS NULL
+                WHERE author.user_id == ? AND {ALIVE_AUTHOR}
+                ORDER BY author.name, story.title, review.id
+            ''',
+            (user.id,)
+        )
 
     def remove_review(self, user: User, review_id: int):
         cursor = self.conn.cursor()
-        cursor.execute(
-            '''DELETE FROM review WHERE user_id == ? AND id == ?''',
+        alive = cursor.execute(
+            f'''
+                SELECT 1 FROM review
+                JOIN story ON (review.user_id == story.user_id) AND (review.story_id == story.id)
+                JOIN author ON (review.user_id == author.user_id) AND (story.author_id == author.id)
+                WHERE review.user_id == ? AND review.id == ? AND {ALIVE_REVIEW}
+            ''',
             (user.id, review_id)
+        ).fetchone()
+        if alive:
+            self._count_reviews(cursor, -1, user.id, REMOVED_REVIEWS['review'], review_id)
+            cursor.execute(
+                '''UPDATE review SET removed_at = ? WHERE user_id == ? AND id == ?''', (time.time(), user.id, review_id)
+            )
+        self._commit()
+
+    def undo_remove(self, user: User, since: float):
+        '''Возвращаем последнее из удалённого пользователем после `since` (время в секундах, как time.time())
+
+        Возвращаем восстановленную сущность (Author, Story или Review) или None, если восстанавливать нечего.
+        Произведение или отзыв удаляются, только пока их автор на месте, так что последнее удалённое
+        всегда можно вернуть целиком.
+        '''
+        cursor = self.conn.cursor()
+        removed = cursor.execute(
+            '''
+                SELECT * FROM (
+                    SELECT 'author', id, removed_at FROM author WHERE user_id == :user AND removed_at > :since
+                    UNION ALL
+                    SELECT 'story', id, removed_at FROM story WHERE user_id == :user AND removed_at > :since
+                    UNION ALL
+                    SELECT 'review', id, removed_at FROM review WHERE user_id == :user AND removed_at > :since
+                )
+                ORDER BY removed_at DESC
+                LIMIT 1
+            ''',
+            {'user': user.id, 'since': since}
+        ).fetchone()
+        if removed is None:
+            return None
+        table, entity_id, _ = removed
+        cursor.execute(f'''UPDATE {table} SET removed_at = NULL WHERE id == ?''', (entity_id,))
+        self._count_reviews(cursor, 1, user.id, REMOVED_REVIEWS[table], entity_id)
+        self._commit()
+        get = {'author': self.get_author, 'story': self.get_story, 'review': self.get_review}[table]
+        return get(user, entity_id)
+
+    def purge_removed(self, before: float, limit: int = 100) -> int:
+        '''Окончательно удаляем то, что удалено раньше `before` (время в секундах, как time.time())
+
+        Удаление идёт снизу вверх: до `limit` отзывов, затем до `limit` произведений, у которых не осталось
+        отзывов, и авторов, у которых не осталось произведений. Возвращаем, сколько строк удалено: пока не 0,
+        стоит вызывать снова. Каждый вызов - отдельная транзакция не больше чем на 3 * `limit` строк,
+        так что запросы пользователей не ждут удаления автора с тысячами отзывов целиком.
+        '''
+        params = {'before': before, 'limit': limit}
+        cursor = self.conn.cursor()
+        cursor.execute('BEGIN')
+        try:
+            # Statistics do not change: removed reviews are already subtracted from it (see _count_reviews())
+            purged = cursor.execute('''
+                DELETE FROM review WHERE id IN (
+                    SELECT id FROM review WHERE removed_at < :before
+                    UNION
+                    SELECT review.id FROM story
+                    JOIN review ON (review.user_id == story.user_id) AND (review.story_id == story.id)
+                    WHERE story.removed_at < :before
+                    UNION
+                    -- CROSS JOIN keeps this order: a few removed authors, then their stories and reviews by index
+                    SELECT review.id FROM author
+                    CROSS JOIN story ON (story.user_id == author.user_id) AND (story.author_id == author.id)
+                    CROSS JOIN review ON (review.user_id == story.user_id) AND (review.story_id == story.id)
+                    WHERE author.removed_at < :before
+                    LIMIT :limit
+                )
+            ''', params).rowcount
+            no_reviews = '''
+                NOT EXISTS (SELECT 1 FROM review WHERE review.user_id == story.user_id AND review.story_id == story.id)
+            '''
+            purged += cursor.execute(f'''
+                DELETE FROM story WHERE id IN (
+                    SELECT id FROM story WHERE removed_at < :before AND {no_reviews}
+                    UNION
+                    SELECT story.id FROM author
+                    JOIN story ON (story.user_id == author.user_id) AND (story.author_id == author.id)
+                    WHERE author.removed_at < :before AND {no_reviews}
+                    LIMIT :limit
+                )
+            ''', params).rowcount
+            purged += cursor.execute('''
+                DELETE FROM author WHERE id IN (
+                    SELECT id FROM author WHERE removed_at < :before AND NOT EXISTS (
+                        SELECT 1 FROM story WHERE story.user_id == author.user_id AND story.author_id == author.id
+                    )
+                    LIMIT :limit
+                )
+            ''', params).rowcount
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+        return purged
+
+    def import_reviews(self, user: User, rows: list) -> dict:
+        '''Добавляем строки (автор, название, текст, оценка) одной транзакцией
+
+        Авторы и произведения (если `title` не None) ищутся по text_key() и создаются, если их нет;
+        отзыв (если `text` не None) пропускается как повтор, если у произведения уже есть отзыв
+        с тем же текстом и оценкой.
+        Возвращаем число добавленных авторов, произведений, отзывов и число повторов.
+        '''
+        cursor = self.conn.cursor()
+        # Removed rows would be taken for existing authors, stories and reviews, so they go for good
+        self._purge(cursor, *(
+            [
+                entity_id for entity_id, in cursor.execute(
+                    f'''SELECT id FROM {table} WHERE user_id == ? AND removed_at IS NOT NULL''', (user.id,)
+                )
+            ]
+            for table in ('author', 'story', 'review')
+        ))
+
+        # Authors: the first spelling of a name in the file is stored
+        names = {}
+        for author_name, _, _, _ in rows:
+            names.setdefault(text_key(author_name), author_name)
+        author_ids = dict(cursor.execute('''SELECT name_key, id FROM author WHERE user_id == ?''', (user.id,)))
+        new_authors = [(user.id, name, key) for key, name in names.items() if key not in author_ids]
+        cursor.executemany('''INSERT INTO author (user_id, name, name_key) VALUES (?, ?, ?)''', new_authors)
+        author_ids = dict(cursor.execute('''SELECT name_key, id FROM author WHERE user_id == ?''', (user.id,)))
+        cursor.executemany(
+            '''INSERT INTO author_trigram (user_id, trigram, author_id) VALUES (?, ?, ?)''',
+            [(user.id, trigram, author_ids[key]) for _, _, key in new_authors for trigram in trigrams(key)]
+        )
+
+        # Stories, unique per author
+        titles = {}
+        for author_name, title, _, _ in rows:
+            if title is None:
+                continue
+            titles.setdefault((author_ids[text_key(author_name)], text_key(title)), title)
+        story_ids = {
+            (author_id, key): story_id for author_id, key, story_id in cursor.execute(
+                '''SELECT author_id, title_key, id FROM story WHERE user_id == ?''', (user.id,)
+            )
+        }
+        new_stories = [
+            (user.id, title, author_id, key) for (author_id, key), title in titles.items()
+            if (author_id, key) not in story_ids
+        ]
+        cursor.executemany(
+            '''INSERT INTO story (user_id, title, author_id, title_key) VALUES (?, ?, ?, ?)''', new_stories
+        )
+        story_ids = {
+            (author_id, key): story_id for author_id, key, story_id in cursor.execute(
+                '''SELECT author_id, title_key, id FROM story WHERE user_id == ?''', (user.id,)
+            )
+        }
+        cursor.executemany(
+            '''INSERT INTO story_trigram (user_id, author_id, trigram, story_id) VALUES (?, ?, ?, ?)''',
+            [
+                (user.id, author_id, trigram, story_ids[author_id, key])
+                for _, _, author_id, key in new_stories for trigram in trigrams(key)
+            ]
         )
+
+        # Reviews: the same file imported twice adds nothing
+        existing = set(cursor.execute('''SELECT story_id, text, rank FROM review WHERE user_id == ?''', (user.id,)))
+        new_reviews = []
+        duplicates = 0
+        for author_name, title, text, rank in rows:
+            if text is None:
+                continue
+            review = (story_ids[author_ids[text_key(author_name)], text_key(title)], text, rank)
+            if review in existing:
+                duplicates += 1
+                continue
+            existing.add(review)
+            new_reviews.append((user.id, *review))
+        cursor.executemany('''INSERT INTO review (user_id, story_id, text, rank) VALUES (?, ?, ?, ?)''', new_reviews)
+
+        self._commit()
+        return {
+            'authors': len(new_authors), 'stories': len(new_stories), 'reviews': len(new_reviews),
+            'duplicates': duplicates,
+        }
+
+    def get_stats(self, user: User, authors: int = 10, stories: int = 5) -> Stats:
+        '''Сводка по отзывам из таблиц статистики: читается не больше 6 + `authors` + `stories` строк'''
+        cursor = self.conn.cursor()
+        ranks = cursor.execute(
+            '''SELECT rank, reviews FROM rank_stats WHERE user_id == ? ORDER BY rank''', (user.id,)
+        ).fetchall()
+        top_authors = cursor.execute(
+            '''
+                SELECT author.name, author_stats.reviews, author_stats.rank_sum * 1.0 / author_stats.reviews
+                FROM author_stats
+                JOIN author ON author.id == author_stats.author_id
+                WHERE author_stats.user_id == ?
+                ORDER BY author_stats.reviews DESC, author_stats.author_id DESC
+                LIMIT ?
+            ''',
+            (user.id, authors)
+        ).fetchall()
+        top_stories = cursor.execute(
+            '''
+                SELECT story.title, author.name, story_stats.reviews, story_stats.rank_sum * 1.0 / story_stats.reviews
+                FROM story_stats
+                JOIN story ON story.id == story_stats.story_id
+                JOIN author ON author.id == story_stats.author_id
+                WHERE story_stats.user_id == ?
+                ORDER BY story_stats.rank_sum * 1.0 / story_stats.reviews DESC, story_stats.reviews DESC,
+                    story_stats.story_id DESC
+                LIMIT ?
+            ''',
+            (user.id, stories)
+        ).fetchall()
+        return Stats(dict(ranks), top_authors, top_stories)
+
+    def check_stats(self) -> dict:
+        '''Сравниваем таблицы статистики с пересчитанными по отзывам; возвращаем число расходящихся строк'''
+        cursor = self.conn.cursor()
+        mismatches = {}
+        for table, (columns, expected) in STATS_TABLES_8.items():
+            actual = f'SELECT {columns} FROM {table}'
+            mismatches[table] = cursor.execute(
+                f'''
+                    SELECT COUNT(*) FROM (
+                        SELECT * FROM ({expected} EXCEPT {actual})
+                        UNION ALL
+                        SELECT * FROM ({actual} EXCEPT {expected})
+                    )
+                '''
+            ).fetchone()[0]
+        return mismatches
+
+    def rebuild_stats(self):
+        cursor = self.conn.cursor()
+        cursor.execute('BEGIN')
+        try:
+            for statement in STATS_REBUILD_8:
+                cursor.execute(statement)
+        except Exception:
+            self.conn.rollback()
+            raise
         self.conn.commit()
 
+    def load_user_data(self) -> list:
+        return self.conn.cursor().execute('''SELECT user_id, data FROM user_data''').fetchall()
+
+    def save_user_data(self, user_id: int, data):
+        '''`data` - сериализованные данные пользователя, None удаляет их'''
+        cursor = self.conn.cursor()
+        if data is None:
+            cursor.execute('''DELETE FROM user_data WHERE user_id == ?''', (user_id,))
+        else:
+            cursor.execute('''INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)''', (user_id, data))
+        self._commit()
+
+    def load_conversations(self, name: str) -> list:
+        return self.conn.cursor().execute(
+            '''SELECT key, state FROM conversation WHERE name == ?''', (name,)
+        ).fetchall()
+
+    def save_conversation(self, name: str, key: str, state):
+        '''`state` - сериализованное состояние диалога, None означает, что диалог закончен'''
+        cursor = self.conn.cursor()
+        if state is None:
+            cursor.execute('''DELETE FROM conversation WHERE name == ? AND key == ?''', (name, key))
+        else:
+            cursor.execute(
+                '''INSERT OR REPLACE INTO conversation (name, key, state) VALUES (?, ?, ?)''', (name, key, state)
+            )
+        self._commit()
+
+    def load_callback_data(self, worker: int = 0):
+        '''Данные кнопок, сохранённые процессом `worker` (см. workers.py)'''
+        cursor = self.conn.cursor()
+        keyboards = cursor.execute(
+            '''SELECT uuid, access_time, data FROM callback_keyboard WHERE worker == ? ORDER BY access_time''',
+            (worker,)
+        ).fetchall()
+        queries = cursor.execute(
+            '''SELECT id, keyboard_uuid FROM callback_query WHERE worker == ?''', (worker,)
+        ).fetchall()
+        return keyboards, queries
+
+    def save_callback_data(
+        self, keyboards: list, access_times: list, removed_keyboards: list, queries: list, removed_queries: list,
+        worker: int = 0,
+    ):
+        '''Применяем изменения данных кнопок: новые клавиатуры, обновлённое время обращения и удалённые записи'''
+        cursor = self.conn.cursor()
+        cursor.executemany(
+            '''INSERT OR REPLACE INTO callback_keyboard (uuid, access_time, data, worker) VALUES (?, ?, ?, ?)''',
+            [(*keyboard, worker) for keyboard in keyboards]
+        )
+        cursor.executemany('''UPDATE callback_keyboard SET access_time = ? WHERE uuid == ?''', access_times)
+        cursor.executemany('''DELETE FROM callback_keyboard WHERE uuid == ?''', removed_keyboards)
+        cursor.executemany(
+            '''INSERT OR REPLACE INTO callback_query (id, keyboard_uuid, worker) VALUES (?, ?, ?)''',
+            [(*query, worker) for query in queries]
+        )
+        cursor.executemany('''DELETE FROM callback_query WHERE id == ?''', removed_queries)
+        self._commit()
+
+    def _count_reviews(self, cursor, sign: int, user_id: int, scope: str, scope_id: int):
+        '''Добавляем (`sign` = 1) или вычитаем (-1) из статистики отзывы пользователя, подходящие под `scope`
+
+        `scope` - условие на review с параметрами `:user` и `:id`, см. REMOVED_REVIEWS.
+
+        Учитываются только неудалённые отзывы неудалённых произведений: при удалении вызывается до пометки,
+        при восстановлении - после снятия пометки. Каждая таблица обновляется одним запросом.
+        '''
+        reviews = f'''
+            FROM review JOIN story ON (review.user_id == story.user_id) AND (review.story_id == story.id)
+            WHERE review.user_id == :user AND {scope} AND review.removed_at IS NULL AND story.removed_at IS NULL
+        '''
+        params = {'user': user_id, 'id': scope_id, 'sign': sign}
+        cursor.execute(
+            f'''
+                INSERT INTO rank_stats (user_id, rank, reviews)
+                SELECT review.user_id, review.rank, :sign * COUNT(*) {reviews}
+                GROUP BY review.rank
+                ON CONFLICT (user_id, rank) DO UPDATE SET reviews = reviews + excluded.reviews
+            ''',
+            params
+        )
+        cursor.execute(
+            f'''
+                INSERT INTO author_stats (author_id, user_id, reviews, rank_sum)
+                SELECT story.author_id, review.user_id, :sign * COUNT(*), :sign * SUM(review.rank) {reviews}
+                GROUP BY story.author_id
+                ON CONFLICT (author_id) DO UPDATE SET
+                    reviews = reviews + excluded.reviews, rank_sum = rank_sum + excluded.rank_sum
+            ''',
+            params
+        )
+        cursor.execute(
+            f'''
+                INSERT INTO story_stats (story_id, user_id, author_id, reviews, rank_sum)
+                SELECT story.id, review.user_id, story.author_id, :sign * COUNT(*), :sign * SUM(review.rank) {reviews}
+                GROUP BY story.id
+                ON CONFLICT (story_id) DO UPDATE SET
+                    reviews = reviews + excluded.reviews, rank_sum = rank_sum + excluded.rank_sum
+            ''',
+            params
+        )
+        for table in ('rank_stats', 'author_stats', 'story_stats'):
+            cursor.execute(f'''DELETE FROM {table} WHERE user_id == ? AND reviews <= 0''', (user_id,))
+
+    def _purge(self, cursor, authors=(), stories=(), reviews=()):
+        '''Удаляем помеченные удалёнными записи по id вместе со всем, что от них зависит
+
+        Удаление идёт снизу вверх, каждая таблица - одним запросом. Статистика не меняется: удалённые
+        отзывы уже вычтены из неё (см. _count_reviews()), а триггеры поддерживают полнотекстовый индекс
+        и индексы триграмм.
+        '''
+        if not (authors or stories or reviews):
+            return
+        params = {'authors': json.dumps(list(authors)), 'stories': json.dumps(list(stories))}
+        purged_stories = '''
+            SELECT user_id, id FROM story
+            WHERE id IN (SELECT value FROM json_each(:stories))
+                OR (user_id, author_id) IN (
+                    SELECT user_id, id FROM author WHERE id IN (SELECT value FROM json_each(:authors))
+                )
+        '''
+        cursor.execute(
+            '''DELETE FROM review WHERE id IN (SELECT value FROM json_each(?))''', (json.dumps(list(reviews)),)
+        )
+        cursor.execute(f'''DELETE FROM review WHERE (user_id, story_id) IN ({purged_stories})''', params)
+        cursor.execute(f'''DELETE FROM story WHERE (user_id, id) IN ({purged_stories})''', params)
+        cursor.execute('''DELETE FROM author WHERE id IN (SELECT value FROM json_each(:authors))''', params)
+
+    def _cursor(self, row_factory):
+        '''Курсор, который сразу собирает сущности из строк с помощью `row_factory`'''
+        cursor = self.conn.cursor()
+        cursor.row_factory = row_factory
+        return cursor
+
+    def _keyset_page(
+        self, row_factory, query: str, params: tuple, order_by: tuple, cursor, limit: int, backward: bool
+    ):
+        '''Fetch up to `limit` rows that go right after (or right before) the `cursor` in `order_by` order
+
+        `cursor` is a tuple of `order_by` values of the boundary row, None means the beginning of the list.
+        Rows are always returned in ascending order.
+        '''
+        if cursor is not None:
+            columns = ', '.join(order_by)
+            placeholders = ', '.join('?' * len(order_by))
+            query += f' AND ({columns}) {"<" if backward else ">"} ({placeholders})'
+            params += tuple(cursor)
+        direction = ' DESC' if backward else ''
+        query += ' ORDER BY {} LIMIT ?'.format(', '.join(column + direction for column in order_by))
+        rows = self._cursor(row_factory).execute(query, params + (limit,)).fetchall()
+        if backward:
+            rows.reverse()
+        return rows
+
 
 if __name__ == '__main__':
     db = DB(':memory:')
@@ -2,6 +2,8 @@ INVALID_ID = -1
 
 
 class User:
+    __slots__ = ('id', 'is_bot', 'username', 'first_name', 'last_name', 'lang')
+
     def __init__(self, effective_user):
         self.id = effective_user.id
         self.is_bot = effective_user.is_bot
@@ -10,15 +12,42 @@ class User:
         self.last_name = effective_user.last_name
         self.lang = effective_user.language_code
 
+    def matches(self, effective_user) -> bool:
+        '''Совпадают ли поля с пользователем telegram (тогда объект можно не создавать заново)'''
+        return (
+            self.id == effective_user.id
+            and self.is_bot == effective_user.is_bot
+            and self.username == effective_user.username
+            and self.first_name == effective_user.first_name
+            and self.last_name == effective_user.last_name
+            and self.lang == effective_user.language_code
+        )
+
+
+# Row factories below are used as `sqlite3.Cursor.row_factory`, so entities are built right from
+# the fetched rows, without intermediate tuples and without calling __init__.
+# Every factory documents the order of columns it expects.
+
 
 class Author:
+    __slots__ = ('user_id', 'name', 'id')
+
     def __init__(self, user: User, name: str = '', id_: int = INVALID_ID):
         self.user_id = user.id
         self.name = name
         self.id = id_
 
+    @classmethod
+    def from_row(cls, cursor, row):
+        '''Колонки: id, name, user_id'''
+        author = object.__new__(cls)
+        author.id, author.name, author.user_id = row
+        return author
+
 
 class Story:
+    __slots__ = ('user_id', 'title', 'author_id', 'author_name', 'id')
+
     def __init__(self, user: User, title: str = '', id_: int = INVALID_ID, author_name: str = ''):
         self.user_id = user.id
         self.title = title
@@ -26,8 +55,17 @@ class Story:
         self.author_name = author_name
         self.id = id_
 
+    @classmethod
+    def from_row(cls, cursor, row):
+        '''Колонки: title, id, author_name, author_id, user_id'''
+        story = object.__new__(cls)
+        story.title, story.id, story.author_name, story.author_id, story.user_id = row
+        return story
+
 
 class Review:
+    __slots__ = ('user_id', 'text', 'rank', 'author_name', 'author_id', 'story_id', 'story_title', 'id')
+
     def __init__(
         self, user: User, text: str, id_: int = INVALID_ID, author_name: str = '',
         story_title: str = '', rank: int = INVALID_ID,
@@ -41,8 +79,41 @@ class Review:
         self.story_title = story_title
         self.id = id_
 
+    @classmethod
+    def from_row(cls, cursor, row):
+        '''Колонки: text, id, story_title, author_name, rank, story_id, author_id, user_id'''
+        review = object.__new__(cls)
+        (
+            review.text, review.id, review.story_title, review.author_name, review.rank,
+            review.story_id, review.author_id, review.user_id,
+        ) = row
+        return review
+
     def __str__(self):
         return f'Review(title="{self.story_title}",text="{self.text}",author="{self.author_name}",rank={self.rank})'
 
     def __repr__(self):
         return str(self)
+
+
+class Stats:
+    '''Сводка по отзывам пользователя
+
+    `ranks` - {оценка: число отзывов}, `authors` - [(имя, число отзывов, средняя оценка)],
+    `stories` - [(название, автор, число отзывов, средняя оценка)].
+    '''
+    __slots__ = ('ranks', 'authors', 'stories')
+
+    def __init__(self, ranks: dict, authors: list, stories: list):
+        self.ranks = ranks
+        self.authors = authors
+        self.stories = stories
+
+    @property
+    def reviews(self) -> int:
+        return sum(self.ranks.values())
+
+    @property
+    def average_rank(self) -> float:
+        reviews = self.reviews
+        return sum(rank * count for rank, count in self.ranks.items()) / reviews if reviews else 0.0
@@ -0,0 +1,72 @@
+'''Выгрузка всего дневника в файл (/export)
+
+Строки берутся прямо из курсора DB.iter_diary() и сразу пишутся в SpooledTemporaryFile, так что
+память не зависит от размера дневника: небольшой файл остаётся в памяти, большой уходит на диск.
+CSV и JSON используют те же поля, что понимает /import (см. importer.py).
+'''
+import csv
+import io
+from itertools import groupby
+import json
+from tempfile import SpooledTemporaryFile
+from typing import Iterable, TextIO
+
+from db import DB
+from entities import User
+
+
+# Files up to this size are not written to disk
+SPOOL_MAX_SIZE = 1024 * 1024
+
+CSV_HEADER = ('Author', 'Title', 'My Rating', 'My Review')
+
+
+def write_csv(rows: Iterable[tuple], out: TextIO):
+    writer = csv.writer(out)
+    writer.writerow(CSV_HEADER)
+    for author, title, rank, text in rows:
+        writer.writerow((author, title or '', '' if rank is None else rank, text or ''))
+
+
+def write_json(rows: Iterable[tuple], out: TextIO):
+    out.write('[')
+    for i, (author, title, rank, text) in enumerate(rows):
+        out.write(',\n' if i else '\n')
+        out.write(json.dumps({'author': author, 'title': title, 'rank': rank, 'review': text}, ensure_ascii=False))
+    out.write('\n]\n')
+
+
+def write_markdown(rows: Iterable[tuple], out: TextIO):
+    out.write('# Читательский дневник\n')
+    for author, author_rows in groupby(rows, key=lambda row: row[0]):
+        out.write(f'\n## {author}\n')
+        for title, story_rows in groupby(author_rows, key=lambda row: row[1]):
+            if title is None:
+                continue
+            out.write(f'\n### {title}\n\n')
+            for _, _, rank, text in story_rows:
+                if text is not None:
+                    out.write(f'- [{rank}] {text}\n')
+
+
+FORMATS = {
+    'csv': write_csv,
+    'json': write_json,
+    'md': write_markdown,
+}
+
+
+def export_diary(db: DB, user: User, fmt: str):
+    '''Пишем дневник пользователя в формате `fmt` во временный файл и возвращаем его, перемотанным в начало'''
+    spool = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode='w+b')
+    try:
+        out = io.TextIOWrapper(spool, encoding='utf-8', newline='')
+        FORMATS[fmt](db.iter_diary(user), out)
+        out.flush()
+        # Otherwise the wrapper closes the file when it is collected
+        out.detach()
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
@@ -1,8 +1,10 @@
 from .author import format_authors
-from .story import format_stories
-from .review import format_reviews
+from .story import format_stories, iter_format_stories
+from .review import format_found_reviews, format_reviews, iter_format_reviews
+from .stats import format_stats
 
 
 __all__ = [
-    'format_authors', 'format_stories', 'format_reviews'
+    'format_authors', 'format_stories', 'format_reviews', 'format_found_reviews', 'iter_format_stories',
+    'iter_format_reviews', 'format_stats',
 ]
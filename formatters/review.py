@@ -1,13 +1,13 @@
 from itertools import groupby
-from typing import List
+from typing import Iterable, Iterator, List
 
 from entities import Review
 
 
-def format_reviews(reviews: List[Review]) -> str:
+def iter_format_reviews(reviews: Iterable[Review]) -> Iterator[str]:
+    '''Форматируем отзывы по одному автору за раз, чтобы не собирать весь текст в памяти'''
     author_sep = '-' * 50
-    reviews_list = []
-    for author_key, author_reviews in groupby(reviews, key=lambda r: r.author_name):
+    for i, (author_key, author_reviews) in enumerate(groupby(reviews, key=lambda r: r.author_name)):
         author_review_list = []
         for story_key, author_story_reviews_group in groupby(author_reviews, key=lambda r: r.story_title):
             rec = '  "{}":\n{}'.format(
@@ -15,7 +15,16 @@ def format_reviews(reviews: List[Review]) -> str:
             )
             author_review_list.append(rec)
         author_rec = '{}:\n{}\n'.format(author_key, ' \n\n'.join(author_review_list))
-        reviews_list.append(author_rec)
-    reviews_str = f'{author_sep}\n'.join(reviews_list)
+        yield author_rec if i == 0 else f'{author_sep}\n{author_rec}'
+
+
+def format_reviews(reviews: List[Review]) -> str:
+    return ''.join(iter_format_reviews(reviews))
+
 
-    return reviews_str
+def format_found_reviews(reviews: List[Review], offset: int = 0) -> str:
+    '''Результаты поиска: номер, автор, произведение, оценка и найденный фрагмент отзыва'''
+    return '\n\n'.join(
+        '{}. {} - "{}" [{}]\n    {}'.format(offset + i, r.author_name, r.story_title, r.rank, r.text)
+        for i, r in enumerate(reviews, start=1)
+    )
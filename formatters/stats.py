@@ -0,0 +1,19 @@
+from entities import Stats
+
+
+def format_stats(stats: Stats) -> str:
+    '''Число отзывов, распределение оценок, авторы с наибольшим числом отзывов и лучшие произведения'''
+    lines = [f'Отзывов: {stats.reviews}, средняя оценка: {stats.average_rank:.2f}', '', 'Оценки:']
+    # Ranks are given from 1 to 5, though the schema allows 0
+    ranks = sorted(stats.ranks.keys() | set(range(1, 6)), reverse=True)
+    lines.extend(f'    [{rank}] {stats.ranks.get(rank, 0)}' for rank in ranks)
+    lines += ['', 'Авторы:']
+    lines.extend(
+        f'    {name} - отзывов: {reviews}, средняя оценка: {rank:.2f}' for name, reviews, rank in stats.authors
+    )
+    lines += ['', 'Лучшие произведения:']
+    lines.extend(
+        f'    {author_name} - "{title}" [{rank:.2f}], отзывов: {reviews}'
+        for title, author_name, reviews, rank in stats.stories
+    )
+    return '\n'.join(lines)
@@ -1,13 +1,15 @@
 from itertools import groupby
-from typing import List
+from typing import Iterable, Iterator, List
 
 from entities import Story
 
 
-def format_stories(stories: List[Story]) -> str:
-    stories_list = []
-    for key, author_stories in groupby(stories, key=lambda story: story.author_name):
+def iter_format_stories(stories: Iterable[Story]) -> Iterator[str]:
+    '''Форматируем произведения по одному автору за раз, чтобы не собирать весь текст в памяти'''
+    for i, (key, author_stories) in enumerate(groupby(stories, key=lambda story: story.author_name)):
         author_story_lits = '{}:\n{}'.format(key, '\n'.join('    {}'.format(story.title) for story in author_stories))
-        stories_list.append(author_story_lits)
-    stories_str = '\n\n'.join(stories_list)
-    return stories_str
+        yield author_story_lits if i == 0 else f'\n\n{author_story_lits}'
+
+
+def format_stories(stories: List[Story]) -> str:
+    return ''.join(iter_format_stories(stories))
@@ -1,9 +1,14 @@
 from .author import get_author_handlers
 from .review import get_review_handlers
+from .stats import get_stats_handlers
 from .story import get_story_handlers
-from .common import get_cancel_handler, get_fallback_handler
+from .transfer import get_transfer_handlers
+from .undo import get_undo_handlers
+from .common import get_cancel_handler, get_fallback_handler, get_invalid_button_handler, get_other_button_handler
+from .pages import get_page_handler
 
 __all__ = [
-    'get_author_handlers', 'get_review_handlers', 'get_story_handlers',
-    'get_cancel_handler', 'get_fallback_handler',
+    'get_author_handlers', 'get_review_handlers', 'get_stats_handlers', 'get_story_handlers', 'get_transfer_handlers',
+    'get_undo_handlers', 'get_cancel_handler', 'get_fallback_handler', 'get_invalid_button_handler', 'get_page_handler',
+    'get_other_button_handler',
 ]
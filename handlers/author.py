@@ -2,17 +2,20 @@ import logging
 
 from telegram import Update
 from telegram.ext import (
-    CallbackContext,
-    CallbackQueryHandler, CommandHandler, ConversationHandler, filters
+    CallbackQueryHandler, CommandHandler, ContextTypes, ConversationHandler, filters
 )
 
+from async_db import AsyncDB
 from consts import CONFIRM_POSITIVE
-from db import DB, INVALID_ID
+from db import INVALID_ID
 from entities import Author, User
 from formatters import format_authors
-from keyboards import authors_inline_keyboard, confirm_inline_keyboard
+from keyboards import AUTHOR_ACTION, action_data, action_pattern, confirm_data, confirm_inline_keyboard, confirm_pattern
+from text_keys import text_key
 from utils import update_confirm_status, with_db
 
+from .pages import authors_keyboard
+
 
 ADD_AUTHOR = 'add_author'
 LIST_AUTHORS = 'list_authors'
@@ -24,7 +27,7 @@ ADD_AUTHOR_CONFIRM, = range(1)
 
 
 @with_db
-async def add_author(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def add_author(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     if update.message is None:
         return ConversationHandler.END
     if not context.args:
@@ -32,19 +35,28 @@ async def add_author(update: Update, context: CallbackContext.DEFAULT_TYPE, db:
         return ConversationHandler.END
 
     author_name = ' '.join(context.args)
-    author_id = db.author_id(user, author_name)
+    if not text_key(author_name):
+        await update.message.reply_text('В имени автора должны быть буквы или цифры')
+        return ConversationHandler.END
+
+    author_id = await db.author_id(user, author_name)
     if author_id != INVALID_ID:
         await update.message.reply_text(f'Такой автор уже есть в базе')
         return ConversationHandler.END
     else:
-        author = Author(user, name=author_name)
-        confirm_markup = confirm_inline_keyboard(optional_data=(author,))
-        await update.message.reply_text('Добавить автора `{}`?'.format(author.name), reply_markup=confirm_markup)
+        # Keep the name until confirmation instead of passing it through the callback data
+        context.user_data[ADD_AUTHOR] = author_name     # type: ignore
+        text = 'Добавить автора `{}`?'.format(author_name)
+        similar = await db.similar_authors(user, author_name)
+        if similar:
+            text += '\n\nПохожие авторы уже есть в базе: {}'.format(', '.join(f'`{a.name}`' for a in similar))
+        confirm_markup = confirm_inline_keyboard(optional_data=(ADD_AUTHOR,))
+        await update.message.reply_text(text, reply_markup=confirm_markup)
         return ADD_AUTHOR_CONFIRM
 
 
 @with_db
-async def add_author_name_callback(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def add_author_name_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     query = update.callback_query
     if query is None:
         return ConversationHandler.END
@@ -55,16 +67,21 @@ async def add_author_name_callback(update: Update, context: CallbackContext.DEFA
         logging.error('query.message is None')
         return ConversationHandler.END
 
-    if query.data is None:
-        logging.error('query.data is None in add_author_name_callback()')
+    data = confirm_data(query.data, ADD_AUTHOR)
+    if data is None:
+        logging.error(f'unexpected query.data in add_author_name_callback(): {query.data!r}')
         return ConversationHandler.END
     answer: str
-    author: Author
-    answer, author = query.data     # type: ignore
-
-    if answer == CONFIRM_POSITIVE:
-        db.add_author(author)
-        status_msg = 'добавлен'
+    answer, = data
+    author_name = context.user_data.pop(ADD_AUTHOR, None)     # type: ignore
+
+    if author_name is None:
+        status_msg = 'данные устарели, начни заново'
+    elif answer == CONFIRM_POSITIVE:
+        if await db.add_author(Author(user, name=author_name)):
+            status_msg = 'добавлен'
+        else:
+            status_msg = 'такой автор уже есть в базе'
     else:
         status_msg = 'добавление отменено'
     await update_confirm_status(query, status_msg)
@@ -75,11 +92,11 @@ async def add_author_name_callback(update: Update, context: CallbackContext.DEFA
 
 # LIST AUTHORS ---------------------------------------------------------------------------------------------------------
 @with_db
-async def list_authors(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def list_authors(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     if update.message is None:
         return ConversationHandler.END
 
-    authors = db.list_authors(user)
+    authors = await db.list_authors(user)
     authors_str = format_authors(authors)
     text = f'Твой список авторов:\n\n{authors_str}'
 
@@ -91,31 +108,36 @@ REMOVE_AUTHOR_ACTION, REMOVE_AUTHOR_CONFIRM = range(2)
 
 
 @with_db
-async def remove_author(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def remove_author(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     if update.message is None:
         return ConversationHandler.END
 
-    authors = db.list_authors(user)
-    author_markup = authors_inline_keyboard(authors)
+    author_markup = await authors_keyboard(db, user)
     await update.message.reply_text('Какого автора ты хочешь удалить?', reply_markup=author_markup)
     return REMOVE_AUTHOR_ACTION
 
 
 @with_db
-async def remove_author_callback(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def remove_author_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     query = update.callback_query
     if query is None:
         return ConversationHandler.END
 
     await query.answer()
 
-    if query.data is None:
-        logging.error('query.data is None in remove_author_callback()')
+    data = action_data(query.data, AUTHOR_ACTION)
+    if data is None:
+        logging.error(f'unexpected query.data in remove_author_callback(): {query.data!r}')
+        return ConversationHandler.END
+
+    author_id: int
+    author_id, = data
+    author = await db.get_author(user, author_id)
+    if author is None:
+        await query.edit_message_text(text='Такого автора уже нет в базе')
         return ConversationHandler.END
 
-    author: Author
-    author, = query.data    # type: ignore
-    confirm_markup = confirm_inline_keyboard(optional_data=(author,))
+    confirm_markup = confirm_inline_keyboard(optional_data=(REMOVE_AUTHOR, author.id))
 
     text = f'Удалить автора `{author.name}`? Вместе с ним удалятся все его произведения, а также все твои записи о них'
     await query.edit_message_text(text=text, reply_markup=confirm_markup)
@@ -123,7 +145,7 @@ async def remove_author_callback(update: Update, context: CallbackContext.DEFAUL
 
 
 @with_db
-async def remove_author_confirm_callback(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def remove_author_confirm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     query = update.callback_query
     if query is None:
         return ConversationHandler.END
@@ -134,16 +156,17 @@ async def remove_author_confirm_callback(update: Update, context: CallbackContex
         logging.error('query.message is None')
         return ConversationHandler.END
 
-    if query.data is None:
-        logging.error('query.data is None in remove_author_confirm_callback()')
+    data = confirm_data(query.data, REMOVE_AUTHOR, 1)
+    if data is None:
+        logging.error(f'unexpected query.data in remove_author_confirm_callback(): {query.data!r}')
         return ConversationHandler.END
 
     answer: str
-    author: Author
-    answer, author = query.data     # type: ignore
+    author_id: int
+    answer, author_id = data
     if answer == CONFIRM_POSITIVE:
-        db.remove_author(user, author.id)
-        status_msg = 'удалён'
+        await db.remove_author(user, author_id)
+        status_msg = 'удалён (вернуть: /undo)'
     else:
         status_msg = 'удаление отменено'
 
@@ -152,13 +175,18 @@ async def remove_author_confirm_callback(update: Update, context: CallbackContex
 # ----------------------------------------------------------------------------------------------------------------------
 
 
-def get_author_handlers(fallback_handler: CommandHandler, cancel_handler: CallbackQueryHandler):
+def get_author_handlers(
+    fallback_handler: CommandHandler, cancel_handler: CallbackQueryHandler, page_handler: CallbackQueryHandler,
+    other_button_handler: CallbackQueryHandler,
+):
     add_author_handler = ConversationHandler(
         entry_points=[CommandHandler(ADD_AUTHOR, add_author, filters=~filters.UpdateType.EDITED_MESSAGE)],
         states={
-            ADD_AUTHOR_CONFIRM: [CallbackQueryHandler(add_author_name_callback)],
+            ADD_AUTHOR_CONFIRM: [CallbackQueryHandler(add_author_name_callback, pattern=confirm_pattern(ADD_AUTHOR))],
         },
-        fallbacks=[fallback_handler],
+        fallbacks=[fallback_handler, other_button_handler],
+        name=ADD_AUTHOR,
+        persistent=True,
     )
 
     list_authors_handler = CommandHandler(LIST_AUTHORS, list_authors, filters=~filters.UpdateType.EDITED_MESSAGE)
@@ -167,12 +195,17 @@ def get_author_handlers(fallback_handler: CommandHandler, cancel_handler: Callba
         entry_points=[CommandHandler(REMOVE_AUTHOR, remove_author, filters=~filters.UpdateType.EDITED_MESSAGE)],
         states={
             REMOVE_AUTHOR_ACTION: [
-                CallbackQueryHandler(remove_author_callback, pattern=tuple),
+                page_handler,
+                CallbackQueryHandler(remove_author_callback, pattern=action_pattern(AUTHOR_ACTION)),
                 cancel_handler,
             ],
-            REMOVE_AUTHOR_CONFIRM: [CallbackQueryHandler(remove_author_confirm_callback)],
+            REMOVE_AUTHOR_CONFIRM: [
+                CallbackQueryHandler(remove_author_confirm_callback, pattern=confirm_pattern(REMOVE_AUTHOR, 1)),
+            ],
         },
-        fallbacks=[fallback_handler],
+        fallbacks=[fallback_handler, other_button_handler],
+        name=REMOVE_AUTHOR,
+        persistent=True,
     )
 
     return (
@@ -1,8 +1,12 @@
 from telegram import Update
-from telegram.ext import CallbackContext, CommandHandler, ConversationHandler, CallbackQueryHandler
+from telegram.ext import (
+    ApplicationHandlerStop, CallbackQueryHandler, CommandHandler, ContextTypes, ConversationHandler,
+    InvalidCallbackData,
+)
 
-from db import DB
+from async_db import AsyncDB
 from entities import User
+from keyboards import CANCEL_VALUE
 from utils import with_db, update_confirm_status
 
 
@@ -10,7 +14,9 @@ CANCEL_COMMAND = 'cancel'
 
 
 @with_db
-async def fallback(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def fallback(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
+    # Drafts of the abandoned conversation are not needed anymore (and would be persisted otherwise)
+    context.user_data.clear()     # type: ignore
     if update.message is None:
         return ConversationHandler.END
 
@@ -25,7 +31,8 @@ def get_fallback_handler():
 
 
 @with_db
-async def cancel(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
+    context.user_data.clear()     # type: ignore
     query = update.callback_query
     if query is None:
         return ConversationHandler.END
@@ -35,4 +42,31 @@ async def cancel(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB,
 
 
 def get_cancel_handler():
-    return CallbackQueryHandler(cancel)
+    return CallbackQueryHandler(cancel, pattern=f'^{CANCEL_VALUE}$')
+
+
+async def other_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if query is None:
+        return None
+    # A button of another step or conversation, e.g. in an older message: it must not act on this one
+    await query.answer('Эта кнопка сейчас не работает, выбери в последнем сообщении')
+    # Stay in the current state of the conversation
+    return None
+
+
+def get_other_button_handler():
+    return CallbackQueryHandler(other_button)
+
+
+async def invalid_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if query is None:
+        return
+    await query.answer('Эта кнопка устарела, начни заново', show_alert=True)
+    # Do not pass the update to conversations, they can not handle it anyway
+    raise ApplicationHandlerStop
+
+
+def get_invalid_button_handler():
+    return CallbackQueryHandler(invalid_button, pattern=InvalidCallbackData)
@@ -0,0 +1,109 @@
+import logging
+
+from telegram import Update
+from telegram.ext import CallbackQueryHandler, ContextTypes
+
+from async_db import AsyncDB
+from config import Config
+from entities import INVALID_ID, User
+from keyboards import KeyboardCache, Page, authors_inline_keyboard, reviews_inline_keyboard, stories_inline_keyboard
+from metrics import CACHES
+from utils import with_db
+
+
+PAGE_SIZE = 10
+
+AUTHORS_PAGE = 'authors'
+STORIES_PAGE = 'stories'
+REVIEWS_PAGE = 'reviews'
+
+# Keyboards of list pages by (user, kind, scope, optional data, cursor, direction)
+keyboards = KeyboardCache(Config.keyboard_cache_size())
+CACHES.register('keyboards', keyboards.cache.stats)
+
+
+def _split_page(kind: str, scope: int, rows: list, key, cursor, backward: bool, optional_data):
+    '''Отрезаем лишнюю строку (она была запрошена, чтобы понять, есть ли ещё страница) и создаём кнопки навигации'''
+    has_more = len(rows) > PAGE_SIZE
+    if backward:
+        rows = rows[-PAGE_SIZE:]
+        has_prev, has_next = has_more, True
+    else:
+        rows = rows[:PAGE_SIZE]
+        has_prev, has_next = cursor is not None, has_more
+
+    prev_page = next_page = None
+    if rows:
+        if has_prev:
+            prev_page = Page(kind, scope, key(rows[0]), backward=True, optional_data=optional_data)
+        if has_next:
+            next_page = Page(kind, scope, key(rows[-1]), backward=False, optional_data=optional_data)
+    return rows, prev_page, next_page
+
+
+async def authors_keyboard(db: AsyncDB, user: User, optional_data=None, cursor=None, backward: bool = False):
+    async def build():
+        authors = await db.list_authors_page(user, cursor, PAGE_SIZE + 1, backward)
+        authors, prev_page, next_page = _split_page(
+            AUTHORS_PAGE, INVALID_ID, authors, lambda a: (a.name,), cursor, backward, optional_data
+        )
+        return authors_inline_keyboard(authors, optional_data=optional_data, prev_page=prev_page, next_page=next_page)
+
+    key = (AUTHORS_PAGE, INVALID_ID, optional_data, cursor, backward)
+    return await keyboards.get(user.id, db.version(user.id), key, build)
+
+
+async def stories_keyboard(
+    db: AsyncDB, user: User, author_id: int, optional_data=None, cursor=None, backward: bool = False
+):
+    async def build():
+        stories = await db.list_stories_page(user, author_id, cursor, PAGE_SIZE + 1, backward)
+        stories, prev_page, next_page = _split_page(
+            STORIES_PAGE, author_id, stories, lambda s: (s.title,), cursor, backward, optional_data
+        )
+        return stories_inline_keyboard(stories, optional_data=optional_data, prev_page=prev_page, next_page=next_page)
+
+    key = (STORIES_PAGE, author_id, optional_data, cursor, backward)
+    return await keyboards.get(user.id, db.version(user.id), key, build)
+
+
+async def reviews_keyboard(
+    db: AsyncDB, user: User, story_id: int, optional_data=None, cursor=None, backward: bool = False
+):
+    async def build():
+        reviews = await db.list_story_reviews_page(user, story_id, cursor, PAGE_SIZE + 1, backward)
+        reviews, prev_page, next_page = _split_page(
+            REVIEWS_PAGE, story_id, reviews, lambda r: (r.id,), cursor, backward, optional_data
+        )
+        return reviews_inline_keyboard(reviews, optional_data=optional_data, prev_page=prev_page, next_page=next_page)
+
+    key = (REVIEWS_PAGE, story_id, optional_data, cursor, backward)
+    return await keyboards.get(user.id, db.version(user.id), key, build)
+
+
+@with_db
+async def page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
+    query = update.callback_query
+    if query is None:
+        return None
+
+    await query.answer()
+
+    if query.data is None:
+        logging.error('query.data is None in page_callback()')
+        return None
+
+    page: Page = query.data     # type: ignore
+    if page.kind == AUTHORS_PAGE:
+        markup = await authors_keyboard(db, user, page.optional_data, page.cursor, page.backward)
+    elif page.kind == STORIES_PAGE:
+        markup = await stories_keyboard(db, user, page.scope, page.optional_data, page.cursor, page.backward)
+    else:
+        markup = await reviews_keyboard(db, user, page.scope, page.optional_data, page.cursor, page.backward)
+    await query.edit_message_reply_markup(reply_markup=markup)
+    # Stay in the current state of the conversation
+    return None
+
+
+def get_page_handler():
+    return CallbackQueryHandler(page_callback, pattern=Page)
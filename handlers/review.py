@@ -2,23 +2,27 @@ import logging
 
 from telegram import Update
 from telegram.ext import (
-    CallbackContext, CallbackQueryHandler, CommandHandler, ConversationHandler, filters
+    CallbackQueryHandler, CommandHandler, ContextTypes, ConversationHandler, filters
 )
 
+from async_db import AsyncDB
 from consts import CONFIRM_POSITIVE
 from db import DB
-from entities import Author, Review, Story, User
-from formatters import format_reviews
+from entities import Review, User
+from formatters import format_found_reviews, iter_format_reviews
 from keyboards import (
-    authors_inline_keyboard, confirm_inline_keyboard, stories_inline_keyboard,
-    rank_inline_keyboard, reviews_inline_keyboard,
+    AUTHOR_ACTION, RANK_ACTION, REVIEW_ACTION, STORY_ACTION, SearchPage, action_data, action_pattern, confirm_data,
+    confirm_inline_keyboard, confirm_pattern, rank_inline_keyboard, search_pages_inline_keyboard,
 )
-from utils import update_confirm_status, with_db
+from utils import chunk_messages, update_confirm_status, with_db
+
+from .pages import authors_keyboard, reviews_keyboard, stories_keyboard
 
 
 ADD_REVIEW = 'add_review'
 LIST_REVIEWS = 'list_reviews'
 REMOVE_REVIEW = 'remove_review'
+SEARCH_REVIEWS = 'search_reviews'
 
 
 # ADD REVIEW -----------------------------------------------------------------------------------------------------------
@@ -26,7 +30,7 @@ ADD_REVIEW_STORY, ADD_REVIEW_RANK, ADD_REVIEW_CONFIRM, ADD_REVIEW_CONFIRM_CALLBA
 
 
 @with_db
-async def add_review(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def add_review(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     if update.message is None:
         return ConversationHandler.END
     if not context.args:
@@ -34,10 +38,10 @@ async def add_review(update: Update, context: CallbackContext.DEFAULT_TYPE, db:
         return ConversationHandler.END
 
     review_text = ' '.join(context.args)
-    review = Review(user, text=review_text)
+    # Keep the text until confirmation instead of passing it through the callback data
+    context.user_data[ADD_REVIEW] = review_text     # type: ignore
 
-    authors = db.list_authors(user)
-    author_markup = authors_inline_keyboard(authors, optional_data=(review,))
+    author_markup = await authors_keyboard(db, user)
 
     await update.message.reply_text(
         'Выбери автора', reply_markup=author_markup,
@@ -46,26 +50,26 @@ async def add_review(update: Update, context: CallbackContext.DEFAULT_TYPE, db:
 
 
 @with_db
-async def add_review_story_callback(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def add_review_story_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     query = update.callback_query
     if query is None:
         return ConversationHandler.END
 
     await query.answer()
 
-    if query.data is None:
-        logging.error('query.data is None in add_review_story_callback()')
+    data = action_data(query.data, AUTHOR_ACTION)
+    if data is None:
+        logging.error(f'unexpected query.data in add_review_story_callback(): {query.data!r}')
         return ConversationHandler.END
 
-    author: Author
-    review: Review
-    author, review = query.data     # type: ignore
-
-    review.author_name = author.name
-    review.author_id = author.id
+    author_id: int
+    author_id, = data
+    author = await db.get_author(user, author_id)
+    if author is None:
+        await query.edit_message_text(text='Такого автора уже нет в базе')
+        return ConversationHandler.END
 
-    stories = db.list_stories(user, author_id=author.id)
-    story_markup = stories_inline_keyboard(stories, optional_data=(review,))
+    story_markup = await stories_keyboard(db, user, author.id)
 
     await query.edit_message_text(
         text=f'Выбери произведение автора `{author.name}`',
@@ -75,61 +79,66 @@ async def add_review_story_callback(update: Update, context: CallbackContext.DEF
 
 
 @with_db
-async def add_review_rank(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def add_review_rank(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     query = update.callback_query
     if query is None:
         return ConversationHandler.END
 
     await query.answer()
 
-    if query.data is None:
-        logging.error('query.data is None in add_review_rank()')
+    data = action_data(query.data, STORY_ACTION)
+    if data is None:
+        logging.error(f'unexpected query.data in add_review_rank(): {query.data!r}')
         return ConversationHandler.END
 
-    story: Story
-    review: Review
-    story, review = query.data      # type: ignore
-
-    review.story_id = story.id
-    review.story_title = story.title
+    story_id: int
+    story_id, = data
+    story = await db.get_story(user, story_id)
+    if story is None:
+        await query.edit_message_text(text='Такого произведения уже нет в базе')
+        return ConversationHandler.END
 
-    rank_markup = rank_inline_keyboard(optional_data=(review,))
+    rank_markup = rank_inline_keyboard(optional_data=(story.id,))
 
     await query.edit_message_text(
-        text=f'Оцени произведение `{review.story_title}` автора `{review.author_name}`',
+        text=f'Оцени произведение `{story.title}` автора `{story.author_name}`',
         reply_markup=rank_markup,
     )
     return ADD_REVIEW_CONFIRM
 
 
 @with_db
-async def add_review_confirm(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def add_review_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     query = update.callback_query
     if query is None:
         return ConversationHandler.END
 
     await query.answer()
 
-    if query.data is None:
-        logging.error('query.data is None in add_review_confirm()')
+    data = action_data(query.data, RANK_ACTION, 2)
+    if data is None:
+        logging.error(f'unexpected query.data in add_review_confirm(): {query.data!r}')
         return ConversationHandler.END
 
     rank: int
-    review: Review
-    rank, review = query.data       # type: ignore
-    review.rank = rank
+    story_id: int
+    rank, story_id = data
+    story = await db.get_story(user, story_id)
+    if story is None:
+        await query.edit_message_text(text='Такого произведения уже нет в базе')
+        return ConversationHandler.END
 
-    confirm_markup = confirm_inline_keyboard(optional_data=(review,))
+    confirm_markup = confirm_inline_keyboard(optional_data=(ADD_REVIEW, story.id, rank))
 
     text = 'Добавить отзыв на произведение `{}` автора `{}` с оценкой `{}`?'.format(
-        review.story_title, review.author_name, review.rank
+        story.title, story.author_name, rank
     )
     await query.edit_message_text(text=text, reply_markup=confirm_markup)
     return ADD_REVIEW_CONFIRM_CALLBACK
 
 
 @with_db
-async def add_review_confirm_callback(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def add_review_confirm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     query = update.callback_query
     if query is None:
         return ConversationHandler.END
@@ -140,17 +149,29 @@ async def add_review_confirm_callback(update: Update, context: CallbackContext.D
         logging.error('query.message is None in add_review_confirm_callback()')
         return ConversationHandler.END
 
-    if query.data is None:
-        logging.error('query.data is None in add_review_confirm_callback()')
+    data = confirm_data(query.data, ADD_REVIEW, 2)
+    if data is None:
+        logging.error(f'unexpected query.data in add_review_confirm_callback(): {query.data!r}')
         return ConversationHandler.END
 
     answer: str
-    review: Review
-    answer, review = query.data     # type: ignore
-
-    if answer == CONFIRM_POSITIVE:
-        db.add_review(review)
-        status_msg = 'добавлен'
+    story_id: int
+    rank: int
+    answer, story_id, rank = data
+    review_text = context.user_data.pop(ADD_REVIEW, None)     # type: ignore
+
+    if review_text is None:
+        status_msg = 'данные устарели, начни заново'
+    elif answer == CONFIRM_POSITIVE:
+        story = await db.get_story(user, story_id)
+        if story is None:
+            status_msg = 'такого произведения уже нет в базе'
+        else:
+            review = Review(user, text=review_text, rank=rank)
+            review.story_id = story.id
+            review.author_id = story.author_id
+            await db.add_review(review)
+            status_msg = 'добавлен'
     else:
         status_msg = 'добавление отменено'
 
@@ -160,16 +181,71 @@ async def add_review_confirm_callback(update: Update, context: CallbackContext.D
 
 
 # LIST REVIEWS ---------------------------------------------------------------------------------------------------------
+def reviews_messages(db: DB, user: User):
+    return chunk_messages(iter_format_reviews(db.iter_reviews(user)), header='Твой список отзывов:\n\n')
+
+
+@with_db
+async def list_reviews(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
+    if update.message is None:
+        return ConversationHandler.END
+
+    async for text in db.stream(reviews_messages, user):
+        await update.message.reply_text(text)
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+# SEARCH REVIEWS -------------------------------------------------------------------------------------------------------
+SEARCH_PAGE_SIZE = 10
+
+
+async def found_reviews_page(db: AsyncDB, user: User, query: str, offset: int):
+    '''Текст и клавиатура страницы результатов поиска; текст None, если на странице ничего нет'''
+    reviews = await db.search_reviews(user, query, offset, SEARCH_PAGE_SIZE + 1)
+    has_more = len(reviews) > SEARCH_PAGE_SIZE
+    reviews = reviews[:SEARCH_PAGE_SIZE]
+    if not reviews:
+        return None, None
+    text = 'Найденные отзывы по запросу `{}`:\n\n{}'.format(query, format_found_reviews(reviews, offset))
+    return text, search_pages_inline_keyboard(query, offset, SEARCH_PAGE_SIZE, has_more)
+
+
 @with_db
-async def list_reviews(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def search_reviews(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     if update.message is None:
         return ConversationHandler.END
+    if not context.args:
+        await update.message.reply_text('Найти отзывы: `/search_reviews QUERY`')
+        return ConversationHandler.END
+
+    query = ' '.join(context.args)
+    text, markup = await found_reviews_page(db, user, query, 0)
+    if text is None:
+        await update.message.reply_text(f'По запросу `{query}` ничего не найдено')
+    else:
+        await update.message.reply_text(text, reply_markup=markup)
+    return ConversationHandler.END
+
+
+@with_db
+async def search_reviews_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
+    query = update.callback_query
+    if query is None:
+        return None
 
-    reviews = db.list_reviews(user)
-    reviews_txt = format_reviews(reviews)
+    await query.answer()
 
-    text = f'Твой список отзывов:\n\n{reviews_txt}'
-    await update.message.reply_text(text)
+    if query.data is None:
+        logging.error('query.data is None in search_reviews_page_callback()')
+        return None
+
+    page: SearchPage = query.data     # type: ignore
+    text, markup = await found_reviews_page(db, user, page.query, page.offset)
+    if text is None:
+        # Reviews have been removed since the previous page was shown
+        text = f'По запросу `{page.query}` больше ничего не найдено'
+    await query.edit_message_text(text=text, reply_markup=markup)
+    return None
 # ----------------------------------------------------------------------------------------------------------------------
 
 
@@ -178,34 +254,37 @@ REMOVE_REVIEW_GET_STORY, REMOVE_REVIEW_GET_REVIEW, REMOVE_REVIEW_CONFIRM, REMOVE
 
 
 @with_db
-async def remove_review(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def remove_review(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     if update.message is None:
         return ConversationHandler.END
 
-    authors = db.list_authors(user)
-    author_markup = authors_inline_keyboard(authors)
+    author_markup = await authors_keyboard(db, user)
 
     await update.message.reply_text('Выбери автора', reply_markup=author_markup)
     return REMOVE_REVIEW_GET_STORY
 
 
 @with_db
-async def remove_review_get_story(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def remove_review_get_story(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     query = update.callback_query
     if query is None:
         return ConversationHandler.END
 
     await query.answer()
 
-    if query.data is None:
-        logging.error('query.data is None in remove_review_get_story()')
+    data = action_data(query.data, AUTHOR_ACTION)
+    if data is None:
+        logging.error(f'unexpected query.data in remove_review_get_story(): {query.data!r}')
         return ConversationHandler.END
 
-    author: Author
-    author, = query.data    # type: ignore
+    author_id: int
+    author_id, = data
+    author = await db.get_author(user, author_id)
+    if author is None:
+        await query.edit_message_text(text='Такого автора уже нет в базе')
+        return ConversationHandler.END
 
-    stories = db.list_stories(user, author.id)
-    story_markup = stories_inline_keyboard(stories, optional_data=(author,))
+    story_markup = await stories_keyboard(db, user, author.id)
 
     await query.edit_message_text(
         text=f'Выбери произведение автора `{author.name}`',
@@ -215,59 +294,65 @@ async def remove_review_get_story(update: Update, context: CallbackContext.DEFAU
 
 
 @with_db
-async def remove_review_get_review(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def remove_review_get_review(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     query = update.callback_query
     if query is None:
         return ConversationHandler.END
 
     await query.answer()
 
-    if query.data is None:
-        logging.error('query.data is None in remove_review_get_review()')
+    data = action_data(query.data, STORY_ACTION)
+    if data is None:
+        logging.error(f'unexpected query.data in remove_review_get_review(): {query.data!r}')
         return ConversationHandler.END
 
-    author: Author
-    story: Story
-    story, author = query.data      # type: ignore
+    story_id: int
+    story_id, = data
+    story = await db.get_story(user, story_id)
+    if story is None:
+        await query.edit_message_text(text='Такого произведения уже нет в базе')
+        return ConversationHandler.END
 
-    reviews = db.list_story_reviews(user, story_id=story.id)
-    review_markup = reviews_inline_keyboard(reviews, optional_data=(author, story))
+    review_markup = await reviews_keyboard(db, user, story.id)
 
     await query.edit_message_text(
-        text=f'Выбери свой отзыв на произведение `{story.title}` автора `{author.name}`',
+        text=f'Выбери свой отзыв на произведение `{story.title}` автора `{story.author_name}`',
         reply_markup=review_markup,
     )
     return REMOVE_REVIEW_CONFIRM
 
 
 @with_db
-async def remove_review_confirm(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def remove_review_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     query = update.callback_query
     if query is None:
         return ConversationHandler.END
 
     await query.answer()
 
-    if query.data is None:
-        logging.error('query.data is None in remove_review_confirm()')
+    data = action_data(query.data, REVIEW_ACTION)
+    if data is None:
+        logging.error(f'unexpected query.data in remove_review_confirm(): {query.data!r}')
         return ConversationHandler.END
 
-    review: Review
-    author: Author
-    story: Story
-    review, author, story = query.data      # type: ignore
+    review_id: int
+    review_id, = data
+    review = await db.get_review(user, review_id)
+    if review is None:
+        await query.edit_message_text(text='Такого отзыва уже нет в базе')
+        return ConversationHandler.END
 
-    confirm_markup = confirm_inline_keyboard(optional_data=(review,))
+    confirm_markup = confirm_inline_keyboard(optional_data=(REMOVE_REVIEW, review.id))
 
     await query.edit_message_text(
-        text=f'Удалить отзыв на произведение `{story.title}` автора `{author.name}`?',
+        text=f'Удалить отзыв на произведение `{review.story_title}` автора `{review.author_name}`?',
         reply_markup=confirm_markup,
     )
     return REMOVE_REVIEW_CONFIRM_CALLBACK
 
 
 @with_db
-async def remove_review_confirm_callback(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def remove_review_confirm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     query = update.callback_query
     if query is None:
         return ConversationHandler.END
@@ -278,16 +363,17 @@ async def remove_review_confirm_callback(update: Update, context: CallbackContex
         logging.error('query.message is None in remove_review_confirm_callback()')
         return ConversationHandler.END
 
-    if query.data is None:
-        logging.error('query.data is None in remove_review_confirm_callback()')
+    data = confirm_data(query.data, REMOVE_REVIEW, 1)
+    if data is None:
+        logging.error(f'unexpected query.data in remove_review_confirm_callback(): {query.data!r}')
         return ConversationHandler.END
 
     answer: str
-    review: Review
-    answer, review = query.data     # type: ignore
+    review_id: int
+    answer, review_id = data
     if answer == CONFIRM_POSITIVE:
-        db.remove_review(user, review.id)
-        status_msg = 'удалён'
+        await db.remove_review(user, review_id)
+        status_msg = 'удалён (вернуть: /undo)'
     else:
         status_msg = 'удаление отменено'
 
@@ -296,27 +382,34 @@ async def remove_review_confirm_callback(update: Update, context: CallbackContex
 # ----------------------------------------------------------------------------------------------------------------------
 
 
-def get_review_handlers(fallback_handler: CommandHandler, cancel_handler: CallbackQueryHandler):
+def get_review_handlers(
+    fallback_handler: CommandHandler, cancel_handler: CallbackQueryHandler, page_handler: CallbackQueryHandler,
+    other_button_handler: CallbackQueryHandler,
+):
     add_review_handler = ConversationHandler(
         entry_points=[CommandHandler(ADD_REVIEW, add_review, filters=~filters.UpdateType.EDITED_MESSAGE)],
         states={
             ADD_REVIEW_STORY: [
-                CallbackQueryHandler(add_review_story_callback, pattern=tuple),
+                page_handler,
+                CallbackQueryHandler(add_review_story_callback, pattern=action_pattern(AUTHOR_ACTION)),
                 cancel_handler,
             ],
             ADD_REVIEW_RANK: [
-                CallbackQueryHandler(add_review_rank, pattern=tuple),
+                page_handler,
+                CallbackQueryHandler(add_review_rank, pattern=action_pattern(STORY_ACTION)),
                 cancel_handler,
             ],
             ADD_REVIEW_CONFIRM: [
-                CallbackQueryHandler(add_review_confirm, pattern=tuple),
+                CallbackQueryHandler(add_review_confirm, pattern=action_pattern(RANK_ACTION, 2)),
                 cancel_handler,
             ],
             ADD_REVIEW_CONFIRM_CALLBACK: [
-                CallbackQueryHandler(add_review_confirm_callback)
+                CallbackQueryHandler(add_review_confirm_callback, pattern=confirm_pattern(ADD_REVIEW, 2)),
             ],
         },
-        fallbacks=[fallback_handler],
+        fallbacks=[fallback_handler, other_button_handler],
+        name=ADD_REVIEW,
+        persistent=True,
     )
 
     list_reviews_handler = CommandHandler(LIST_REVIEWS, list_reviews, filters=~filters.UpdateType.EDITED_MESSAGE)
@@ -325,22 +418,35 @@ def get_review_handlers(fallback_handler: CommandHandler, cancel_handler: Callba
         entry_points=[CommandHandler(REMOVE_REVIEW, remove_review, filters=~filters.UpdateType.EDITED_MESSAGE)],
         states={
             REMOVE_REVIEW_GET_STORY: [
-                CallbackQueryHandler(remove_review_get_story, pattern=tuple),
+                page_handler,
+                CallbackQueryHandler(remove_review_get_story, pattern=action_pattern(AUTHOR_ACTION)),
                 cancel_handler,
             ],
             REMOVE_REVIEW_GET_REVIEW: [
-                CallbackQueryHandler(remove_review_get_review, pattern=tuple),
+                page_handler,
+                CallbackQueryHandler(remove_review_get_review, pattern=action_pattern(STORY_ACTION)),
                 cancel_handler,
             ],
             REMOVE_REVIEW_CONFIRM: [
-                CallbackQueryHandler(remove_review_confirm),
+                page_handler,
+                CallbackQueryHandler(remove_review_confirm, pattern=action_pattern(REVIEW_ACTION)),
                 cancel_handler,
             ],
-            REMOVE_REVIEW_CONFIRM_CALLBACK: [CallbackQueryHandler(remove_review_confirm_callback)],
+            REMOVE_REVIEW_CONFIRM_CALLBACK: [
+                CallbackQueryHandler(remove_review_confirm_callback, pattern=confirm_pattern(REMOVE_REVIEW, 1)),
+            ],
         },
-        fallbacks=[fallback_handler],
+        fallbacks=[fallback_handler, other_button_handler],
+        name=REMOVE_REVIEW,
+        persistent=True,
+    )
+
+    search_reviews_handler = CommandHandler(
+        SEARCH_REVIEWS, search_reviews, filters=~filters.UpdateType.EDITED_MESSAGE
     )
+    search_reviews_page_handler = CallbackQueryHandler(search_reviews_page_callback, pattern=SearchPage)
 
     return [
-        add_review_handler, list_reviews_handler, remove_review_handler
+        add_review_handler, list_reviews_handler, remove_review_handler, search_reviews_handler,
+        search_reviews_page_handler,
     ]
@@ -0,0 +1,33 @@
+from telegram import Update
+from telegram.ext import CommandHandler, ContextTypes, ConversationHandler, filters
+
+from async_db import AsyncDB
+from entities import User
+from formatters import format_stats
+from utils import with_db
+
+
+STATS = 'stats'
+
+
+# STATS ----------------------------------------------------------------------------------------------------------------
+@with_db
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
+    if update.message is None:
+        return ConversationHandler.END
+
+    user_stats = await db.get_stats(user)
+    if not user_stats.reviews:
+        await update.message.reply_text('У тебя пока нет отзывов')
+        return ConversationHandler.END
+
+    await update.message.reply_text(f'Твоя статистика:\n\n{format_stats(user_stats)}')
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def get_stats_handlers():
+    stats_handler = CommandHandler(STATS, stats, filters=~filters.UpdateType.EDITED_MESSAGE)
+
+    return (
+        stats_handler,
+    )
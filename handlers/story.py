@@ -2,16 +2,21 @@ import logging
 
 from telegram import Update
 from telegram.ext import (
-    CallbackContext,
-    CallbackQueryHandler, CommandHandler, ConversationHandler, filters
+    CallbackQueryHandler, CommandHandler, ContextTypes, ConversationHandler, filters
 )
 
+from async_db import AsyncDB
 from consts import CONFIRM_POSITIVE
 from db import DB, INVALID_ID
-from entities import Author, Story, User
-from formatters import format_stories
-from keyboards import authors_inline_keyboard, stories_inline_keyboard, confirm_inline_keyboard
-from utils import update_confirm_status, with_db
+from entities import Story, User
+from formatters import iter_format_stories
+from keyboards import (
+    AUTHOR_ACTION, STORY_ACTION, action_data, action_pattern, confirm_data, confirm_inline_keyboard, confirm_pattern,
+)
+from text_keys import text_key
+from utils import chunk_messages, update_confirm_status, with_db
+
+from .pages import authors_keyboard, stories_keyboard
 
 
 ADD_STORY = 'add_story'
@@ -24,7 +29,7 @@ ADD_STORY_AUTHOR_CONFIRM, ADD_STORY_CONFIRM = range(2)
 
 
 @with_db
-async def add_story(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def add_story(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     if update.message is None:
         return ConversationHandler.END
     if not context.args:
@@ -32,55 +37,75 @@ async def add_story(update: Update, context: CallbackContext.DEFAULT_TYPE, db: D
         return ConversationHandler.END
 
     story_title = ' '.join(context.args)
+    if not text_key(story_title):
+        await update.message.reply_text('В названии произведения должны быть буквы или цифры')
+        return ConversationHandler.END
+
     # Do not check the uniqueness of the story title, because
     # it is possible for different authors to have same-titled stories
-    story = Story(user, title=story_title)
+    context.user_data[ADD_STORY] = story_title      # type: ignore
 
-    authors = db.list_authors(user)
-    author_markup = authors_inline_keyboard(authors, optional_data=(story,))
+    author_markup = await authors_keyboard(db, user)
     await update.message.reply_text(
-        'Кто автор произведения `{}`?'.format(story.title),
+        'Кто автор произведения `{}`?'.format(story_title),
         reply_markup=author_markup,
     )
     return ADD_STORY_AUTHOR_CONFIRM
 
 
 @with_db
-async def add_story_author_confirm_callback(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def add_story_author_confirm_callback(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User
+):
     query = update.callback_query
     if query is None:
         return ConversationHandler.END
 
     await query.answer()
 
-    if query.data is None:
-        logging.error('query.data is None in add_story_author_confirm_callback()')
+    data = action_data(query.data, AUTHOR_ACTION)
+    if data is None:
+        logging.error(f'unexpected query.data in add_story_author_confirm_callback(): {query.data!r}')
+        return ConversationHandler.END
+
+    author_id: int
+    author_id, = data
+
+    story_title = context.user_data.get(ADD_STORY)      # type: ignore
+    if story_title is None:
+        await query.edit_message_text(text='Данные устарели, начни заново')
         return ConversationHandler.END
 
-    story: Story
-    author: Author
+    author = await db.get_author(user, author_id)
+    if author is None:
+        context.user_data.pop(ADD_STORY, None)      # type: ignore
+        await query.edit_message_text(text='Такого автора уже нет в базе')
+        return ConversationHandler.END
 
-    author, story = query.data      # type: ignore
-    story.author_name = author.name
+    story = Story(user, title=story_title, author_name=author.name)
     story.author_id = author.id
 
-    if db.story_id(user, story, author) != INVALID_ID:
+    if await db.story_id(user, story, author) != INVALID_ID:
+        context.user_data.pop(ADD_STORY, None)      # type: ignore
         await query.edit_message_text(
             text=f'Произведение `{story.title}` автора `{author.name}` уже есть в базе',
         )
         return ConversationHandler.END
 
-    confirm_markup = confirm_inline_keyboard(optional_data=(story,))
+    text = f'Добавить произведение `{story.title}` автора `{author.name}`?'
+    similar = await db.similar_stories(user, author.id, story.title)
+    if similar:
+        text += '\n\nПохожие произведения этого автора уже есть в базе: {}'.format(
+            ', '.join(f'`{similar_story.title}`' for similar_story in similar)
+        )
+    confirm_markup = confirm_inline_keyboard(optional_data=(ADD_STORY, author.id))
 
-    await query.edit_message_text(
-        text=f'Добавить произведение `{story.title}` автора `{author.name}`?',
-        reply_markup=confirm_markup,
-    )
+    await query.edit_message_text(text=text, reply_markup=confirm_markup)
     return ADD_STORY_CONFIRM
 
 
 @with_db
-async def add_story_confirm_callback(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def add_story_confirm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     query = update.callback_query
     if query is None:
         return ConversationHandler.END
@@ -91,16 +116,25 @@ async def add_story_confirm_callback(update: Update, context: CallbackContext.DE
         logging.error('query.message is None in add_story_confirm_callback()')
         return ConversationHandler.END
 
-    if query.data is None:
-        logging.error('query.data is None in add_story_confirm_callback')
+    data = confirm_data(query.data, ADD_STORY, 1)
+    if data is None:
+        logging.error(f'unexpected query.data in add_story_confirm_callback(): {query.data!r}')
         return ConversationHandler.END
 
     answer: str
-    story: Story
-    answer, story = query.data      # type: ignore
-    if answer == CONFIRM_POSITIVE:
-        db.add_story(story)
-        status_msg = 'добавлено'
+    author_id: int
+    answer, author_id = data
+    story_title = context.user_data.pop(ADD_STORY, None)      # type: ignore
+
+    if story_title is None:
+        status_msg = 'данные устарели, начни заново'
+    elif answer == CONFIRM_POSITIVE:
+        story = Story(user, title=story_title)
+        story.author_id = author_id
+        if await db.add_story(story):
+            status_msg = 'добавлено'
+        else:
+            status_msg = 'такое произведение уже есть в базе'
     else:
         status_msg = 'добавление отменено'
     await update_confirm_status(query, status_msg)
@@ -108,16 +142,17 @@ async def add_story_confirm_callback(update: Update, context: CallbackContext.DE
 # ----------------------------------------------------------------------------------------------------------------------
 
 # LIST STORIES ---------------------------------------------------------------------------------------------------------
+def stories_messages(db: DB, user: User):
+    return chunk_messages(iter_format_stories(db.iter_stories(user)), header='Твой список произведений:\n\n')
+
+
 @with_db
-async def list_stories(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def list_stories(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     if update.message is None:
         return ConversationHandler.END
 
-    stories = db.list_stories(user)
-    stories_str = format_stories(stories)
-    text = f'Твой список произведений:\n\n{stories_str}'
-
-    await update.message.reply_text(text)
+    async for text in db.stream(stories_messages, user):
+        await update.message.reply_text(text)
 # ----------------------------------------------------------------------------------------------------------------------
 
 
@@ -126,33 +161,36 @@ REMOVE_STORY_GET_AUTHOR_STORY, REMOVE_STORY_CALLBACK, REMOVE_STORY_CONFIRM = ran
 
 
 @with_db
-async def remove_story(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def remove_story(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     if update.message is None:
         return ConversationHandler.END
 
-    authors = db.list_authors(user)
-    author_markup = authors_inline_keyboard(authors)
+    author_markup = await authors_keyboard(db, user)
     await update.message.reply_text('Выбери автора', reply_markup=author_markup)
     return REMOVE_STORY_GET_AUTHOR_STORY
 
 
 @with_db
-async def remove_story_get_author_story(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def remove_story_get_author_story(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     query = update.callback_query
     if query is None:
         return ConversationHandler.END
 
     await query.answer()
 
-    if query.data is None:
-        logging.error('query.data is None in remove_story_get_author_story()')
+    data = action_data(query.data, AUTHOR_ACTION)
+    if data is None:
+        logging.error(f'unexpected query.data in remove_story_get_author_story(): {query.data!r}')
         return ConversationHandler.END
 
-    author: Author
-    author, = query.data    # type: ignore
+    author_id: int
+    author_id, = data
+    author = await db.get_author(user, author_id)
+    if author is None:
+        await query.edit_message_text(text='Такого автора уже нет в базе')
+        return ConversationHandler.END
 
-    stories = db.list_stories(user, author_id=author.id)
-    story_markup = stories_inline_keyboard(stories)
+    story_markup = await stories_keyboard(db, user, author.id)
 
     await query.edit_message_text(
         text=f'Выбери произведение автора`{author.name}`',
@@ -162,21 +200,26 @@ async def remove_story_get_author_story(update: Update, context: CallbackContext
 
 
 @with_db
-async def remove_story_callback(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def remove_story_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     query = update.callback_query
     if query is None:
         return ConversationHandler.END
 
     await query.answer()
 
-    if query.data is None:
-        logging.error('query.data is None in remove_story_callback()')
+    data = action_data(query.data, STORY_ACTION)
+    if data is None:
+        logging.error(f'unexpected query.data in remove_story_callback(): {query.data!r}')
         return ConversationHandler.END
 
-    story: Story
-    story, = query.data     # type: ignore
+    story_id: int
+    story_id, = data
+    story = await db.get_story(user, story_id)
+    if story is None:
+        await query.edit_message_text(text='Такого произведения уже нет в базе')
+        return ConversationHandler.END
 
-    confirm_markup = confirm_inline_keyboard(optional_data=(story,))
+    confirm_markup = confirm_inline_keyboard(optional_data=(REMOVE_STORY, story.id))
 
     await query.edit_message_text(
         text=f'Удалить произведение `{story.title}`? Вместе с ним удалится твоя запись о нём (если она есть)',
@@ -186,7 +229,7 @@ async def remove_story_callback(update: Update, context: CallbackContext.DEFAULT
 
 
 @with_db
-async def remove_story_confirm_callback(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def remove_story_confirm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     query = update.callback_query
     if query is None:
         return ConversationHandler.END
@@ -197,17 +240,18 @@ async def remove_story_confirm_callback(update: Update, context: CallbackContext
         logging.error('query.message is None in remove_story_confirm_callback()')
         return ConversationHandler.END
 
-    if query.data is None:
-        logging.error('query.data is None in remove_story_confirm_callback')
+    data = confirm_data(query.data, REMOVE_STORY, 1)
+    if data is None:
+        logging.error(f'unexpected query.data in remove_story_confirm_callback(): {query.data!r}')
         return ConversationHandler.END
 
     answer: str
-    story: Story
-    answer, story = query.data      # type: ignore
+    story_id: int
+    answer, story_id = data
 
     if answer == CONFIRM_POSITIVE:
-        db.remove_story(user, story.id)
-        status_msg = 'удалено'
+        await db.remove_story(user, story_id)
+        status_msg = 'удалено (вернуть: /undo)'
     else:
         status_msg = 'удаление отменено'
 
@@ -216,17 +260,25 @@ async def remove_story_confirm_callback(update: Update, context: CallbackContext
 # ----------------------------------------------------------------------------------------------------------------------
 
 
-def get_story_handlers(fallback_handler: CommandHandler, cancel_handler: CallbackQueryHandler):
+def get_story_handlers(
+    fallback_handler: CommandHandler, cancel_handler: CallbackQueryHandler, page_handler: CallbackQueryHandler,
+    other_button_handler: CallbackQueryHandler,
+):
     add_story_handler = ConversationHandler(
         entry_points=[CommandHandler(ADD_STORY, add_story, filters=~filters.UpdateType.EDITED_MESSAGE)],
         states={
             ADD_STORY_AUTHOR_CONFIRM: [
-                CallbackQueryHandler(add_story_author_confirm_callback, pattern=tuple),
+                page_handler,
+                CallbackQueryHandler(add_story_author_confirm_callback, pattern=action_pattern(AUTHOR_ACTION)),
                 cancel_handler
             ],
-            ADD_STORY_CONFIRM: [CallbackQueryHandler(add_story_confirm_callback)],
+            ADD_STORY_CONFIRM: [
+                CallbackQueryHandler(add_story_confirm_callback, pattern=confirm_pattern(ADD_STORY, 1)),
+            ],
         },
-        fallbacks=[fallback_handler],
+        fallbacks=[fallback_handler, other_button_handler],
+        name=ADD_STORY,
+        persistent=True,
     )
 
     list_stories_handler = CommandHandler(LIST_STORIES, list_stories, filters=~filters.UpdateType.EDITED_MESSAGE)
@@ -235,16 +287,22 @@ def get_story_handlers(fallback_handler: CommandHandler, cancel_handler: Callbac
         entry_points=[CommandHandler(REMOVE_STORY, remove_story, filters=~filters.UpdateType.EDITED_MESSAGE)],
         states={
             REMOVE_STORY_GET_AUTHOR_STORY: [
-                CallbackQueryHandler(remove_story_get_author_story, pattern=tuple),
+                page_handler,
+                CallbackQueryHandler(remove_story_get_author_story, pattern=action_pattern(AUTHOR_ACTION)),
                 cancel_handler,
             ],
             REMOVE_STORY_CALLBACK: [
-                CallbackQueryHandler(remove_story_callback, pattern=tuple),
+                page_handler,
+                CallbackQueryHandler(remove_story_callback, pattern=action_pattern(STORY_ACTION)),
                 cancel_handler,
             ],
-            REMOVE_STORY_CONFIRM: [CallbackQueryHandler(remove_story_confirm_callback)],
+            REMOVE_STORY_CONFIRM: [
+                CallbackQueryHandler(remove_story_confirm_callback, pattern=confirm_pattern(REMOVE_STORY, 1)),
+            ],
         },
-        fallbacks=[fallback_handler],
+        fallbacks=[fallback_handler, other_button_handler],
+        name=REMOVE_STORY,
+        persistent=True,
     )
 
     return (
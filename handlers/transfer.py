@@ -0,0 +1,126 @@
+import asyncio
+from datetime import date
+
+from telegram import Message, Update
+from telegram.ext import CommandHandler, ContextTypes, ConversationHandler, MessageHandler, filters
+
+from async_db import AsyncDB
+from entities import User
+from exporter import FORMATS, export_diary
+from importer import ImportFileError, parse_import
+from utils import with_db
+
+
+IMPORT = 'import'
+EXPORT = 'export'
+
+# Enough for tens of thousands of rows, the Bot API does not give bots files larger than 20 MB anyway
+IMPORT_MAX_FILE_SIZE = 5 * 1024 * 1024
+# Bots can not upload larger files
+EXPORT_MAX_FILE_SIZE = 50 * 1024 * 1024
+
+
+# IMPORT ---------------------------------------------------------------------------------------------------------------
+IMPORT_DOCUMENT, = range(1)
+
+
+async def import_file(message: Message, db: AsyncDB, user: User):
+    document = message.document
+    if document.file_size is not None and document.file_size > IMPORT_MAX_FILE_SIZE:
+        await message.reply_text(f'Файл слишком большой, максимум {IMPORT_MAX_FILE_SIZE // 1024 // 1024} МБ')
+        return
+
+    file = await document.get_file()
+    data = bytes(await file.download_as_bytearray())
+    try:
+        # Parsing takes a while for big files, the event loop keeps serving other users meanwhile
+        rows, skipped = await asyncio.get_running_loop().run_in_executor(
+            None, parse_import, document.file_name or '', data
+        )
+    except ImportFileError as e:
+        await message.reply_text(f'Не получилось прочитать файл: {e}')
+        return
+    if not rows:
+        await message.reply_text(f'В файле нет ни одной подходящей строки, пропущено строк: {skipped}')
+        return
+
+    # All rows are written by one transaction
+    counts = await db.import_reviews(user, rows)
+    await message.reply_text(
+        'Импорт закончен.\n\nДобавлено авторов: {authors}, произведений: {stories}, отзывов: {reviews}\n'
+        'Уже были в базе отзывов: {duplicates}\nПропущено строк с ошибками: {skipped}'.format(skipped=skipped, **counts)
+    )
+
+
+@with_db
+async def import_diary(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
+    if update.message is None:
+        return ConversationHandler.END
+    if update.message.document is not None:
+        await import_file(update.message, db, user)
+        return ConversationHandler.END
+
+    await update.message.reply_text(
+        'Пришли CSV или JSON файл с колонками Author, Title, My Rating, My Review (как в экспорте Goodreads)'
+    )
+    return IMPORT_DOCUMENT
+
+
+@with_db
+async def import_document(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
+    if update.message is None or update.message.document is None:
+        return ConversationHandler.END
+
+    await import_file(update.message, db, user)
+    return ConversationHandler.END
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+# EXPORT ---------------------------------------------------------------------------------------------------------------
+@with_db
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
+    if update.message is None:
+        return ConversationHandler.END
+
+    fmt = context.args[0].lower().lstrip('.') if context.args else 'csv'
+    if fmt not in FORMATS:
+        await update.message.reply_text('Выгрузить дневник: `/export [{}]`'.format('|'.join(FORMATS)))
+        return ConversationHandler.END
+
+    # The file is written by its own connection in another thread, the database thread keeps serving other users
+    spool = await db.run_reader(export_diary, user, fmt)
+    try:
+        size = spool.seek(0, 2)
+        spool.seek(0)
+        if size > EXPORT_MAX_FILE_SIZE:
+            await update.message.reply_text('Дневник не помещается в один файл, попробуй другой формат')
+            return ConversationHandler.END
+        # python-telegram-bot reads the whole file to upload it anyway (and needs a named file to read it itself)
+        await update.message.reply_document(
+            document=spool.read(), filename=f'diary-{date.today().isoformat()}.{fmt}'
+        )
+    finally:
+        spool.close()
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def get_transfer_handlers(fallback_handler: CommandHandler):
+    import_handler = ConversationHandler(
+        entry_points=[
+            CommandHandler(IMPORT, import_diary, filters=~filters.UpdateType.EDITED_MESSAGE),
+            # A file sent with the command in its caption
+            MessageHandler(filters.Document.ALL & filters.CaptionRegex(rf'^/{IMPORT}\b'), import_diary),
+        ],
+        states={
+            IMPORT_DOCUMENT: [MessageHandler(filters.Document.ALL, import_document)],
+        },
+        fallbacks=[fallback_handler],
+        name=IMPORT,
+        persistent=True,
+    )
+
+    export_handler = CommandHandler(EXPORT, export, filters=~filters.UpdateType.EDITED_MESSAGE)
+
+    return (
+        import_handler, export_handler
+    )
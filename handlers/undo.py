@@ -0,0 +1,38 @@
+import time
+
+from telegram import Update
+from telegram.ext import CommandHandler, ContextTypes, ConversationHandler, filters
+
+from async_db import AsyncDB
+from config import Config
+from entities import Author, Story, User
+from utils import with_db
+
+
+UNDO = 'undo'
+
+
+# UNDO -----------------------------------------------------------------------------------------------------------------
+@with_db
+async def undo(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
+    if update.message is None:
+        return ConversationHandler.END
+
+    restored = await db.undo_remove(user, time.time() - Config.undo_window())
+    if restored is None:
+        await update.message.reply_text('Нечего возвращать')
+    elif isinstance(restored, Author):
+        await update.message.reply_text(f'Автор `{restored.name}` возвращён вместе со всеми записями о нём')
+    elif isinstance(restored, Story):
+        await update.message.reply_text(f'Произведение `{restored.title}` возвращено вместе с отзывами')
+    else:
+        await update.message.reply_text(f'Отзыв на `{restored.story_title}` возвращён')
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def get_undo_handlers():
+    undo_handler = CommandHandler(UNDO, undo, filters=~filters.UpdateType.EDITED_MESSAGE)
+
+    return (
+        undo_handler,
+    )
@@ -0,0 +1,116 @@
+'''Разбор файлов для импорта читательского дневника (/import)
+
+Подходят CSV (например, экспорт Goodreads) и JSON - список объектов с теми же полями.
+Из каждой строки берутся автор, название, текст отзыва и оценка; названия колонок
+сравниваются без учёта регистра, см. `COLUMNS`.
+'''
+import csv
+import io
+import json
+
+from text_keys import text_key
+
+
+# Field -> accepted column names, Goodreads export names go first
+COLUMNS = {
+    'author': ('author', 'author name', 'автор'),
+    'title': ('title', 'story', 'book', 'название', 'произведение'),
+    'text': ('my review', 'review', 'text', 'отзыв'),
+    'rank': ('my rating', 'rating', 'rank', 'оценка'),
+}
+MAX_RANK = 5
+
+
+class ImportFileError(ValueError):
+    '''Файл нельзя разобрать целиком (а не отдельная строка)'''
+
+
+def _records(filename: str, data: bytes) -> list:
+    text = data.decode('utf-8-sig')
+    if filename.lower().endswith('.json') or text.lstrip()[:1] in ('[', '{'):
+        try:
+            records = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise ImportFileError(f'bad JSON: {e}')
+        if isinstance(records, dict):
+            # {"reviews": [...]} or any other single list inside an object
+            records = next((value for value in records.values() if isinstance(value, list)), [])
+        if not isinstance(records, list):
+            raise ImportFileError('JSON must be a list of objects')
+        return records
+
+    # Only the delimiter is guessed, by the header: quoted values may contain anything, even line breaks
+    try:
+        delimiter = csv.Sniffer().sniff(text.partition('\n')[0], delimiters=',;\t').delimiter
+    except csv.Error:
+        delimiter = ','
+    return list(csv.DictReader(io.StringIO(text), delimiter=delimiter))
+
+
+def _field(record: dict, names: tuple):
+    for name in names:
+        value = record.get(name)
+        if value is not None:
+            return value
+    return None
+
+
+def parse_import(filename: str, data: bytes):
+    '''Возвращаем строки (автор, название, текст, оценка) и число пропущенных строк
+
+    Строка пропускается, если в ней нет автора (см. text_key()), оценка не от 0 до 5 или есть отзыв,
+    но нет названия. Отзыв (`text` не None) создаётся, если есть текст или оценка больше 0, иначе
+    импортируются только автор и произведение (`title` - None, если нет и его).
+    Бросает ImportFileError, если файл не удалось разобрать.
+    '''
+    try:
+        records = _records(filename, data)
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise ImportFileError(str(e))
+
+    rows, skipped = [], 0
+    for record in records:
+        if not isinstance(record, dict):
+            skipped += 1
+            continue
+        record = {str(key).strip().lower(): value for key, value in record.items() if key is not None}
+        author, title, text, rank = (_field(record, names) for names in COLUMNS.values())
+        author = str(author or '').strip()
+        title = str(title or '').strip()
+        text = str(text or '').strip()
+        try:
+            rank = int(float(rank or 0))
+        except (TypeError, ValueError, OverflowError):
+            rank = -1
+        if not text_key(author) or not 0 <= rank <= MAX_RANK:
+            skipped += 1
+            continue
+        if not text_key(title):
+            # An author without stories (as /export writes them), but not a review without a story
+            if text or rank:
+                skipped += 1
+            else:
+                rows.append((author, None, None, 0))
+            continue
+        rows.append((author, title, text if text or rank else None, rank))
+    return rows, skipped
+
+
+if __name__ == '__main__':
+    goodreads = (
+        'Book Id,Title,Author,Author l-f,My Rating,My Review\n'
+        '1,Война и мир,Лев Толстой,"Толстой, Лев",5,Отлично\n'
+        '2,Нос,Гоголь,"Гоголь",0,\n'
+        '3,,Гоголь,"Гоголь",3,\n'
+        '5,,Пушкин,"Пушкин",0,\n'
+        '4,Шинель,Гоголь,"Гоголь",7,\n'
+    ).encode()
+    assert parse_import('goodreads.csv', goodreads) == (
+        [('Лев Толстой', 'Война и мир', 'Отлично', 5), ('Гоголь', 'Нос', None, 0), ('Пушкин', None, None, 0)], 2
+    )
+    assert parse_import('diary.csv', 'Author;Title;Review\nГоголь;Нос;"Смешно;\nочень"'.encode()) == (
+        [('Гоголь', 'Нос', 'Смешно;\nочень', 0)], 0
+    )
+    assert parse_import('diary.json', '[{"author": "Гоголь", "title": "Нос", "rank": 4}, 1]'.encode()) == (
+        [('Гоголь', 'Нос', '', 4)], 1
+    )
@@ -1,11 +1,18 @@
 from .author import authors_inline_keyboard
 from .confirm import confirm_inline_keyboard
+from .engine import KeyboardCache
+from .kb_utils import (
+    AUTHOR_ACTION, CANCEL_VALUE, RANK_ACTION, REVIEW_ACTION, STORY_ACTION, Page, SearchPage, action_data,
+    action_pattern, confirm_data, confirm_pattern,
+)
 from .rank import rank_inline_keyboard
-from .review import reviews_inline_keyboard
+from .review import reviews_inline_keyboard, search_pages_inline_keyboard
 from .story import stories_inline_keyboard
 
 
 __all__ = [
     'authors_inline_keyboard', 'confirm_inline_keyboard', 'rank_inline_keyboard', 'reviews_inline_keyboard',
-    'stories_inline_keyboard',
+    'search_pages_inline_keyboard', 'stories_inline_keyboard', 'KeyboardCache', 'Page', 'SearchPage',
+    'AUTHOR_ACTION', 'CANCEL_VALUE', 'RANK_ACTION', 'REVIEW_ACTION', 'STORY_ACTION', 'action_data', 'action_pattern',
+    'confirm_data', 'confirm_pattern',
 ]
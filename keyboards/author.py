@@ -1,20 +1,18 @@
 from typing import List
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import InlineKeyboardButton
 
 from entities import Author
-from utils import reshape
 
-from .kb_utils import callback_args, get_rows_for_cols, CancelButton
+from .engine import list_markup
+from .kb_utils import AUTHOR_ACTION, callback_args
 
 
-def authors_inline_keyboard(authors: List[Author], optional_data=None, add_cancel: bool = True, cols: int = 2):
+def authors_inline_keyboard(
+    authors: List[Author], optional_data=None, add_cancel: bool = True, cols: int = 2, prev_page=None, next_page=None,
+):
     author_buttons = [
-        InlineKeyboardButton(author.name, callback_data=callback_args(author, optional_data)) for author in authors
+        InlineKeyboardButton(author.name, callback_data=callback_args(AUTHOR_ACTION, author.id, optional_data))
+        for author in authors
     ]
-    if add_cancel:
-        author_buttons.append(CancelButton)
-    rows = get_rows_for_cols(len(author_buttons), cols)
-    author_keyboard = reshape(author_buttons, rows, cols)
-    author_markup = InlineKeyboardMarkup(author_keyboard)
-    return author_markup
+    return list_markup(author_buttons, add_cancel, cols, prev_page, next_page)
@@ -2,12 +2,17 @@ from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 from consts import CONFIRM_ANSWERS
 
-from .kb_utils import callback_args
+from .engine import static_keyboard
+from .kb_utils import CONFIRM_ACTION, callback_args
 
 
+@static_keyboard
 def confirm_inline_keyboard(optional_data=None):
     confirm_reply_keyboard = [
-        [InlineKeyboardButton(text, callback_data=callback_args(text, optional_data)) for text in CONFIRM_ANSWERS]
+        [
+            InlineKeyboardButton(text, callback_data=callback_args(CONFIRM_ACTION, text, optional_data))
+            for text in CONFIRM_ANSWERS
+        ]
     ]
     confirm_markup = InlineKeyboardMarkup(confirm_reply_keyboard)
     return confirm_markup
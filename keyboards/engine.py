@@ -0,0 +1,74 @@
+'''Построение inline-клавиатур
+
+* layout() раскладывает кнопки по строкам срезами, за один проход;
+* клавиатуры, кнопки которых зависят только от аргументов (оценка, подтверждение), строятся один раз
+  для каждого набора аргументов (static_keyboard);
+* клавиатуры списков пользователя хранятся в KeyboardCache, пока версия его библиотеки
+  (CachedDB.version()) не изменилась.
+
+Клавиатуры можно отдавать повторно: InlineKeyboardMarkup неизменяем, а CallbackDataCache при отправке
+строит новую клавиатуру со своими данными кнопок и переданную не трогает.
+'''
+from functools import lru_cache
+
+from telegram import InlineKeyboardMarkup
+
+from cache import LRUCache
+
+from .kb_utils import CancelButton, page_buttons
+
+
+# Static keyboards differ only by the ids in their callback data
+STATIC_KEYBOARDS_CACHE_SIZE = 1024
+
+
+def layout(buttons: list, cols: int) -> list:
+    '''
+    layout([1,2,3,4,5], 2) -> [[1,2], [3,4], [5]]
+    '''
+    return [buttons[i:i + cols] for i in range(0, len(buttons), cols)]
+
+
+def list_markup(buttons: list, add_cancel: bool, cols: int, prev_page=None, next_page=None) -> InlineKeyboardMarkup:
+    '''Кнопки списка по `cols` в строке, затем "Отмена" и кнопки перехода на соседние страницы'''
+    if add_cancel:
+        buttons.append(CancelButton)
+    keyboard = layout(buttons, cols)
+    nav_buttons = page_buttons(prev_page, next_page)
+    if nav_buttons:
+        keyboard.append(nav_buttons)
+    return InlineKeyboardMarkup(keyboard)
+
+
+def static_keyboard(build):
+    '''Запоминаем клавиатуры, которые зависят только от аргументов `build` (они должны быть хешируемыми)'''
+    return lru_cache(maxsize=STATIC_KEYBOARDS_CACHE_SIZE)(build)
+
+
+class KeyboardCache:
+    '''Клавиатуры списков по (пользователь, ключ) вместе с версией библиотеки, для которой они построены'''
+
+    def __init__(self, maxsize: int):
+        self.cache = LRUCache(maxsize)
+
+    async def get(self, user_id: int, version, key: tuple, build):
+        '''Клавиатура из кэша или `await build()`
+
+        `version` берётся до чтения из БД, так что клавиатура, построенная одновременно с записью,
+        сохраняется со старой версией и больше не отдаётся. None - версий нет, клавиатура не запоминается.
+        '''
+        if version is None:
+            return await build()
+        entry = self.cache.get((user_id,) + key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        markup = await build()
+        self.cache.put((user_id,) + key, (version, markup))
+        return markup
+
+
+if __name__ == '__main__':
+    assert layout([1, 2, 3, 4, 5, 6], 3) == [[1, 2, 3], [4, 5, 6]]
+    assert layout([1, 2, 3, 4, 5, 6], 2) == [[1, 2], [3, 4], [5, 6]]
+    assert layout([1, 2, 3, 4, 5, 6, 7], 3) == [[1, 2, 3], [4, 5, 6], [7]]
+    assert layout([], 3) == []
@@ -1,20 +1,79 @@
 from telegram import InlineKeyboardButton
 
 
-def callback_args(base, optional=None):
+# Action codes are the first item of the callback data of each button.
+# Callback data holds only ids and other short values, entities are loaded from db when the button is pressed.
+AUTHOR_ACTION = 'a'
+STORY_ACTION = 's'
+REVIEW_ACTION = 'r'
+RANK_ACTION = 'k'
+CONFIRM_ACTION = 'c'
+
+
+def callback_args(action: str, base, optional=None):
     if not optional:
-        return (base,)
+        return (action, base)
     else:
-        return (base,) + optional
+        return (action, base) + optional
+
+
+def action_data(data, action: str, size: int = 1):
+    '''Данные кнопки без кода действия или None, если это не кнопка `action` с `size` значениями'''
+    if isinstance(data, tuple) and len(data) == size + 1 and data[0] == action:
+        return data[1:]
+    return None
+
+
+def confirm_data(data, dialog: str, size: int = 0):
+    '''(ответ, *значения) кнопки подтверждения диалога `dialog` или None, если кнопка другая
+
+    Диалог хранится в данных кнопки первым после ответа, потому что все кнопки подтверждения
+    одного вида и по числу значений их не отличить.
+    '''
+    values = action_data(data, CONFIRM_ACTION, size + 2)
+    if values is None or values[1] != dialog:
+        return None
+    return (values[0],) + values[2:]
+
+
+def action_pattern(action: str, size: int = 1):
+    '''`pattern` для CallbackQueryHandler, который пропускает только кнопки `action` с `size` значениями'''
+    return lambda data: action_data(data, action, size) is not None
+
+
+def confirm_pattern(dialog: str, size: int = 0):
+    '''`pattern` для CallbackQueryHandler, который пропускает только кнопки подтверждения диалога `dialog`'''
+    return lambda data: confirm_data(data, dialog, size) is not None
+
+
+class Page:
+    '''Данные кнопки перехода на соседнюю страницу списка'''
+    def __init__(self, kind: str, scope: int, cursor: tuple, backward: bool, optional_data=None):
+        self.kind = kind
+        self.scope = scope
+        self.cursor = cursor
+        self.backward = backward
+        self.optional_data = optional_data
+
+
+class SearchPage:
+    '''Данные кнопки перехода на соседнюю страницу результатов поиска'''
+    def __init__(self, query: str, offset: int):
+        self.query = query
+        self.offset = offset
 
 
-def get_rows_for_cols(length: int, cols: int) -> int:
-    '''Calculate minimal `rows` such that rows*cols >= length'''
-    rows = length // cols + int(length % cols > 0)
-    return rows
+def page_buttons(prev_page=None, next_page=None) -> list:
+    buttons = []
+    if prev_page is not None:
+        buttons.append(InlineKeyboardButton('«', callback_data=prev_page))
+    if next_page is not None:
+        buttons.append(InlineKeyboardButton('»', callback_data=next_page))
+    return buttons
 
 
-CANCEL_VALUE = object()
+# Not a tuple, so that it does not match the action patterns (see action_pattern)
+CANCEL_VALUE = 'cancel'
 
 
 CancelButton = InlineKeyboardButton('Отмена', callback_data=CANCEL_VALUE)
@@ -3,18 +3,24 @@ from typing import List
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 from entities import Review
-from utils import reshape
 
-from .kb_utils import callback_args, CancelButton, get_rows_for_cols
+from .engine import list_markup
+from .kb_utils import REVIEW_ACTION, SearchPage, callback_args, page_buttons
 
 
-def reviews_inline_keyboard(reviews: List[Review], optional_data=None, add_cancel: bool = True, cols: int = 2):
+def reviews_inline_keyboard(
+    reviews: List[Review], optional_data=None, add_cancel: bool = True, cols: int = 2, prev_page=None, next_page=None,
+):
     review_buttons = [
-        InlineKeyboardButton(review.text[:15], callback_data=callback_args(review, optional_data)) for review in reviews
+        InlineKeyboardButton(review.text[:15], callback_data=callback_args(REVIEW_ACTION, review.id, optional_data))
+        for review in reviews
     ]
-    if add_cancel:
-        review_buttons.append(CancelButton)
-    rows = get_rows_for_cols(len(review_buttons), cols)
-    review_keyboard = reshape(review_buttons, rows, cols)
-    review_markup = InlineKeyboardMarkup(review_keyboard)
-    return review_markup
+    return list_markup(review_buttons, add_cancel, cols, prev_page, next_page)
+
+
+def search_pages_inline_keyboard(query: str, offset: int, page_size: int, has_more: bool):
+    '''Кнопки перехода между страницами результатов поиска; None, если страница одна'''
+    prev_page = SearchPage(query, max(0, offset - page_size)) if offset > 0 else None
+    next_page = SearchPage(query, offset + page_size) if has_more else None
+    nav_buttons = page_buttons(prev_page, next_page)
+    return InlineKeyboardMarkup([nav_buttons]) if nav_buttons else None
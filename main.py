@@ -1,21 +1,27 @@
+import asyncio
+from functools import partial
 import logging
+import time
 
 from telegram import Update
-from telegram.ext import ApplicationBuilder, CallbackContext, CommandHandler, ConversationHandler
+from telegram.ext import Application, ApplicationBuilder, CommandHandler, ContextTypes, ConversationHandler
+from telegram.request import HTTPXRequest
 
+from async_db import AsyncDB
+from callback_cache import DiaryBot
 from config import Config
-from db import DB
 from entities import User
-from handlers import (
-    get_author_handlers, get_review_handlers, get_story_handlers,
-    get_cancel_handler, get_fallback_handler,
-)
+import metrics
+from persistence import SQLitePersistence
+from send_scheduler import SendScheduler
+from update_processor import PerUserUpdateProcessor
 from utils import with_db
+from workers import build_front
 
 
 # ENTRY POINT ------------------------------------------------------------------
 @with_db
-async def start(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, user: User):
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDB, user: User):
     if update.message is None:
         return ConversationHandler.END
 
@@ -28,29 +34,131 @@ async def start(update: Update, context: CallbackContext.DEFAULT_TYPE, db: DB, u
 # ------------------------------------------------------------------------------
 
 
-if __name__ == '__main__':
-    logging.basicConfig(
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.INFO
+# Task of purge_removed() in bot_data
+PURGE_TASK = 'purge_task'
+
+
+async def purge_removed(db: AsyncDB):
+    '''Время от времени окончательно удаляем то, что уже нельзя вернуть командой /undo'''
+    while True:
+        await asyncio.sleep(Config.purge_interval())
+        try:
+            purged = await db.purge_removed(time.time() - Config.undo_window())
+        except Exception:
+            logging.exception('Failed to purge removed authors, stories and reviews')
+            continue
+        if purged:
+            logging.info(f'Purged {purged} removed authors, stories and reviews')
+
+
+async def post_init(application: Application, worker: int = 0):
+    port = Config.metrics_port()
+    if port is not None:
+        # Every worker process serves its own metrics on the next port
+        await metrics.start_server(Config.metrics_host(), port + worker)
+    # The purge covers all users, one worker is enough
+    if worker == 0:
+        application.bot_data[PURGE_TASK] = asyncio.create_task(purge_removed(Config.async_db()))
+
+
+async def shutdown(application: Application):
+    await metrics.stop_server()
+    purge_task = application.bot_data.pop(PURGE_TASK, None)
+    if purge_task is not None:
+        purge_task.cancel()
+        try:
+            await purge_task
+        except asyncio.CancelledError:
+            pass
+    await Config.async_db().close()
+
+
+def build_bot() -> DiaryBot:
+    return DiaryBot(
+        Config.token(),
+        base_url=Config.api_base_url(),
+        arbitrary_callback_data=Config.callback_data_cache_size(),
+        # Same pool sizes as ApplicationBuilder uses by default
+        request=HTTPXRequest(connection_pool_size=256),
+        get_updates_request=HTTPXRequest(connection_pool_size=1),
+        # Chats of a user are served by one worker process, the bot-wide limit is shared by all of them
+        rate_limiter=SendScheduler(
+            Config.rate_limit() / Config.workers(), Config.chat_rate_limit(), Config.chat_burst()
+        ),
     )
 
-    # Prepare database
-    Config.db().prepare()
 
-    application = ApplicationBuilder().token(Config.token()).arbitrary_callback_data(True).build()
+def build_application(bot: DiaryBot, worker: int = 0) -> Application:
+    '''Собираем приложение со всеми обработчиками бота; `worker` - номер процесса-обработчика (см. workers.py)'''
+    # Handlers and keyboards are imported only here: the front process of the multi-process mode needs none of them
+    from handlers import (
+        get_author_handlers, get_review_handlers, get_stats_handlers, get_story_handlers, get_transfer_handlers,
+        get_undo_handlers, get_cancel_handler, get_fallback_handler, get_invalid_button_handler, get_page_handler,
+        get_other_button_handler,
+    )
+
+    application = (
+        ApplicationBuilder()
+        .bot(bot)
+        .concurrent_updates(PerUserUpdateProcessor(Config.concurrency()))
+        .persistence(SQLitePersistence(
+            Config.async_db(), update_interval=Config.persistence_interval(), worker=worker
+        ))
+        .post_init(partial(post_init, worker=worker))
+        .post_shutdown(shutdown)
+        .build()
+    )
 
     fallback_handler = get_fallback_handler()
     cancel_handler = get_cancel_handler()
+    page_handler = get_page_handler()
+    other_button_handler = get_other_button_handler()
 
     start_handler = CommandHandler('start', start)
     application.add_handler(start_handler)
+    # Checked before all other handlers
+    application.add_handler(get_invalid_button_handler(), group=-1)
 
-    author_handlers = get_author_handlers(fallback_handler, cancel_handler)
-    story_handlers = get_story_handlers(fallback_handler, cancel_handler)
-    review_handlers = get_review_handlers(fallback_handler, cancel_handler)
+    author_handlers = get_author_handlers(fallback_handler, cancel_handler, page_handler, other_button_handler)
+    story_handlers = get_story_handlers(fallback_handler, cancel_handler, page_handler, other_button_handler)
+    review_handlers = get_review_handlers(fallback_handler, cancel_handler, page_handler, other_button_handler)
 
     application.add_handlers(author_handlers)
     application.add_handlers(story_handlers)
     application.add_handlers(review_handlers)
+    application.add_handlers(get_stats_handlers())
+    application.add_handlers(get_undo_handlers())
+    application.add_handlers(get_transfer_handlers(fallback_handler))
+
+    return application
+
+
+def run(application: Application):
+    '''Получаем обновления от Telegram так, как задано в BOT_MODE'''
+    if Config.mode() == 'webhook':
+        application.run_webhook(
+            listen=Config.webhook_listen(),
+            port=Config.webhook_port(),
+            url_path=Config.webhook_path(),
+            webhook_url=Config.webhook_url(),
+            secret_token=Config.webhook_secret(),
+        )
+    else:
+        application.run_polling()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    # Prepare database
+    Config.db().prepare()
 
-    application.run_polling()
+    if Config.workers() > 1:
+        # Updates are received here and handled by worker processes
+        application = build_front(Config.workers())
+    else:
+        application = build_application(build_bot())
+    run(application)
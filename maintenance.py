@@ -0,0 +1,58 @@
+'''Обслуживание БД бота; можно запускать, пока бот работает
+
+    python maintenance.py check-stats            # сравнить таблицы статистики с отзывами
+    python maintenance.py check-stats --rebuild  # и пересчитать их, если они разошлись
+    python maintenance.py rebuild-stats          # пересчитать в любом случае
+    python maintenance.py rebalance --shards 4   # разложить пользователей по шардам (только при остановленном боте)
+'''
+import argparse
+import logging
+import os
+
+from db import DB
+from sharding import ShardedDB, shard_paths
+
+
+def check_stats(db: DB, rebuild: bool) -> int:
+    mismatches = db.check_stats()
+    for table, rows in mismatches.items():
+        print(f'{table}: {rows} mismatched rows')
+    if not any(mismatches.values()):
+        print('Statistics are consistent with reviews')
+        return 0
+    if rebuild:
+        db.rebuild_stats()
+        print('Statistics have been rebuilt')
+        return 0
+    return 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=('check-stats', 'rebuild-stats', 'rebalance'))
+    parser.add_argument('--db', default=os.environ.get('BOT_DB'), help='path to the database (default: $BOT_DB)')
+    parser.add_argument(
+        '--shards', type=int, default=int(os.environ.get('BOT_DB_SHARDS', 1)),
+        help='number of database shards (default: $BOT_DB_SHARDS or 1)'
+    )
+    parser.add_argument('--rebuild', action='store_true', help='rebuild statistics if they are inconsistent')
+    args = parser.parse_args()
+    if args.db is None:
+        parser.error('set BOT_DB or pass --db')
+
+    logging.basicConfig(level=logging.INFO)
+    db = ShardedDB(shard_paths(args.db, args.shards)) if args.shards > 1 else DB(args.db)
+    db.prepare()
+    if args.command == 'rebalance':
+        if args.shards < 2:
+            parser.error('rebalance needs --shards 2 or more')
+        print(f'Moved {db.rebalance()} users')
+        return
+    if args.command == 'check-stats':
+        raise SystemExit(check_stats(db, args.rebuild))
+    db.rebuild_stats()
+    print('Statistics have been rebuilt')
+
+
+if __name__ == '__main__':
+    main()
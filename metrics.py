@@ -0,0 +1,198 @@
+import asyncio
+from bisect import bisect_left
+import logging
+import time
+
+
+# Upper bounds of histogram buckets in seconds, from a cached read to a slow fsync
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    '''Счётчик с метками в формате Prometheus'''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} counter'
+        for labels, value in list(self._values.items()):
+            yield f'{self.name}{_format_labels(self.labelnames, labels)} {value}'
+
+
+class Histogram:
+    '''Гистограмма с метками в формате Prometheus
+
+    Наблюдение - это bisect и пара сложений, так что её можно оставлять включённой всегда.
+    '''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [counts per bucket (the last one is +Inf), sum]
+        self._values = {}
+
+    def observe(self, *labels, value: float):
+        data = self._values.get(labels)
+        if data is None:
+            data = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        data[0][bisect_left(self.buckets, value)] += 1
+        data[1] += value
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} histogram'
+        for labels, (counts, total) in list(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), list(counts)):
+                cumulative += count
+                bucket_labels = _format_labels(self.labelnames + ('le',), labels + (bound,))
+                yield f'{self.name}_bucket{bucket_labels} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labelnames, labels)} {total}'
+            yield f'{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}'
+
+
+class CacheMetrics:
+    '''Размер и счётчики обращений кэшей: значения берутся из их stats() при каждом чтении метрик'''
+
+    # stats() key -> (metric name suffix, type, documentation)
+    FIELDS = {
+        'size': ('size', 'gauge', 'Entries in the cache'),
+        'maxsize': ('maxsize', 'gauge', 'Max entries in the cache'),
+        'hits': ('hits_total', 'counter', 'Lookups that found the entry in the cache'),
+        'misses': ('misses_total', 'counter', 'Lookups that did not find the entry in the cache'),
+        'evictions': ('evictions_total', 'counter', 'Entries evicted to keep the cache within its size'),
+    }
+
+    def __init__(self, name: str):
+        self.name = name
+        self._caches = {}
+
+    def register(self, cache: str, stats):
+        '''`stats()` возвращает словарь со счётчиками кэша (см. LRUCache.stats()); имя `cache` - значение метки'''
+        self._caches[cache] = stats
+
+    def collect(self):
+        snapshots = {cache: stats() for cache, stats in list(self._caches.items())}
+        for key, (suffix, kind, documentation) in self.FIELDS.items():
+            yield f'# HELP {self.name}_{suffix} {documentation}'
+            yield f'# TYPE {self.name}_{suffix} {kind}'
+            for cache, snapshot in snapshots.items():
+                if key in snapshot:
+                    yield f'{self.name}_{suffix}{_format_labels(("cache",), (cache,))} {snapshot[key]}'
+
+
+# Metrics are updated from the event loop and from the database thread without locks: under the GIL
+# a race can at worst lose a single increment, which is fine for monitoring and keeps the hot path cheap.
+
+HANDLER_SECONDS = Histogram('diary_handler_seconds', 'Handler execution time', ('handler',))
+HANDLER_ERRORS = Counter('diary_handler_errors_total', 'Handlers that raised an exception', ('handler',))
+TRANSITIONS = Counter(
+    'diary_conversation_transitions_total', 'Conversation states returned by handlers', ('handler', 'state')
+)
+DB_QUERY_SECONDS = Histogram('diary_db_query_seconds', 'Database method execution time', ('query',))
+DB_READER_WAIT_SECONDS = Histogram(
+    'diary_db_reader_wait_seconds', 'Time a read waited for a free connection of the reader pool', ('pool',)
+)
+API_REQUEST_SECONDS = Histogram(
+    'diary_api_request_seconds', 'Bot API request time, including waiting for the rate limits', ('endpoint',)
+)
+API_EVENTS = Counter(
+    'diary_api_events_total', 'Bot API requests retried after flood control or failed in background',
+    ('endpoint', 'event')
+)
+CACHES = CacheMetrics('diary_cache')
+
+REGISTRY = [
+    HANDLER_SECONDS, HANDLER_ERRORS, TRANSITIONS, DB_QUERY_SECONDS, DB_READER_WAIT_SECONDS, API_REQUEST_SECONDS,
+    API_EVENTS, CACHES,
+]
+
+
+def state_label(state) -> str:
+    '''Метка состояния диалога: None - остаться в текущем, -1 - ConversationHandler.END'''
+    if state is None:
+        return 'same'
+    if state == -1:
+        return 'end'
+    return str(state)
+
+
+def timed_query(fn, *args, **kwargs):
+    '''Вызываем метод БД, записывая время его выполнения под его именем'''
+    start = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        DB_QUERY_SECONDS.observe(fn.__name__, value=time.perf_counter() - start)
+
+
+def render() -> str:
+    return '\n'.join(line for metric in REGISTRY for line in metric.collect()) + '\n'
+
+
+async def _serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        # Skip headers, the request has no body
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+            status, body = '200 OK', render().encode()
+        else:
+            status, body = '404 Not Found', b'Not found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+_server = None
+
+
+async def start_server(host: str, port: int):
+    '''Отдаём метрики по HTTP на http://host:port/metrics'''
+    global _server
+    _server = await asyncio.start_server(_serve, host, port)
+    logging.info(f'Serving metrics on http://{host}:{port}/metrics')
+
+
+async def stop_server():
+    global _server
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
+
+
+if __name__ == '__main__':
+    HANDLER_SECONDS.observe('start', value=0.003)
+    TRANSITIONS.inc('add_author', state_label(None))
+    text = render()
+    assert 'diary_handler_seconds_bucket{handler="start",le="0.005"} 1' in text
+    assert 'diary_handler_seconds_bucket{handler="start",le="0.0025"} 0' in text
+    assert 'diary_handler_seconds_count{handler="start"} 1' in text
+    assert 'diary_conversation_transitions_total{handler="add_author",state="same"} 1' in text
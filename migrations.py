@@ -0,0 +1,530 @@
+import logging
+import sqlite3
+
+from text_keys import text_key
+
+
+# Tables of review statistics: columns and the query that computes them from reviews (see DB.check_stats())
+STATS_TABLES = {
+    'rank_stats': (
+        'user_id, rank, reviews',
+        '''
+        SELECT review.user_id, review.rank, COUNT(*)
+        FROM review JOIN story ON (review.user_id == story.user_id) AND (review.story_id == story.id)
+        GROUP BY review.user_id, review.rank
+        ''',
+    ),
+    'author_stats': (
+        'author_id, user_id, reviews, rank_sum',
+        '''
+        SELECT story.author_id, review.user_id, COUNT(*), SUM(review.rank)
+        FROM review JOIN story ON (review.user_id == story.user_id) AND (review.story_id == story.id)
+        GROUP BY story.author_id
+        ''',
+    ),
+    'story_stats': (
+        'story_id, user_id, author_id, reviews, rank_sum',
+        '''
+        SELECT story.id, review.user_id, story.author_id, COUNT(*), SUM(review.rank)
+        FROM review JOIN story ON (review.user_id == story.user_id) AND (review.story_id == story.id)
+        GROUP BY story.id
+        ''',
+    ),
+}
+# Recompute the tables of review statistics from scratch
+STATS_REBUILD = [f'DELETE FROM {table}' for table in STATS_TABLES] + [
+    f'INSERT INTO {table} ({columns}) {query}' for table, (columns, query) in STATS_TABLES.items()
+]
+
+
+# Since migration 8 removed reviews, stories and authors (see DB.remove_author()) are not counted.
+# DB.check_stats() and DB.rebuild_stats() compare and recompute the statistics by these versions.
+_COUNTED_REVIEWS_8 = '''
+        FROM review
+        JOIN story ON (review.user_id == story.user_id) AND (review.story_id == story.id)
+        LEFT JOIN author ON (story.user_id == author.user_id) AND (story.author_id == author.id)
+        WHERE review.removed_at IS NULL AND story.removed_at IS NULL AND author.removed_at IS NULL
+'''
+STATS_TABLES_8 = {
+    'rank_stats': (
+        'user_id, rank, reviews',
+        f'''
+        SELECT review.user_id, review.rank, COUNT(*) {_COUNTED_REVIEWS_8}
+        GROUP BY review.user_id, review.rank
+        ''',
+    ),
+    'author_stats': (
+        'author_id, user_id, reviews, rank_sum',
+        f'''
+        SELECT story.author_id, review.user_id, COUNT(*), SUM(review.rank) {_COUNTED_REVIEWS_8}
+        GROUP BY story.author_id
+        ''',
+    ),
+    'story_stats': (
+        'story_id, user_id, author_id, reviews, rank_sum',
+        f'''
+        SELECT story.id, review.user_id, story.author_id, COUNT(*), SUM(review.rank) {_COUNTED_REVIEWS_8}
+        GROUP BY story.id
+        ''',
+    ),
+}
+STATS_REBUILD_8 = [f'DELETE FROM {table}' for table in STATS_TABLES_8] + [
+    f'INSERT INTO {table} ({columns}) {query}' for table, (columns, query) in STATS_TABLES_8.items()
+]
+
+# Every item is a list of statements that upgrades the schema by one version.
+# Version number of the schema is stored in `PRAGMA user_version`, so the
+# migration at index `i` brings the database from version `i` to `i + 1`.
+MIGRATIONS = [
+    # 1: initial schema (also matches databases created before migrations were introduced)
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS user
+        (
+            id INTEGER PRIMARY KEY
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS author
+        (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            name TEXT,
+            FOREIGN KEY(user_id) REFERENCES user(id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS story
+        (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            title TEXT NOT NULL,
+            author_id INTEGER,
+            FOREIGN KEY(author_id) REFERENCES author(id),
+            FOREIGN KEY(user_id) REFERENCES user(id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS review
+        (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            story_id INTEGER,
+            text TEXT NOT NULL,
+            rank INTEGER NOT NULL CHECK(rank >= 0 AND rank <= 5),
+            FOREIGN KEY(user_id) REFERENCES user(id),
+            FOREIGN KEY(story_id) REFERENCES story(id)
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS on_author_delete
+        AFTER DELETE ON author
+        FOR EACH ROW
+        BEGIN
+            DELETE FROM story WHERE story.user_id == OLD.user_id AND story.author_id == OLD.id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS on_story_delete
+        AFTER DELETE ON story
+        FOR EACH ROW
+        BEGIN
+            DELETE FROM review WHERE review.user_id == OLD.user_id AND review.story_id == OLD.id;
+        END
+        ''',
+    ],
+    # 2: lookup indexes and uniqueness of authors and stories
+    [
+        # Merge duplicated authors into the oldest one before adding the UNIQUE index
+        '''
+        UPDATE story SET author_id = (
+            SELECT MIN(dup.id) FROM author
+            JOIN author AS dup ON (dup.user_id == author.user_id) AND (dup.name == author.name)
+            WHERE author.id == story.author_id
+        )
+        WHERE author_id IN (SELECT id FROM author)
+        ''',
+        '''
+        DELETE FROM author WHERE id NOT IN (SELECT MIN(id) FROM author GROUP BY user_id, name)
+        ''',
+        # Same for stories of the same author
+        '''
+        UPDATE review SET story_id = (
+            SELECT MIN(dup.id) FROM story
+            JOIN story AS dup ON
+                (dup.user_id == story.user_id) AND (dup.author_id == story.author_id) AND (dup.title == story.title)
+            WHERE story.id == review.story_id
+        )
+        WHERE story_id IN (SELECT id FROM story)
+        ''',
+        '''
+        DELETE FROM story WHERE id NOT IN (SELECT MIN(id) FROM story GROUP BY user_id, author_id, title)
+        ''',
+        '''CREATE UNIQUE INDEX IF NOT EXISTS author_user_name ON author (user_id, name)''',
+        '''CREATE UNIQUE INDEX IF NOT EXISTS story_user_author_title ON story (user_id, author_id, title)''',
+        '''CREATE INDEX IF NOT EXISTS review_user_story ON review (user_id, story_id)''',
+    ],
+    # 3: bot state that survives restarts (see persistence.py), values are pickled
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS user_data
+        (
+            user_id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS conversation
+        (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state BLOB NOT NULL,
+            PRIMARY KEY (name, key)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS callback_keyboard
+        (
+            uuid TEXT PRIMARY KEY,
+            access_time REAL NOT NULL,
+            data BLOB NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS callback_query
+        (
+            id TEXT PRIMARY KEY,
+            keyboard_uuid TEXT NOT NULL
+        )
+        ''',
+    ],
+    # 4: full-text index of review texts, kept in sync with the review table by triggers
+    # (including deletes cascaded from story and author)
+    [
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS review_fts USING fts5
+        (
+            text,
+            content='review',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS review_fts_insert
+        AFTER INSERT ON review
+        BEGIN
+            INSERT INTO review_fts (rowid, text) VALUES (NEW.id, NEW.text);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS review_fts_delete
+        AFTER DELETE ON review
+        BEGIN
+            INSERT INTO review_fts (review_fts, rowid, text) VALUES ('delete', OLD.id, OLD.text);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS review_fts_update
+        AFTER UPDATE OF text ON review
+        BEGIN
+            INSERT INTO review_fts (review_fts, rowid, text) VALUES ('delete', OLD.id, OLD.text);
+            INSERT INTO review_fts (rowid, text) VALUES (NEW.id, NEW.text);
+        END
+        ''',
+        # Index reviews written before this version
+        '''INSERT INTO review_fts (review_fts) VALUES ('rebuild')''',
+    ],
+    # 5: authors and stories are unique by a normalized key (see text_keys.py) instead of the exact text,
+    # plus trigram indexes of the keys for "did you mean" suggestions
+    [
+        '''ALTER TABLE author ADD COLUMN name_key TEXT''',
+        '''ALTER TABLE story ADD COLUMN title_key TEXT''',
+        '''UPDATE author SET name_key = text_key(name)''',
+        '''UPDATE story SET title_key = text_key(title)''',
+        # Stories of merged authors may get the same title, the unique index is restored below
+        '''DROP INDEX IF EXISTS story_user_author_title''',
+        # Merge authors with the same key into the oldest one, then stories with the same key (as in version 2)
+        '''
+        UPDATE story SET author_id = (
+            SELECT MIN(dup.id) FROM author
+            JOIN author AS dup ON (dup.user_id == author.user_id) AND (dup.name_key == author.name_key)
+            WHERE author.id == story.author_id
+        )
+        WHERE author_id IN (SELECT id FROM author)
+        ''',
+        '''
+        DELETE FROM author WHERE id NOT IN (SELECT MIN(id) FROM author GROUP BY user_id, name_key)
+        ''',
+        '''
+        UPDATE review SET story_id = (
+            SELECT MIN(dup.id) FROM story
+            JOIN story AS dup ON
+                (dup.user_id == story.user_id) AND (dup.author_id == story.author_id)
+                AND (dup.title_key == story.title_key)
+            WHERE story.id == review.story_id
+        )
+        WHERE story_id IN (SELECT id FROM story)
+        ''',
+        '''
+        DELETE FROM story WHERE id NOT IN (SELECT MIN(id) FROM story GROUP BY user_id, author_id, title_key)
+        ''',
+        '''CREATE UNIQUE INDEX IF NOT EXISTS story_user_author_title ON story (user_id, author_id, title)''',
+        '''CREATE UNIQUE INDEX IF NOT EXISTS author_user_name_key ON author (user_id, name_key)''',
+        '''CREATE UNIQUE INDEX IF NOT EXISTS story_user_author_title_key ON story (user_id, author_id, title_key)''',
+        '''
+        CREATE TABLE IF NOT EXISTS author_trigram
+        (
+            user_id INTEGER NOT NULL,
+            trigram TEXT NOT NULL,
+            author_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, trigram, author_id)
+        ) WITHOUT ROWID
+        ''',
+        '''CREATE INDEX IF NOT EXISTS author_trigram_author ON author_trigram (author_id)''',
+        '''
+        CREATE TABLE IF NOT EXISTS story_trigram
+        (
+            user_id INTEGER NOT NULL,
+            author_id INTEGER NOT NULL,
+            trigram TEXT NOT NULL,
+            story_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, author_id, trigram, story_id)
+        ) WITHOUT ROWID
+        ''',
+        '''CREATE INDEX IF NOT EXISTS story_trigram_story ON story_trigram (story_id)''',
+        # Trigrams are added by DB.add_author() and DB.add_story(), triggers can not split text into rows
+        '''
+        CREATE TRIGGER IF NOT EXISTS author_trigram_delete
+        AFTER DELETE ON author
+        BEGIN
+            DELETE FROM author_trigram WHERE author_id == OLD.id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS story_trigram_delete
+        AFTER DELETE ON story
+        BEGIN
+            DELETE FROM story_trigram WHERE story_id == OLD.id;
+        END
+        ''',
+        # The same split as text_keys.trigrams(): every 3 characters of the key padded with spaces
+        '''
+        WITH RECURSIVE pos(i) AS (
+            SELECT 1 UNION ALL SELECT i + 1 FROM pos WHERE i < (SELECT MAX(length(name_key)) FROM author)
+        )
+        INSERT OR IGNORE INTO author_trigram (user_id, trigram, author_id)
+        SELECT author.user_id, substr(' ' || author.name_key || ' ', pos.i, 3), author.id
+        FROM author JOIN pos ON pos.i <= length(author.name_key)
+        ''',
+        '''
+        WITH RECURSIVE pos(i) AS (
+            SELECT 1 UNION ALL SELECT i + 1 FROM pos WHERE i < (SELECT MAX(length(title_key)) FROM story)
+        )
+        INSERT OR IGNORE INTO story_trigram (user_id, author_id, trigram, story_id)
+        SELECT story.user_id, story.author_id, substr(' ' || story.title_key || ' ', pos.i, 3), story.id
+        FROM story JOIN pos ON pos.i <= length(story.title_key)
+        ''',
+    ],
+    # 6: review counts and rank sums per user and rank, per author and per story, kept by triggers (see STATS_REBUILD)
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS rank_stats
+        (
+            user_id INTEGER NOT NULL,
+            rank INTEGER NOT NULL,
+            reviews INTEGER NOT NULL,
+            PRIMARY KEY (user_id, rank)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS author_stats
+        (
+            author_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            reviews INTEGER NOT NULL,
+            rank_sum INTEGER NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS story_stats
+        (
+            story_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            author_id INTEGER NOT NULL,
+            reviews INTEGER NOT NULL,
+            rank_sum INTEGER NOT NULL
+        )
+        ''',
+        # Top authors by the number of reviews and top stories by the average rank are read in index order
+        '''CREATE INDEX IF NOT EXISTS author_stats_user_reviews ON author_stats (user_id, reviews, author_id)''',
+        '''
+        CREATE INDEX IF NOT EXISTS story_stats_user_rank
+        ON story_stats (user_id, rank_sum * 1.0 / reviews, reviews, story_id)
+        ''',
+        # Only reviews of existing stories are counted. When a story is deleted, its row in story_stats lives
+        # until the last of its reviews is deleted by the cascade, so the author is still known then.
+        '''
+        CREATE TRIGGER IF NOT EXISTS review_stats_insert
+        AFTER INSERT ON review
+        BEGIN
+            INSERT INTO rank_stats (user_id, rank, reviews)
+            SELECT NEW.user_id, NEW.rank, 1 FROM story
+            WHERE story.id == NEW.story_id AND story.user_id == NEW.user_id
+            ON CONFLICT (user_id, rank) DO UPDATE SET reviews = reviews + 1;
+
+            INSERT INTO author_stats (author_id, user_id, reviews, rank_sum)
+            SELECT story.author_id, NEW.user_id, 1, NEW.rank FROM story
+            WHERE story.id == NEW.story_id AND story.user_id == NEW.user_id
+            ON CONFLICT (author_id) DO UPDATE SET reviews = reviews + 1, rank_sum = rank_sum + excluded.rank_sum;
+
+            INSERT INTO story_stats (story_id, user_id, author_id, reviews, rank_sum)
+            SELECT NEW.story_id, NEW.user_id, story.author_id, 1, NEW.rank FROM story
+            WHERE story.id == NEW.story_id AND story.user_id == NEW.user_id
+            ON CONFLICT (story_id) DO UPDATE SET reviews = reviews + 1, rank_sum = rank_sum + excluded.rank_sum;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS review_stats_delete
+        AFTER DELETE ON review
+        WHEN OLD.story_id IN (SELECT story_id FROM story_stats)
+        BEGIN
+            UPDATE rank_stats SET reviews = reviews - 1 WHERE user_id == OLD.user_id AND rank == OLD.rank;
+            DELETE FROM rank_stats WHERE user_id == OLD.user_id AND rank == OLD.rank AND reviews <= 0;
+
+            UPDATE author_stats SET reviews = reviews - 1, rank_sum = rank_sum - OLD.rank
+            WHERE author_id == (SELECT author_id FROM story_stats WHERE story_id == OLD.story_id);
+            DELETE FROM author_stats
+            WHERE author_id == (SELECT author_id FROM story_stats WHERE story_id == OLD.story_id) AND reviews <= 0;
+
+            UPDATE story_stats SET reviews = reviews - 1, rank_sum = rank_sum - OLD.rank
+            WHERE story_id == OLD.story_id;
+            DELETE FROM story_stats WHERE story_id == OLD.story_id AND reviews <= 0;
+        END
+        ''',
+        # Count reviews written before this version
+        *STATS_REBUILD,
+    ],
+    # 7: every worker process (see workers.py) keeps the buttons of its own users, existing ones belong to the first
+    [
+        '''ALTER TABLE callback_keyboard ADD COLUMN worker INTEGER NOT NULL DEFAULT 0''',
+        '''ALTER TABLE callback_query ADD COLUMN worker INTEGER NOT NULL DEFAULT 0''',
+    ],
+    # 8: removal marks rows with the time it happened, so that it can be undone; marked rows are deleted later
+    # by DB.purge_removed() bottom-up in set-based statements instead of the per-row cascade of triggers
+    [
+        '''ALTER TABLE author ADD COLUMN removed_at REAL''',
+        '''ALTER TABLE story ADD COLUMN removed_at REAL''',
+        '''ALTER TABLE review ADD COLUMN removed_at REAL''',
+        # Only marked rows get into these indexes: they serve /undo and the purge
+        '''CREATE INDEX IF NOT EXISTS author_removed ON author (user_id, removed_at) WHERE removed_at IS NOT NULL''',
+        '''CREATE INDEX IF NOT EXISTS story_removed ON story (user_id, removed_at) WHERE removed_at IS NOT NULL''',
+        '''CREATE INDEX IF NOT EXISTS review_removed ON review (user_id, removed_at) WHERE removed_at IS NOT NULL''',
+        '''DROP TRIGGER IF EXISTS on_author_delete''',
+        '''DROP TRIGGER IF EXISTS on_story_delete''',
+        # Reviews are subtracted from the statistics when they are marked (see DB._count_reviews()),
+        # and reviews of removed stories and authors are already out of story_stats when they are deleted
+        '''DROP TRIGGER IF EXISTS review_stats_delete''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS review_stats_delete
+        AFTER DELETE ON review
+        WHEN OLD.removed_at IS NULL AND OLD.story_id IN (SELECT story_id FROM story_stats)
+        BEGIN
+            UPDATE rank_stats SET reviews = reviews - 1 WHERE user_id == OLD.user_id AND rank == OLD.rank;
+            DELETE FROM rank_stats WHERE user_id == OLD.user_id AND rank == OLD.rank AND reviews <= 0;
+
+            UPDATE author_stats SET reviews = reviews - 1, rank_sum = rank_sum - OLD.rank
+            WHERE author_id == (SELECT author_id FROM story_stats WHERE story_id == OLD.story_id);
+            DELETE FROM author_stats
+            WHERE author_id == (SELECT author_id FROM story_stats WHERE story_id == OLD.story_id) AND reviews <= 0;
+
+            UPDATE story_stats SET reviews = reviews - 1, rank_sum = rank_sum - OLD.rank
+            WHERE story_id == OLD.story_id;
+            DELETE FROM story_stats WHERE story_id == OLD.story_id AND reviews <= 0;
+        END
+        ''',
+        *STATS_REBUILD_8,
+    ],
+    # 9: the full-text index carries the owner of every review as a token of its own column, so that a search
+    # matches only the reviews of one user instead of all reviews in the database (see DB.search_reviews())
+    [
+        '''DROP TRIGGER IF EXISTS review_fts_insert''',
+        '''DROP TRIGGER IF EXISTS review_fts_delete''',
+        '''DROP TRIGGER IF EXISTS review_fts_update''',
+        '''DROP TABLE IF EXISTS review_fts''',
+        # Content of the index is read through the view: the owner token is not stored in the review table
+        '''
+        CREATE VIEW IF NOT EXISTS review_fts_content AS
+        SELECT id, text, 'u' || user_id AS owner FROM review
+        ''',
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS review_fts USING fts5
+        (
+            text,
+            owner,
+            content='review_fts_content',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS review_fts_insert
+        AFTER INSERT ON review
+        BEGIN
+            INSERT INTO review_fts (rowid, text, owner) VALUES (NEW.id, NEW.text, 'u' || NEW.user_id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS review_fts_delete
+        AFTER DELETE ON review
+        BEGIN
+            INSERT INTO review_fts (review_fts, rowid, text, owner)
+            VALUES ('delete', OLD.id, OLD.text, 'u' || OLD.user_id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS review_fts_update
+        AFTER UPDATE OF text ON review
+        BEGIN
+            INSERT INTO review_fts (review_fts, rowid, text, owner)
+            VALUES ('delete', OLD.id, OLD.text, 'u' || OLD.user_id);
+            INSERT INTO review_fts (rowid, text, owner) VALUES (NEW.id, NEW.text, 'u' || NEW.user_id);
+        END
+        ''',
+        '''INSERT INTO review_fts (review_fts) VALUES ('rebuild')''',
+    ],
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection):
+    '''Обновляем схему БД до последней версии'''
+    version = schema_version(conn)
+    if version == SCHEMA_VERSION:
+        # Every start but the first: the schema is up to date, nothing to create
+        return
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f'Database schema version {version} is newer than supported {SCHEMA_VERSION}')
+    # Keys of existing rows are computed by the same function as the keys of new ones
+    conn.create_function('text_key', 1, text_key, deterministic=True)
+
+    for target, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        logging.info(f'Migrate database schema to version {target}')
+        cursor = conn.cursor()
+        cursor.execute('BEGIN')
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+            # PRAGMA does not accept bound parameters
+            cursor.execute(f'PRAGMA user_version = {target:d}')
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
@@ -0,0 +1,111 @@
+import json
+import pickle
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from async_db import AsyncDB
+
+
+class SQLitePersistence(BasePersistence):
+    '''Хранение состояния диалогов, данных пользователей и данных кнопок в БД бота
+
+    Каждое значение хранится в своей строке, поэтому запись меняет только то, что изменилось:
+    Application раз в `update_interval` секунд передаёт только изменённые ключи, а данные кнопок
+    сравниваются с уже сохранёнными. Законченные диалоги и пустые данные пользователей удаляются,
+    так что размер таблиц пропорционален числу активных диалогов.
+
+    Процессы-обработчики (см. workers.py) хранят данные кнопок отдельно, каждый под своим номером `worker`:
+    кнопки пользователя нажимаются в том же процессе, который их создал. Диалоги и данные пользователей
+    и так разделены между процессами по пользователям.
+    '''
+
+    def __init__(self, db: AsyncDB, update_interval: float = 60, worker: int = 0):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=True),
+            update_interval=update_interval,
+        )
+        self.db = db
+        self.worker = worker
+        # What is already stored, to find out what has changed in the callback data
+        self._keyboard_times = {}
+        self._queries = {}
+
+    async def get_user_data(self):
+        rows = await self.db.load_user_data()
+        return {user_id: pickle.loads(data) for user_id, data in rows}
+
+    async def update_user_data(self, user_id: int, data: dict):
+        await self.db.save_user_data(user_id, pickle.dumps(data) if data else None)
+
+    async def drop_user_data(self, user_id: int):
+        await self.db.save_user_data(user_id, None)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        pass
+
+    async def get_conversations(self, name: str):
+        rows = await self.db.load_conversations(name)
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name: str, key: tuple, new_state):
+        state = None if new_state is None else pickle.dumps(new_state)
+        await self.db.save_conversation(name, json.dumps(key), state)
+
+    async def get_callback_data(self):
+        keyboards, queries = await self.db.load_callback_data(self.worker)
+        self._keyboard_times = {uuid: access_time for uuid, access_time, _ in keyboards}
+        self._queries = dict(queries)
+        if not keyboards and not queries:
+            return None
+        return [(uuid, access_time, pickle.loads(data)) for uuid, access_time, data in keyboards], dict(queries)
+
+    async def update_callback_data(self, data):
+        keyboard_data, queries = data
+        keyboard_times = {}
+        new_keyboards, access_times = [], []
+        for uuid, access_time, button_data in keyboard_data:
+            keyboard_times[uuid] = access_time
+            stored_time = self._keyboard_times.get(uuid)
+            if stored_time is None:
+                new_keyboards.append((uuid, access_time, pickle.dumps(button_data)))
+            elif stored_time != access_time:
+                # Buttons of a keyboard never change, only the time it was used
+                access_times.append((access_time, uuid))
+        removed_keyboards = [(uuid,) for uuid in self._keyboard_times.keys() - keyboard_times.keys()]
+        new_queries = [item for item in queries.items() if self._queries.get(item[0]) != item[1]]
+        removed_queries = [(query_id,) for query_id in self._queries.keys() - queries.keys()]
+        if not (new_keyboards or access_times or removed_keyboards or new_queries or removed_queries):
+            return
+
+        await self.db.save_callback_data(
+            new_keyboards, access_times, removed_keyboards, new_queries, removed_queries, self.worker
+        )
+        self._keyboard_times = keyboard_times
+        self._queries = dict(queries)
+
+    # Bot and chat data are not used by the bot, so they are not stored
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_chat_data(self):
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data):
+        pass
+
+    async def flush(self):
+        # Every update has already been committed by the write queue
+        pass
@@ -0,0 +1,153 @@
+'''Планировщик исходящих запросов к Bot API
+
+Все запросы бота, кроме getUpdates, проходят через SendScheduler (см. ExtBot.rate_limiter):
+
+* общий token bucket и token bucket каждого чата держат бота в лимитах Telegram: всплеск запросов
+  ждёт своей очереди, а не получает 429;
+* если 429 (RetryAfter) всё же пришёл, все запросы ждут указанное время, и запрос повторяется;
+* ответ на нажатие кнопки (answerCallbackQuery) уходит в фоне, одновременно со следующим запросом
+  обработчика (обычно правкой сообщения), так что нажатие стоит одного обращения к API вместо двух подряд.
+'''
+import asyncio
+import itertools
+import logging
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from cache import LRUCache
+from metrics import API_EVENTS, API_REQUEST_SECONDS
+
+
+# Their result does not matter to handlers
+BACKGROUND_ENDPOINTS = frozenset(('answerCallbackQuery',))
+
+
+class TokenBucket:
+    '''В среднем не больше `rate` запросов в секунду и не больше `capacity` подряд; ждущие идут по очереди'''
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+
+class SendScheduler(BaseRateLimiter):
+    '''Лимиты: `rate` запросов в секунду на всего бота, `chat_rate` в секунду и `chat_burst` подряд на чат
+
+    0 отключает соответствующий лимит. Лимиты чатов хранятся для `max_chats` последних чатов.
+    '''
+
+    def __init__(
+        self, rate: float = 30, chat_rate: float = 1, chat_burst: int = 5, max_retries: int = 3,
+        max_chats: int = 10000,
+    ):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(rate, rate) if rate > 0 else None
+        self._chat_buckets = LRUCache(max_chats)
+        self._paused_until = 0.0
+        self._background = set()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        '''Дожидаемся ответов на нажатия кнопок, отправленных в фоне'''
+        if self._background:
+            await asyncio.wait(self._background)
+
+    async def process_request(self, callback, args, kwargs, endpoint: str, data: dict, rate_limit_args):
+        start = time.perf_counter()
+        try:
+            if endpoint in BACKGROUND_ENDPOINTS:
+                task = asyncio.create_task(self._send_background(endpoint, data, (callback, args, kwargs)))
+                self._background.add(task)
+                task.add_done_callback(self._background.discard)
+                # The same as Telegram answers
+                return True
+            return await self._send(endpoint, data.get('chat_id'), (callback, args, kwargs))
+        finally:
+            API_REQUEST_SECONDS.observe(endpoint, value=time.perf_counter() - start)
+
+    async def _acquire(self, chat_id):
+        while (pause := self._paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(pause)
+        if chat_id is not None and self.chat_rate > 0:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+                self._chat_buckets.put(chat_id, bucket)
+            await bucket.acquire()
+        if self._bucket is not None:
+            await self._bucket.acquire()
+
+    async def _send(self, endpoint: str, chat_id, request: tuple):
+        '''Отправляем запрос `(callback, args, kwargs)`, когда подойдёт его очередь'''
+        callback, args, kwargs = request
+        for attempt in itertools.count():
+            await self._acquire(chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                API_EVENTS.inc(endpoint, 'retry_after')
+                if attempt >= self.max_retries:
+                    raise
+                logging.warning(f'Flood control on {endpoint}, all requests wait {e.retry_after} s')
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+
+    async def _send_background(self, endpoint: str, data: dict, request: tuple):
+        try:
+            await self._send(endpoint, data.get('chat_id'), request)
+        except Exception:
+            API_EVENTS.inc(endpoint, 'failed')
+            logging.exception(f'Failed to call {endpoint} in background')
+
+
+if __name__ == '__main__':
+    async def check():
+        calls = []
+
+        async def call(endpoint, data):
+            calls.append((endpoint, data['text']))
+            await asyncio.sleep(0.01)
+            return data['text']
+
+        scheduler = SendScheduler(rate=0, chat_rate=10, chat_burst=1)
+        start = time.monotonic()
+        messages = [
+            scheduler.process_request(
+                call, ('sendMessage', {'text': text}), {}, 'sendMessage', {'chat_id': 1, 'text': text}, None,
+            )
+            for text in 'abc'
+        ]
+        # The first message takes the only token of the chat, the others wait for the next ones in turn
+        assert await asyncio.gather(*messages) == ['a', 'b', 'c']
+        assert calls == [('sendMessage', 'a'), ('sendMessage', 'b'), ('sendMessage', 'c')]
+        assert 0.19 < time.monotonic() - start < 0.35
+
+        start = time.monotonic()
+        bucket = TokenBucket(rate=100, capacity=2)
+        for _ in range(6):
+            await bucket.acquire()
+        assert 0.035 < time.monotonic() - start < 0.1
+
+    asyncio.run(check())
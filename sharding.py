@@ -0,0 +1,269 @@
+'''Разделение пользователей между несколькими файлами SQLite
+
+Каждый пользователь целиком (авторы, произведения, отзывы и всё, что на них построено) живёт
+в одном шарде, который выбирается по кольцу консистентного хеширования. Данные бота (диалоги,
+данные пользователей и кнопок, см. persistence.py) хранятся в шарде 0 - это файл BOT_DB,
+так что одиночная БД - это просто один шард, и переход к нескольким шардам - это перебалансировка
+(см. rebalance() и maintenance.py).
+'''
+from bisect import bisect
+import hashlib
+import logging
+import os
+
+from db import DB
+from entities import User
+from text_keys import trigrams
+
+
+def stable_hash(key: str) -> int:
+    '''Хеш, одинаковый во всех процессах (встроенный hash() для строк меняется от запуска к запуску)'''
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    '''Кольцо консистентного хеширования: при добавлении узла переезжает только ~1/n ключей'''
+
+    def __init__(self, nodes: int, vnodes: int = 64):
+        self.nodes = nodes
+        points = sorted((stable_hash(f'node-{node}-{v}'), node) for node in range(nodes) for v in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node(self, key: int) -> int:
+        if self.nodes == 1:
+            return 0
+        i = bisect(self._hashes, stable_hash(str(key)))
+        return self._nodes[i % len(self._nodes)]
+
+
+def shard_paths(sqlite_fn: str, shards: int) -> list:
+    '''Шард 0 - сам `sqlite_fn`, остальные лежат рядом: diary.sqlite -> diary-1.sqlite, diary-2.sqlite, ...'''
+    base, ext = os.path.splitext(sqlite_fn)
+    return [sqlite_fn] + [f'{base}-{i}{ext}' for i in range(1, shards)]
+
+
+def _user_id(args: tuple):
+    '''Пользователь вызова: первый аргумент методов DB - User или сущность с `user_id`'''
+    if args:
+        if isinstance(args[0], User):
+            return args[0].id
+        user_id = getattr(args[0], 'user_id', None)
+        if user_id is not None:
+            return user_id
+    return None
+
+
+class ShardedDB:
+    '''То же API, что у DB, но каждый вызов уходит в шард своего пользователя
+
+    Вызовы без пользователя (данные бота) идут в шард 0. AsyncDB заводит по потоку и очереди
+    записи на каждый шард (см. shard_index()), так что шарды фиксируют транзакции параллельно.
+    '''
+
+    def __init__(self, sqlite_fns: list, debug=False, read_only=False):
+        self.shards = [DB(sqlite_fn, debug=debug, read_only=read_only) for sqlite_fn in sqlite_fns]
+        self.ring = HashRing(len(self.shards))
+        self.debug = debug
+
+    def shard_index(self, args: tuple) -> int:
+        user_id = _user_id(args)
+        return 0 if user_id is None else self.ring.node(user_id)
+
+    def shard(self, user_id: int) -> DB:
+        return self.shards[self.ring.node(user_id)]
+
+    def __getattr__(self, name: str):
+        # Every DB method is routed by its arguments
+        if name.startswith('_') or not callable(getattr(DB, name, None)):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            return getattr(self.shards[self.shard_index(args)], name)(*args, **kwargs)
+        call.__name__ = name
+        return call
+
+    @property
+    def in_memory(self) -> bool:
+        return any(shard.in_memory for shard in self.shards)
+
+    def prepare(self):
+        for shard in self.shards:
+            shard.prepare()
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    def reader(self):
+        return ShardedDB([shard.sqlite_fn for shard in self.shards], debug=self.debug, read_only=True)
+
+    def check_stats(self) -> dict:
+        mismatches = {}
+        for shard in self.shards:
+            for table, rows in shard.check_stats().items():
+                mismatches[table] = mismatches.get(table, 0) + rows
+        return mismatches
+
+    def rebuild_stats(self):
+        for shard in self.shards:
+            shard.rebuild_stats()
+
+    def misplaced_users(self) -> dict:
+        '''{номер шарда: [пользователи, которые лежат в нём, но по кольцу должны быть в другом]}'''
+        misplaced = {}
+        for index, shard in enumerate(self.shards):
+            user_ids = [
+                user_id for user_id, in shard.conn.execute('''SELECT id FROM user UNION SELECT user_id FROM author''')
+                if self.ring.node(user_id) != index
+            ]
+            if user_ids:
+                misplaced[index] = user_ids
+        return misplaced
+
+    def rebalance(self, batch_size: int = 500) -> int:
+        '''Переносим пользователей в их шарды по кольцу; возвращаем число перенесённых
+
+        Запускается, пока бот остановлен, после изменения числа шардов. Пачка пользователей сначала
+        фиксируется в целевом шарде и только потом удаляется из исходного; если перенос прервался,
+        повторный запуск заменит неполные копии в целевом шарде данными из исходного.
+
+        В новом шарде у записей другие id, а сохранённые диалоги и данные кнопок (см. persistence.py)
+        ссылаются на старые. Поэтому диалоги переносимых пользователей заканчиваются, а все кнопки
+        становятся устаревшими: по ним нельзя удалить не ту запись.
+        '''
+        misplaced = self.misplaced_users()
+        if misplaced:
+            _forget_buttons(self.shards[0])
+        moved = 0
+        for source_index, user_ids in misplaced.items():
+            source = self.shards[source_index]
+            for start in range(0, len(user_ids), batch_size):
+                batch = user_ids[start:start + batch_size]
+                _forget_dialogs(self.shards[0], batch)
+                by_target = {}
+                for user_id in batch:
+                    by_target.setdefault(self.ring.node(user_id), []).append(user_id)
+                for target_index, target_users in by_target.items():
+                    _copy_users(source, self.shards[target_index], target_users)
+                _delete_users(source, batch)
+                moved += len(batch)
+                logging.info(f'Moved {moved} users')
+        return moved
+
+
+def _forget_buttons(db: DB):
+    '''Удаляем данные кнопок всех процессов: в них нет пользователя, так что устаревают все кнопки'''
+    cursor = db.conn.cursor()
+    cursor.execute('BEGIN')
+    try:
+        cursor.execute('''DELETE FROM callback_query''')
+        cursor.execute('''DELETE FROM callback_keyboard''')
+    except Exception:
+        db.conn.rollback()
+        raise
+    db.conn.commit()
+
+
+def _forget_dialogs(db: DB, user_ids: list):
+    '''Заканчиваем диалоги пользователей и удаляем их черновики; ключ диалога - [чат, пользователь]'''
+    params = [(user_id,) for user_id in user_ids]
+    cursor = db.conn.cursor()
+    cursor.execute('BEGIN')
+    try:
+        cursor.executemany('''DELETE FROM conversation WHERE json_extract(key, '$[#-1]') == ?''', params)
+        cursor.executemany('''DELETE FROM user_data WHERE user_id == ?''', params)
+    except Exception:
+        db.conn.rollback()
+        raise
+    db.conn.commit()
+
+
+def _delete_users(db: DB, user_ids: list):
+    '''Удаляем пользователей со всеми данными снизу вверх; индексы и статистика обновляются триггерами'''
+    cursor = db.conn.cursor()
+    cursor.execute('BEGIN')
+    try:
+        params = [(user_id,) for user_id in user_ids]
+        cursor.executemany('''DELETE FROM review WHERE user_id == ?''', params)
+        cursor.executemany('''DELETE FROM story WHERE user_id == ?''', params)
+        cursor.executemany('''DELETE FROM author WHERE user_id == ?''', params)
+        cursor.executemany('''DELETE FROM user WHERE id == ?''', params)
+    except Exception:
+        db.conn.rollback()
+        raise
+    db.conn.commit()
+
+
+def _copy_users(source: DB, target: DB, user_ids: list):
+    '''Копируем пользователей в другой шард одной транзакцией; id записей там выдаются заново
+
+    Удалённое пользователями (см. DB.remove_author()) не копируется: вернуть его после переноса нельзя.
+    '''
+    _delete_users(target, user_ids)
+    src = source.conn.cursor()
+    cursor = target.conn.cursor()
+    cursor.execute('BEGIN')
+    try:
+        for user_id in user_ids:
+            cursor.execute('''INSERT OR IGNORE INTO user VALUES (?)''', (user_id,))
+            author_ids = {}
+            for old_id, name, name_key in src.execute(
+                '''SELECT id, name, name_key FROM author WHERE user_id == ? AND removed_at IS NULL''', (user_id,)
+            ).fetchall():
+                cursor.execute(
+                    '''INSERT INTO author (user_id, name, name_key) VALUES (?, ?, ?)''', (user_id, name, name_key)
+                )
+                author_ids[old_id] = cursor.lastrowid
+                cursor.executemany(
+                    '''INSERT INTO author_trigram (user_id, trigram, author_id) VALUES (?, ?, ?)''',
+                    [(user_id, trigram, cursor.lastrowid) for trigram in trigrams(name_key)]
+                )
+            story_ids = {}
+            for old_id, title, author_id, title_key in src.execute(
+                '''SELECT id, title, author_id, title_key FROM story WHERE user_id == ? AND removed_at IS NULL''',
+                (user_id,)
+            ).fetchall():
+                if author_id not in author_ids:
+                    continue
+                author_id = author_ids[author_id]
+                cursor.execute(
+                    '''INSERT INTO story (user_id, title, author_id, title_key) VALUES (?, ?, ?, ?)''',
+                    (user_id, title, author_id, title_key)
+                )
+                story_ids[old_id] = cursor.lastrowid
+                cursor.executemany(
+                    '''INSERT INTO story_trigram (user_id, author_id, trigram, story_id) VALUES (?, ?, ?, ?)''',
+                    [(user_id, author_id, trigram, cursor.lastrowid) for trigram in trigrams(title_key)]
+                )
+            # The full-text index and the statistics are filled by triggers
+            cursor.executemany(
+                '''INSERT INTO review (user_id, story_id, text, rank) VALUES (?, ?, ?, ?)''',
+                [
+                    (user_id, story_ids[story_id], text, rank) for story_id, text, rank in src.execute(
+                        '''
+                            SELECT story_id, text, rank FROM review
+                            WHERE user_id == ? AND removed_at IS NULL ORDER BY id
+                        ''',
+                        (user_id,)
+                    )
+                    if story_id in story_ids
+                ]
+            )
+    except Exception:
+        target.conn.rollback()
+        raise
+    target.conn.commit()
+
+
+if __name__ == '__main__':
+    ring = HashRing(4)
+    assert [ring.node(user_id) for user_id in range(5)] == [HashRing(4).node(user_id) for user_id in range(5)]
+    counts = [0] * 4
+    for user_id in range(10000):
+        counts[ring.node(user_id)] += 1
+    assert min(counts) > 1500, counts
+    # Growing from 4 to 5 nodes moves about a fifth of the keys, and only to the new node
+    bigger = HashRing(5)
+    moved = [user_id for user_id in range(10000) if bigger.node(user_id) != ring.node(user_id)]
+    assert len(moved) < 3000 and all(bigger.node(user_id) == 4 for user_id in moved), len(moved)
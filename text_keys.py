@@ -0,0 +1,29 @@
+import re
+import unicodedata
+
+
+def text_key(text: str) -> str:
+    '''Ключ для сравнения имён авторов и названий произведений
+
+    Регистр, `ё`, пунктуация и лишние пробелы не учитываются: «Толстой» и « толстой!» дают один ключ.
+    '''
+    text = unicodedata.normalize('NFKC', text).casefold().replace('ё', 'е')
+    return ' '.join(re.findall(r'[^\W_]+', text))
+
+
+def trigrams(key: str) -> set:
+    '''Триграммы ключа, дополненного пробелами, так что у ключа из n символов их не больше n
+
+    Та же разбивка делается в SQL при миграции (см. migrations.py), они должны совпадать.
+    '''
+    padded = f' {key} '
+    return {padded[i:i + 3] for i in range(len(key))}
+
+
+if __name__ == '__main__':
+    assert text_key(' Лев  Толстой! ') == text_key('лев толстой') == 'лев толстой'
+    assert text_key('Ёжик в тумане') == text_key('ежик в тумане')
+    assert text_key('«Мастер и Маргарита»') == 'мастер и маргарита'
+    assert text_key('...') == ''
+    assert trigrams('ab') == {' ab', 'ab '}
+    assert trigrams('толстой') == {' то', 'тол', 'олс', 'лст', 'сто', 'той', 'ой '}
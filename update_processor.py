@@ -0,0 +1,61 @@
+from collections import deque
+import logging
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    '''Обрабатываем обновления разных пользователей параллельно, а одного пользователя - строго по порядку
+
+    Пока обрабатывается обновление пользователя, его следующие обновления встают в очередь за ним
+    и обрабатываются тем же заданием, так что шаги ConversationHandler одного пользователя не гоняются,
+    а ожидающие обновления не занимают слоты `max_concurrent_updates`.
+    '''
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # User (or chat) id -> updates that came while an update of the user is processed
+        self._pending = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @staticmethod
+    def _key(update: object):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine):
+        key = self._key(update)
+        if key is None:
+            await coroutine
+            return
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending.append(coroutine)
+            return
+
+        self._pending[key] = pending = deque((coroutine,))
+        try:
+            while pending:
+                try:
+                    await pending[0]
+                except Exception:
+                    # Application handles errors of handlers itself, this is the last resort
+                    logging.exception(f'Failed to process an update of {key}')
+                pending.popleft()
+        finally:
+            del self._pending[key]
+            # Something is left only if the task was cancelled, the queued updates are dropped then
+            for queued in list(pending)[1:]:
+                queued.close()
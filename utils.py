@@ -1,40 +1,87 @@
 from functools import wraps
 import logging
+import time
+from typing import Iterable, Iterator
 
 from telegram import CallbackQuery
 
+from cache import LRUCache
 from config import Config
+from consts import MESSAGE_MAX_LENGTH
 from entities import User
+from metrics import CACHES, HANDLER_ERRORS, HANDLER_SECONDS, TRANSITIONS, state_label
 
 
-def reshape(array1d: list, nrows: int, ncols: int) -> list:
-    '''
-    reshape([1,2,3,4,5,6], 2, 3) -> [[1,2,3], [4,5,6]]
-    '''
-    # assert len(array1d) >= nrows * ncols
-    result = []
-    for y in range(nrows):
-        row = []
-        if y*ncols < len(array1d):
-            for x in range(ncols):
-                index = y*ncols + x
-                if index < len(array1d):
-                    row.append(array1d[index])
-            result.append(row)
-        else:
-            break
-
-    return result
+# Users that are already registered in db, by id; the cached objects are reused between updates
+known_users = LRUCache(Config.known_users_cache_size())
+CACHES.register('known_users', known_users.stats)
+
+
+def _split_text(text: str, limit: int, room: int) -> Iterator[str]:
+    '''Делим текст на куски не длиннее `limit` (первый - не длиннее `room`), по возможности по границам строк'''
+    while len(text) > room:
+        cut = text.rfind('\n', 0, room) + 1
+        if cut == 0:
+            cut = room
+        yield text[:cut]
+        text = text[cut:]
+        room = limit
+    if text:
+        yield text
+
+
+def chunk_messages(parts: Iterable[str], header: str = '', limit: int = MESSAGE_MAX_LENGTH) -> Iterator[str]:
+    '''Склеиваем части текста в сообщения не длиннее `limit`, отдавая каждое сообщение сразу, как оно готово'''
+    chunk, length = [header], len(header)
+    for part in parts:
+        if length + len(part) > limit and (len(chunk) > 1 or length >= limit):
+            # The part does not fit after the previous ones and starts the next message;
+            # after the header alone it is split right away, so the header is not sent on its own
+            yield ''.join(chunk)
+            chunk, length = [], 0
+        for piece in _split_text(part, limit, limit - length):
+            if length + len(piece) > limit:
+                yield ''.join(chunk)
+                chunk, length = [], 0
+            chunk.append(piece)
+            length += len(piece)
+    if length:
+        yield ''.join(chunk)
 
 
 def with_db(callable):
-    '''Добавляем объекты БД и пользователя к обработчику и при необходимости регистрируем пользователя'''
-    db = Config.db()
+    '''Добавляем объекты БД и пользователя к обработчику и при необходимости регистрируем пользователя
+
+    Заодно измеряем время работы обработчика и считаем, в какие состояния диалога он переходит.
+    '''
+    name = callable.__name__
 
     @wraps(callable)
     async def f(update, context):
-        user = User(update.effective_user)
-        db.add_user_if_new(user)
+        start = time.perf_counter()
+        try:
+            state = await handle(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(name, value=time.perf_counter() - start)
+        TRANSITIONS.inc(name, state_label(state))
+        return state
+
+    async def handle(update, context):
+        # Not at decoration time: importing handlers does not open the database
+        db = Config.async_db()
+        effective_user = update.effective_user
+        user = known_users.get(effective_user.id)
+        if user is None:
+            user = User(effective_user)
+            await db.add_user_if_new(user)
+            known_users.put(user.id, user)
+        elif not user.matches(effective_user):
+            # User has changed the name or the language
+            user = User(effective_user)
+            known_users.put(user.id, user)
         return await callable(update, context, db, user)
 
     return f
@@ -49,8 +96,9 @@ async def update_confirm_status(query: CallbackQuery, status_msg: str):
 
 
 if __name__ == '__main__':
-    assert reshape([1, 2, 3, 4, 5, 6], 2, 3) == [[1, 2, 3], [4, 5, 6]]
-    assert reshape([1, 2, 3, 4, 5, 6], 3, 2) == [[1, 2], [3, 4], [5, 6]]
-    assert reshape([1, 2, 3, 4, 5, 6], 2, 2) == [[1, 2], [3, 4]]
-    assert reshape([1, 2, 3, 4, 5, 6, 7], 3, 3) == [[1, 2, 3], [4, 5, 6], [7]]
-    assert reshape([1, 2, 3, 4, 5, 6, 7], 5, 3) == [[1, 2, 3], [4, 5, 6], [7]]
+    assert list(chunk_messages(['ab', 'cd', 'ef'], limit=4)) == ['abcd', 'ef']
+    assert list(chunk_messages(['a\nbcdef'], header='h', limit=4)) == ['ha\n', 'bcde', 'f']
+    assert list(chunk_messages([], header='h')) == ['h']
+    assert list(chunk_messages(['abcdef'], header='h', limit=4)) == ['habc', 'def']
+    assert list(chunk_messages(['ab', 'cdefgh'], header='h', limit=4)) == ['hab', 'cdef', 'gh']
+    assert list(chunk_messages(['ab'], header='hhhh', limit=4)) == ['hhhh', 'ab']
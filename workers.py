@@ -0,0 +1,183 @@
+'''Режим с несколькими процессами: принимающий процесс раздаёт обновления процессам-обработчикам
+
+Принимающий процесс получает обновления от Telegram так же, как одиночный бот (polling или webhook),
+и пересылает каждое по pipe одному из BOT_WORKERS обработчиков. Обработчик выбирается по кольцу
+консистентного хеширования (sharding.HashRing) от id пользователя, так что обновления пользователя
+обрабатываются одним процессом по порядку, а его диалоги и кнопки живут в памяти этого процесса.
+
+Обработчики работают с одной БД: в режиме WAL они читают параллельно, а запись ждёт блокировку
+(см. db.BUSY_TIMEOUT). Если BOT_DB_SHARDS равно BOT_WORKERS, кольца совпадают и каждый обработчик
+пишет только в свой шард.
+'''
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import multiprocessing
+from multiprocessing.connection import Connection, wait
+import signal
+
+from telegram import Bot, Update
+from telegram.ext import Application, ApplicationBuilder, ContextTypes, TypeHandler
+from telegram.request import HTTPXRequest
+
+from config import Config
+from sharding import HashRing
+from update_processor import PerUserUpdateProcessor
+
+
+# Sent instead of an update: to a worker to stop it, by a worker when it is ready
+_STOP = b''
+_READY = b'ready'
+
+
+class Dispatcher:
+    '''Запускаем процессы-обработчики и раздаём им обновления
+
+    В pipe каждого обработчика пишет свой поток, так что медленный обработчик не задерживает
+    ни остальных, ни получение обновлений, а порядок обновлений сохраняется.
+    '''
+
+    def __init__(self, workers: int, target=None):
+        context = multiprocessing.get_context('spawn')
+        self.ring = HashRing(workers)
+        self.connections = []
+        self.processes = []
+        self._senders = []
+        self._closing = False
+        for index in range(workers):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(
+                target=target or run_worker, args=(index, worker_connection), name=f'worker{index}'
+            )
+            process.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+            self._senders.append(ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'worker{index}'))
+
+    def wait_ready(self):
+        for index, connection in enumerate(self.connections):
+            try:
+                ready = connection.recv_bytes() == _READY
+            except EOFError:
+                ready = False
+            if not ready:
+                raise RuntimeError(f'Worker {index} failed to start')
+
+    def worker(self, update: Update) -> int:
+        key = PerUserUpdateProcessor._key(update)
+        return 0 if key is None else self.ring.node(key)
+
+    def send(self, index: int, data: bytes):
+        '''Ставим обновление в очередь на отправку обработчику `index`, не дожидаясь её'''
+        def check(future):
+            if future.exception() is not None:
+                logging.error(f'Failed to send an update to worker {index}', exc_info=future.exception())
+
+        self._senders[index].submit(self.connections[index].send_bytes, data).add_done_callback(check)
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        self.send(self.worker(update), update.to_json().encode())
+
+    async def watch(self, application: Application):
+        '''Останавливаем бота, если обработчик завершился сам: иначе обновления его пользователей теряются'''
+        await asyncio.get_running_loop().run_in_executor(None, wait, [process.sentinel for process in self.processes])
+        if not self._closing:
+            logging.error('A worker process has exited, stopping the bot')
+            application.stop_running()
+
+    def close(self):
+        '''Обработчики доделывают полученные обновления, сохраняют состояние и завершаются
+
+        Если какой-то из них упал, бросаем RuntimeError, чтобы бот завершился с ошибкой и его перезапустили.
+        '''
+        self._closing = True
+        for index, process in enumerate(self.processes):
+            if process.is_alive():
+                self.send(index, _STOP)
+        for sender in self._senders:
+            sender.shutdown(wait=True)
+        for process in self.processes:
+            process.join()
+        failed = [process.name for process in self.processes if process.exitcode != 0]
+        if failed:
+            raise RuntimeError(f'Worker processes failed: {", ".join(failed)}')
+
+
+def build_front(workers: int) -> Application:
+    '''Приложение принимающего процесса: все обновления пересылаются обработчикам
+
+    Его бот - обычный Bot без данных кнопок: кнопки разбирает обработчик, который их создал.
+    '''
+    dispatcher = Dispatcher(workers)
+    watcher = None
+
+    async def post_init(application: Application):
+        nonlocal watcher
+        await asyncio.get_running_loop().run_in_executor(None, dispatcher.wait_ready)
+        watcher = asyncio.create_task(dispatcher.watch(application))
+
+    async def post_shutdown(application: Application):
+        await asyncio.get_running_loop().run_in_executor(None, dispatcher.close)
+        if watcher is not None:
+            await watcher
+
+    bot = Bot(
+        Config.token(),
+        base_url=Config.api_base_url(),
+        request=HTTPXRequest(),
+        get_updates_request=HTTPXRequest(connection_pool_size=1),
+    )
+    application = ApplicationBuilder().bot(bot).post_init(post_init).post_shutdown(post_shutdown).build()
+    application.add_handler(TypeHandler(Update, dispatcher.dispatch))
+    return application
+
+
+async def serve(application: Application, connection: Connection):
+    '''Обрабатываем обновления из `connection`, пока принимающий процесс не попросит остановиться
+
+    Приложение запускается и останавливается так же, как в Application.run_polling().
+    '''
+    loop = asyncio.get_running_loop()
+    bot = application.bot
+    await application.initialize()
+    try:
+        if application.post_init is not None:
+            await application.post_init(application)
+        await application.start()
+        connection.send_bytes(_READY)
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='updates') as reader:
+            while True:
+                try:
+                    data = await loop.run_in_executor(reader, connection.recv_bytes)
+                except EOFError:
+                    # The front process is gone
+                    break
+                if data == _STOP:
+                    break
+                update = Update.de_json(json.loads(data), bot)
+                # The same as the updater does for updates it gets from Telegram
+                bot.insert_callback_data(update)
+                await application.update_queue.put(update)
+    finally:
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown is not None:
+            await application.post_shutdown(application)
+
+
+def run_worker(index: int, connection: Connection):
+    '''Точка входа процесса-обработчика'''
+    # Signals go to the whole process group, a worker stops when the front process tells it to
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logging.basicConfig(
+        format='%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    # main imports this module
+    from main import build_application, build_bot
+
+    asyncio.run(serve(build_application(build_bot(), worker=index), connection))